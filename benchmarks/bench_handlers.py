@@ -0,0 +1,369 @@
+"""
+Offline benchmark of the three Lambda handlers (src/lambda_function.py, src/super.py,
+super-create.py) with botocore stubbed: every Bedrock call returns a canned response
+immediately, so the numbers measure only our own code (parsing, graph helpers, retrieval
+assembly, prompt building, JSON extraction, response serialization).
+
+Diagrams are synthesized by tiling samples/sample_response.json up to the requested size,
+with conditional (rule-carrying) edges and branches. For each scenario and size the run reports
+p50 / p95 latency, peak traced memory and net allocated blocks, and writes everything to
+benchmarks/results/<timestamp>-<commit>.json. Pass --compare with an earlier file to print
+the change per scenario and flag regressions.
+
+    python benchmarks/bench_handlers.py [--sizes 10,100,1000,10000] [--iterations 20]
+                                        [--compare benchmarks/results/<old>.json] [--threshold 0.15]
+"""
+import argparse
+import base64
+import copy
+import datetime
+import gc
+import importlib.util
+import io
+import itertools
+import json
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SRC = os.path.join(ROOT, 'src')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+sys.path.insert(0, SRC)
+
+# Cấu hình phải có trước khi import handler (đọc env lúc import)
+_TMP = tempfile.mkdtemp(prefix='flowlens-bench-')
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench', 'AWS_DEFAULT_REGION': 'us-east-1',
+    'LOG_LEVEL': 'ERROR', 'METRICS_ENABLED': 'false', 'RETRIEVER': 'bedrock',
+    'ANALYSIS_CACHE_DB': os.path.join(_TMP, 'analysis.sqlite3'),
+    'RETRIEVAL_CACHE_DB': os.path.join(_TMP, 'retrieval.sqlite3'),
+})
+
+from botocore.response import StreamingBody  # noqa: E402
+from botocore.stub import Stubber  # noqa: E402
+
+from aws_clients import get_client  # noqa: E402
+
+# Số thứ tự lời gọi, duy nhất trong cả lần chạy (câu hỏi không lặp giữa các kịch bản)
+_call_sequence = itertools.count()
+
+ANALYSIS_SECTIONS = ('overview', 'components', 'execution', 'evaluation', 'improvement', 'summary')
+
+
+# --- SINH SƠ ĐỒ TỔNG HỢP ---
+
+def make_diagram(n_nodes, template_path=os.path.join(ROOT, 'samples', 'sample_response.json')):
+    """
+    Tile the sample diagram until it has `n_nodes` nodes. Blocks are chained, every third
+    chained edge carries a rule, and each block's last node also branches (with a rule) to the
+    node two blocks ahead, so the graph is not a plain path.
+    """
+    with open(template_path, encoding='utf-8') as f:
+        template = json.load(f)
+    template = template.get('diagram', template)
+    block_nodes, block_edges = template['nodes'], template['edges']
+    nodes, edges = [], []
+    starts, ends = [], []
+    block = 0
+    while len(nodes) < n_nodes:
+        ids = {}
+        starts.append(len(nodes))
+        for node in block_nodes:
+            if len(nodes) >= n_nodes:
+                break
+            new = copy.deepcopy(node)
+            new['id'] = ids[node['id']] = f"{node['id']}_{block}"
+            new['data']['label'] = f"{node['data']['label']} #{block}"
+            new['position'] = {'x': 250 * (len(nodes) % 20), 'y': 120 * (len(nodes) // 20)}
+            new['type'] = 'default'
+            nodes.append(new)
+        ends.append(len(nodes) - 1)
+        for edge in block_edges:
+            if edge['source'] in ids and edge['target'] in ids:
+                new = copy.deepcopy(edge)
+                new.update(id=f"{edge['id']}_{block}", source=ids[edge['source']], target=ids[edge['target']])
+                edges.append(new)
+        if block > 0:
+            edges.append(_edge(f'chain_{block}', nodes[ends[block - 1]]['id'], nodes[starts[block]]['id'],
+                               with_rule=block % 3 == 0))
+        if block > 1:
+            edges.append(_edge(f'branch_{block}', nodes[ends[block - 2]]['id'], nodes[starts[block]]['id'],
+                               with_rule=True))
+        block += 1
+    nodes[0]['type'] = 'input'
+    nodes[-1]['type'] = 'output'
+    return {'nodes': nodes, 'edges': edges}
+
+
+def _edge(edge_id, source, target, with_rule):
+    edge = {'id': edge_id, 'source': source, 'target': target, 'type': 'custom', 'markerEnd': {'type': 'arrowclosed'}}
+    if with_rule:
+        edge['data'] = {'logic': 'AND', 'rules': [{'id': f'{edge_id}_r', 'field': 'Credit Score',
+                                                   'operator': 'Greater than', 'value': '650'}]}
+    return edge
+
+
+# --- BOTOCORE STUB ---
+
+def _png(width, height):
+    """Blank RGB PNG (screenshot-sized input for the create-with-image scenario)"""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+    rows = (b'\x00' + b'\xff' * (width * 3)) * height
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def _as_generated(diagram):
+    """Diagram as the create prompt asks for it (logic VÀ / HOẶC), so it passes validation"""
+    generated = copy.deepcopy(diagram)
+    for edge in generated['edges']:
+        data = edge.get('data') or {}
+        if 'logic' in data:
+            data['logic'] = {'AND': 'VÀ', 'OR': 'HOẶC'}.get(data['logic'], data['logic'])
+    return generated
+
+
+def _model_output(text):
+    raw = json.dumps({'content': [{'type': 'text', 'text': text}]}).encode('utf-8')
+    return {'body': StreamingBody(io.BytesIO(raw), len(raw)), 'contentType': 'application/json'}
+
+
+def _analysis_text():
+    analysis = {section: {'summary': f'Nội dung {section} (Nguồn [1])', 'items': ['a', 'b', 'c']}
+                for section in ANALYSIS_SECTIONS}
+    return 'Kết quả phân tích:\n```json\n' + json.dumps(analysis, ensure_ascii=False, indent=2) + '\n```'
+
+
+def _retrieve_output(k=12):
+    return {'retrievalResults': [{
+        'content': {'text': f'Quy định số {i}: kiểm tra điểm tín dụng, xác minh danh tính khách hàng, '
+                            f'phê duyệt khoản vay theo hạn mức. ' * 8},
+        'location': {'type': 'S3', 's3Location': {'uri': f's3://bench-kb/doc-{i % 4}.pdf'}},
+        'score': 0.9 - i * 0.03,
+        'metadata': {'document_id': f'doc-{i % 4}', 'document_name': f'doc-{i % 4}.pdf'}
+    } for i in range(k)]}
+
+
+class StubbedBedrock:
+    """Stubbers on the shared runtime / agent clients; responses are queued per iteration"""
+
+    def __init__(self):
+        self.runtime = Stubber(get_client('bedrock-runtime'))
+        self.agent = Stubber(get_client('bedrock-agent-runtime'))
+        self.runtime.activate()
+        self.agent.activate()
+
+    def queue(self, retrievals=0, model_texts=()):
+        for _ in range(retrievals):
+            self.agent.add_response('retrieve', _retrieve_output())
+        for text in model_texts:
+            self.runtime.add_response('invoke_model', _model_output(text))
+
+    def assert_drained(self):
+        self.runtime.assert_no_pending_responses()
+        self.agent.assert_no_pending_responses()
+
+
+def load_handlers():
+    import lambda_function
+    import super as super_handler
+    spec = importlib.util.spec_from_file_location('super_create', os.path.join(ROOT, 'super-create.py'))
+    super_create = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(super_create)
+    return lambda_function, super_handler, super_create
+
+
+# --- KỊCH BẢN ---
+
+def build_scenarios(handlers, stub, diagram):
+    """name -> (prepare(i) queues stub responses and returns the event, handler)"""
+    lambda_function, super_handler, super_create = handlers
+    analysis_text = _analysis_text()
+    # Model "sinh" lại chính sơ đồ tổng hợp => extract / validate / post-process tỉ lệ theo kích thước
+    generated_text = 'Đây là sơ đồ:\n' + json.dumps(_as_generated(diagram), ensure_ascii=False)
+    process_text = ' → '.join(node['data']['label'] for node in diagram['nodes'][:50])
+    retrievals_per_call = len(lambda_function.build_retrieval_queries(diagram, 'q'))
+
+    def analyze(fmt):
+        def prepare(i):
+            stub.queue(retrievals=retrievals_per_call, model_texts=[analysis_text])
+            # Câu hỏi khác nhau mỗi lần => trượt cả cache phân tích lẫn cache truy xuất
+            return {'body': json.dumps({'diagram': diagram, 'question': f'Phân tích rủi ro lần {i}',
+                                        'selectedDocumentIds': ['doc-1'], 'diagramFormat': fmt})}
+        return prepare, lambda_function.lambda_handler
+
+    primed = []
+
+    def analyze_hit(i):
+        # Lần gọi đầu (thuộc vòng khởi động) đi hết pipeline và ghi cache; các lần sau trúng cache
+        if not primed:
+            primed.append(True)
+            stub.queue(retrievals=retrievals_per_call, model_texts=[analysis_text])
+        return {'body': json.dumps({'diagram': diagram, 'question': 'Phân tích rủi ro (cache)'})}
+
+    super_retrievals = (len(super_handler.build_sub_queries(diagram, 'q', super_handler.RETRIEVAL_MAX_SUBQUERIES))
+                        if super_handler.RETRIEVAL_MODE == 'multi' else 1)
+
+    def super_analyze(i):
+        stub.queue(retrievals=super_retrievals, model_texts=[analysis_text])
+        return {'body': json.dumps({'diagram': diagram, 'question': f'Phân tích lần {i}'})}
+
+    def create(i):
+        stub.queue(model_texts=[generated_text])
+        # Chuỗi mũi tên sẽ đi đường parser quy tắc => tắt đi để đo đường gọi model
+        return {'body': json.dumps({'text': f'{process_text} ({i})', 'language': 'vietnamese', 'ruleParser': False})}
+
+    def create_rules(i):
+        # Không xếp hàng response nào: parser quy tắc không được phép gọi model
+        return {'body': json.dumps({'text': f'{process_text} ({i})', 'language': 'vietnamese'})}
+
+    create_primed = []
+
+    def create_hit(i):
+        # Như analyze_hit: chỉ lần đầu gọi model, các lần sau trúng cache sơ đồ đã sinh
+        if not create_primed:
+            create_primed.append(True)
+            stub.queue(model_texts=[generated_text])
+        return {'body': json.dumps({'text': f'{process_text} (cache {len(diagram["nodes"])})', 'language': 'vietnamese',
+                                    'ruleParser': False})}
+
+    # Ảnh chụp màn hình high-DPI: thu nhỏ nếu có Pillow, nếu không thì gửi nguyên trạng
+    screenshot = base64.b64encode(_png(2880, 1800)).decode('ascii')
+
+    def create_image(i):
+        stub.queue(model_texts=[generated_text])
+        return {'body': json.dumps({'image': screenshot, 'text': f'Ảnh quy trình ({i})'})}
+
+    return {
+        'analyze_miss_json': analyze('json'),
+        'analyze_miss_compact': analyze('compact'),
+        'analyze_cache_hit': (analyze_hit, lambda_function.lambda_handler),
+        'super_analyze': (super_analyze, super_handler.lambda_handler),
+        'create': (create, super_create.lambda_handler),
+        'create_cache_hit': (create_hit, super_create.lambda_handler),
+        'create_rules': (create_rules, super_create.lambda_handler),
+        'create_image': (create_image, super_create.lambda_handler),
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run_scenario(prepare, handler, stub, iterations, warmup=2):
+    def call():
+        event = prepare(next(_call_sequence))
+        response = handler(event, None)
+        if response.get('statusCode') != 200:
+            raise RuntimeError(f"handler returned {response.get('statusCode')}: {response.get('body', '')[:200]}")
+        stub.assert_drained()
+
+    for _ in range(warmup):
+        call()
+    timings = []
+    for _ in range(iterations):
+        gc.collect()
+        started = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    # Đo bộ nhớ ở một lần gọi riêng: tracemalloc làm chậm đáng kể, không trộn vào số đo thời gian
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    return {
+        'iterations': iterations,
+        'p50_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'peak_kib': round(peak / 1024, 1),
+        'net_blocks': sys.getallocatedblocks() - blocks_before
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return 'unknown'
+
+
+def compare(current, previous_path, threshold):
+    with open(previous_path, encoding='utf-8') as f:
+        previous = json.load(f)
+    old = {(r['scenario'], r['nodes']): r for r in previous['results']}
+    print(f"\ncompared with {previous.get('commit')} ({os.path.basename(previous_path)}), threshold {threshold:.0%}")
+    regressions = 0
+    for result in current['results']:
+        before = old.get((result['scenario'], result['nodes']))
+        if before is None:
+            continue
+        change = result['p50_ms'] / before['p50_ms'] - 1 if before['p50_ms'] else 0.0
+        flag = 'REGRESSION' if change > threshold else ''
+        regressions += bool(flag)
+        print(f"  {result['scenario']:<22}{result['nodes']:>7}  p50 {before['p50_ms']:>9.2f} -> {result['p50_ms']:>9.2f} ms "
+              f"({change:+.0%})  peak {before['peak_kib']:>9.1f} -> {result['peak_kib']:>9.1f} KiB  {flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--scenarios', default='', help='comma-separated subset (default: all)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='p50 slowdown reported as a regression')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    handlers = load_handlers()
+    stub = StubbedBedrock()
+    wanted = {s for s in args.scenarios.split(',') if s}
+    results = []
+
+    print(f"{'scenario':<22}{'nodes':>7}{'p50 (ms)':>11}{'p95 (ms)':>11}{'peak (KiB)':>12}{'net blocks':>12}")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        diagram = make_diagram(size)
+        # Sơ đồ lớn chạy ít vòng hơn để cả bộ benchmark vẫn xong trong vài phút
+        iterations = max(3, args.iterations if size <= 1000 else args.iterations // 4)
+        for name, (prepare, handler) in build_scenarios(handlers, stub, diagram).items():
+            if wanted and name not in wanted:
+                continue
+            stats = run_scenario(prepare, handler, stub, iterations)
+            results.append({'scenario': name, 'nodes': size, 'edges': len(diagram['edges']), **stats})
+            print(f"{name:<22}{size:>7}{stats['p50_ms']:>11.2f}{stats['p95_ms']:>11.2f}"
+                  f"{stats['peak_kib']:>12.1f}{stats['net_blocks']:>12}")
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'results': results
+    }
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['commit']}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nsaved {os.path.relpath(path, ROOT)}")
+    if args.compare:
+        sys.exit(1 if compare(report, args.compare, args.threshold) else 0)
+
+
+if __name__ == '__main__':
+    main()
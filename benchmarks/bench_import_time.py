@@ -0,0 +1,70 @@
+"""
+Cold-start benchmark: import time of each Lambda entry point in a fresh interpreter,
+with lazy AWS clients (default) and with AWS_CLIENTS_EAGER=true (old behaviour: boto3
+imported and clients created at import). No AWS call is made; clients are only constructed.
+
+    python benchmarks/bench_import_time.py [--repeat 7] [--top 8]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC = os.path.join(ROOT, 'src')
+
+ENTRY_POINTS = {
+    'lambda_function': "import lambda_function",
+    'super': "import super",
+    'super-create': ("import importlib.util as u; spec = u.spec_from_file_location('create', 'super-create.py'); "
+                     "spec.loader.exec_module(u.module_from_spec(spec))"),
+}
+
+TIMER = "import time; _t = time.perf_counter(); {stmt}; print(round((time.perf_counter() - _t) * 1000, 2))"
+
+
+def run_import(stmt, eager):
+    env = {**os.environ, 'PYTHONPATH': SRC, 'AWS_CLIENTS_EAGER': 'true' if eager else 'false',
+           'AWS_DEFAULT_REGION': 'us-east-1', 'LOG_LEVEL': 'ERROR', 'METRICS_ENABLED': 'false',
+           # Cache SQLite riêng cho benchmark, không đụng vào /tmp của ứng dụng
+           'ANALYSIS_CACHE_DB': '/tmp/bench_import_analysis.sqlite3',
+           'RETRIEVAL_CACHE_DB': '/tmp/bench_import_retrieval.sqlite3'}
+    out = subprocess.run([sys.executable, '-c', TIMER.format(stmt=stmt)], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def slowest_modules(stmt, top):
+    """Largest self-time entries from `python -X importtime`"""
+    env = {**os.environ, 'PYTHONPATH': SRC, 'LOG_LEVEL': 'ERROR', 'METRICS_ENABLED': 'false'}
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', stmt], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True)
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len('import time:'):].split('|')]
+        rows.append((int(self_us), int(cumulative_us), name))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--top', type=int, default=8)
+    args = parser.parse_args()
+
+    print(f"{'entry point':<18}{'lazy p50 (ms)':>15}{'eager p50 (ms)':>16}")
+    for name, stmt in ENTRY_POINTS.items():
+        lazy = [run_import(stmt, eager=False) for _ in range(args.repeat)]
+        eager = [run_import(stmt, eager=True) for _ in range(args.repeat)]
+        print(f"{name:<18}{statistics.median(lazy):>15.1f}{statistics.median(eager):>16.1f}")
+
+    print("\nslowest modules imported by lambda_function (self time):")
+    for self_us, cumulative_us, module in slowest_modules(ENTRY_POINTS['lambda_function'], args.top):
+        print(f"  {self_us / 1000:>8.1f} ms  {module}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark for extract_json_object (src/json_stream.py) against the legacy
+three-pass extractor that super-create.py used before.
+
+    python benchmarks/bench_json_extract.py [--repeat 5]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from json_stream import extract_json_object  # noqa: E402
+
+
+def legacy_extract(text):
+    """Copy of the previous extract_json_from_response (line scan + brace candidates + regex)"""
+    try:
+        for line in text.strip().split('\n'):
+            line = line.strip()
+            if line.startswith('{') and line.endswith('}'):
+                try:
+                    parsed = json.loads(line)
+                    if 'nodes' in parsed and 'edges' in parsed:
+                        return parsed
+                except Exception:
+                    continue
+        json_candidates = []
+        brace_level = 0
+        start_pos = -1
+        for i, char in enumerate(text):
+            if char == '{':
+                if brace_level == 0:
+                    start_pos = i
+                brace_level += 1
+            elif char == '}':
+                brace_level -= 1
+                if brace_level == 0 and start_pos != -1:
+                    json_candidates.append(text[start_pos:i + 1])
+        for candidate in sorted(json_candidates, key=len, reverse=True):
+            try:
+                parsed = json.loads(candidate)
+                if isinstance(parsed, dict) and 'nodes' in parsed and 'edges' in parsed:
+                    return parsed
+            except Exception:
+                continue
+        for match in re.findall(r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}', text, re.DOTALL):
+            try:
+                parsed = json.loads(match)
+                if isinstance(parsed, dict) and 'nodes' in parsed:
+                    return parsed
+            except Exception:
+                continue
+    except Exception:
+        pass
+    return None
+
+
+def make_diagram(n_nodes):
+    nodes = [{'id': str(i), 'type': 'default', 'data': {'label': f'Bước {i} {{xử lý}}'},
+              'position': {'x': 100 + 250 * i, 'y': 100}} for i in range(n_nodes)]
+    edges = [{'id': f'e{i}-{i + 1}', 'source': str(i), 'target': str(i + 1),
+              'data': {'logic': 'VÀ', 'rules': [{'id': 'r1', 'field': 'score', 'operator': 'Lớn hơn', 'value': '700'}]}}
+             for i in range(n_nodes - 1)]
+    return {'nodes': nodes, 'edges': edges}
+
+
+def build_cases():
+    big = make_diagram(5000)
+    return {
+        # Output bình thường nhưng rất lớn, có lời dẫn và code fence
+        'large_fenced': 'Đây là sơ đồ:\n```json\n' + json.dumps(big, ensure_ascii=False, indent=2) + '\n```\n',
+        # Nhiều object nhỏ cấp 1 không phải sơ đồ trước sơ đồ thật
+        'many_small_objects': ' '.join('{"k": %d}' % i for i in range(20000)) + json.dumps(make_diagram(50)),
+        # Ngoặc nhọn không cân bằng ở lời dẫn làm lệch bộ đếm cũ
+        'unbalanced_preamble': 'Dùng { để mở object. ' + json.dumps(make_diagram(2000), ensure_ascii=False),
+        # Ngoặc nằm trong chuỗi
+        'braces_in_strings': json.dumps({'nodes': [{'id': str(i), 'data': {'label': '}{' * 20}} for i in range(3000)],
+                                         'edges': []}),
+        # JSON bị cắt cụt (model hết max_tokens) với nhiều object lồng nhau
+        'truncated_nested': json.dumps(make_diagram(3000), ensure_ascii=False)[:-5000],
+        # Rất nhiều '{' không bao giờ đóng trước object thật
+        'unclosed_openers': 'x {' * 30000 + json.dumps(make_diagram(20)),
+        # Lồng sâu vượt giới hạn đệ quy của json
+        'deep_nesting': '{"nodes": [' * 20000,
+    }
+
+
+def bench(fn, text, repeat):
+    best = float('inf')
+    found = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        found = fn(text)
+        best = min(best, time.perf_counter() - t0)
+    return best, bool(found)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'case':<22}{'chars':>10}{'new (ms)':>12}{'found':>7}{'legacy (ms)':>14}{'found':>7}")
+    for name, text in build_cases().items():
+        new_t, new_found = bench(lambda t: extract_json_object(t, ('nodes', 'edges')), text, args.repeat)
+        old_t, old_found = bench(legacy_extract, text, args.repeat)
+        print(f"{name:<22}{len(text):>10}{new_t * 1000:>12.2f}{str(new_found):>7}{old_t * 1000:>14.2f}{str(old_found):>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+# --- JOB PHÂN TÍCH BẤT ĐỒNG BỘ (SUBMIT / POLL) ---
+# Store lưu trạng thái job (PROCESSING / COMPLETED / FAILED), kết quả từng phần và kết quả cuối.
+# Có thể thay thế: memory (test nhanh), sqlite (chạy local), dynamodb (production, dùng chung giữa các Lambda).
+
+STATUS_PROCESSING = 'PROCESSING'
+STATUS_COMPLETED = 'COMPLETED'
+STATUS_FAILED = 'FAILED'
+
+
+def new_job_record(job_id: str, ttl_seconds: float) -> Dict[str, Any]:
+    now = time.time()
+    return {
+        'jobId': job_id,
+        'status': STATUS_PROCESSING,
+        'createdAt': now,
+        'updatedAt': now,
+        'expiresAt': now + ttl_seconds,
+        'partial': {},
+        'result': None,
+        'error': None
+    }
+
+
+class JobStore:
+    """Interface for job persistence. Records are JSON-serializable dicts."""
+    # True khi mọi container / pod đọc ghi cùng một store (poll được từ bất kỳ instance nào)
+    shared = False
+
+    def create(self, record: Dict[str, Any]) -> bool:
+        """Insert a new job; return False if a live job with the same ID already exists"""
+        raise NotImplementedError
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def update(self, job_id: str, fields: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class InMemoryJobStore(JobStore):
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _purge(self, now: float) -> None:
+        for job_id in [k for k, v in self._jobs.items() if v['expiresAt'] < now]:
+            del self._jobs[job_id]
+
+    def create(self, record: Dict[str, Any]) -> bool:
+        with self._lock:
+            self._purge(time.time())
+            existing = self._jobs.get(record['jobId'])
+            if existing is not None and existing['status'] != STATUS_FAILED:
+                return False
+            self._jobs[record['jobId']] = dict(record)
+            return True
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None or record['expiresAt'] < time.time():
+                return None
+            return json.loads(json.dumps(record))
+
+    def update(self, job_id: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is not None:
+                record.update(fields)
+                record['updatedAt'] = time.time()
+
+
+class SQLiteJobStore(JobStore):
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, record TEXT NOT NULL, '
+            'status TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+
+    def create(self, record: Dict[str, Any]) -> bool:
+        with self._lock:
+            self._conn.execute('DELETE FROM jobs WHERE expires_at < ?', (time.time(),))
+            # Chỉ ghi đè job đã FAILED; job đang chạy hoặc đã xong được dùng lại (dedupe)
+            cursor = self._conn.execute(
+                'INSERT INTO jobs (job_id, record, status, expires_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(job_id) DO UPDATE SET record = excluded.record, status = excluded.status, '
+                'expires_at = excluded.expires_at WHERE jobs.status = ?',
+                (record['jobId'], json.dumps(record, ensure_ascii=False), record['status'], record['expiresAt'], STATUS_FAILED)
+            )
+            return cursor.rowcount > 0
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT record FROM jobs WHERE job_id = ? AND expires_at >= ?', (job_id, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, job_id: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            row = self._conn.execute('SELECT record FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row is None:
+                return
+            record = json.loads(row[0])
+            record.update(fields)
+            record['updatedAt'] = time.time()
+            self._conn.execute(
+                'UPDATE jobs SET record = ?, status = ? WHERE job_id = ?',
+                (json.dumps(record, ensure_ascii=False), record['status'], job_id)
+            )
+
+
+class DynamoDBJobStore(JobStore):
+    """
+    Table with partition key `jobId` (S). Enable DynamoDB TTL on the `ttl` attribute
+    so expired jobs are removed automatically.
+    """
+    shared = True
+
+    def __init__(self, table_name: str, client=None):
+        from aws_clients import get_client
+        self.table_name = table_name
+        self.client = client or get_client('dynamodb')
+
+    def create(self, record: Dict[str, Any]) -> bool:
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item=self._to_item(record),
+                ConditionExpression='attribute_not_exists(jobId) OR #s = :failed OR #t < :now',
+                ExpressionAttributeNames={'#s': 'status', '#t': 'ttl'},
+                ExpressionAttributeValues={':failed': {'S': STATUS_FAILED}, ':now': {'N': str(int(time.time()))}}
+            )
+            return True
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        item = self.client.get_item(TableName=self.table_name, Key={'jobId': {'S': job_id}}, ConsistentRead=True).get('Item')
+        if not item:
+            return None
+        record = json.loads(item['record']['S'])
+        return record if record['expiresAt'] >= time.time() else None
+
+    def update(self, job_id: str, fields: Dict[str, Any]) -> None:
+        record = self.get(job_id)
+        if record is None:
+            return
+        record.update(fields)
+        record['updatedAt'] = time.time()
+        self.client.put_item(TableName=self.table_name, Item=self._to_item(record))
+
+    @staticmethod
+    def _to_item(record: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'jobId': {'S': record['jobId']},
+            'status': {'S': record['status']},
+            'ttl': {'N': str(int(record['expiresAt']))},
+            'record': {'S': json.dumps(record, ensure_ascii=False)}
+        }
+
+
+def create_job_store() -> JobStore:
+    """ANALYSIS_JOB_STORE = memory | sqlite | dynamodb (ANALYSIS_JOB_DB / ANALYSIS_JOB_TABLE)"""
+    kind = os.environ.get('ANALYSIS_JOB_STORE', 'sqlite').lower()
+    if kind == 'dynamodb':
+        return DynamoDBJobStore(os.environ['ANALYSIS_JOB_TABLE'])
+    if kind == 'sqlite':
+        return SQLiteJobStore(os.environ.get('ANALYSIS_JOB_DB', '/tmp/flowlens_analysis_jobs.sqlite3'))
+    return InMemoryJobStore()
+
+
+class JobRunner:
+    """Bounded worker pool; jobs beyond max_workers wait in the executor queue"""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> None:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='analysis-job')
+        self._executor.submit(fn, *args)
@@ -12,6 +12,8 @@ export interface SubmitJobPayload {
   };
   question?: string;
   selectedDocumentIds: string[];
+  previousAnalysisId?: string; // metadata.analysis_id của lần phân tích trước
+  diagramFormat?: "json" | "compact";
 }
 
 export const submitAnalysisJob = async (
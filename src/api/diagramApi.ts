@@ -7,7 +7,16 @@ const DIAGRAM_API = import.meta.env.VITE_API_DIAGRAM_URL;
 export interface GenerateDiagramPayload {
   text?: string;
   image?: string; // base64
+  // Ảnh đã upload lên bucket upload của server: "s3://bucket/key" hoặc key
+  imageRef?: string | { bucket?: string; key: string };
   language?: string;
+  // Bố cục phía server: "auto" (mặc định) dàn lại khi thiếu position, "layered" luôn dàn lại, "keep" giữ nguyên
+  layout?: "auto" | "layered" | "keep";
+  layoutDirection?: "TB" | "LR";
+  // false = bỏ qua cache sơ đồ đã sinh, luôn gọi model
+  useCache?: boolean;
+  // false = không dùng parser quy tắc cho chuỗi mũi tên đơn giản, luôn gọi model
+  ruleParser?: boolean;
 }
 
 export const generateDiagram = async (
@@ -0,0 +1,103 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from structured_log import get_logger
+
+# --- FACTORY CLIENT AWS DÙNG CHUNG, KHỞI TẠO LƯỜI ---
+# - Import boto3 (~0.3s) và tạo client chỉ xảy ra ở lần dùng đầu tiên, không phải lúc import module
+#   => cold start của các nhánh không gọi AWS (job status, invalidate, cache hit...) nhẹ hơn.
+#   Với provisioned concurrency / SnapStart (init đã được trả trước), đặt AWS_CLIENTS_EAGER=true.
+# - Mỗi (service, region) chỉ có MỘT client trong process, cấu hình rõ ràng:
+#   pool kết nối (đủ cho multi-query / batch chạy song song), TCP keep-alive, timeout, retry.
+# - Event warm-up ({"warmup": true}, hoặc ping EventBridge "aws.events") khởi tạo sẵn client
+#   và cache rồi trả về ngay, không gọi model.
+
+logger = get_logger('aws')
+
+AWS_REGION = os.environ.get('AWS_BEDROCK_REGION', 'us-east-1')
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 32))
+AWS_CONNECT_TIMEOUT = float(os.environ.get('AWS_CONNECT_TIMEOUT', 3))
+AWS_READ_TIMEOUT = float(os.environ.get('AWS_READ_TIMEOUT', 20))
+# Sinh văn bản dài (4000 token) cần read timeout lớn hơn hẳn các API còn lại
+AWS_MODEL_READ_TIMEOUT = float(os.environ.get('AWS_MODEL_READ_TIMEOUT', 120))
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', 3))
+AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'adaptive')
+AWS_CLIENTS_EAGER = os.environ.get('AWS_CLIENTS_EAGER', 'false').lower() == 'true'
+
+_MODEL_SERVICES = ('bedrock-runtime',)
+
+_clients: Dict[tuple, Any] = {}
+_lock = threading.Lock()
+
+
+def client_config(service: str) -> Any:
+    """botocore Config with pooling, keep-alive, timeouts and retries for `service`"""
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        read_timeout=AWS_MODEL_READ_TIMEOUT if service in _MODEL_SERVICES else AWS_READ_TIMEOUT,
+        retries={'max_attempts': AWS_MAX_ATTEMPTS, 'mode': AWS_RETRY_MODE}
+    )
+
+
+def get_client(service: str, region: Optional[str] = None) -> Any:
+    """Process-wide client for (service, region), created on first use"""
+    key = (service, region or AWS_REGION)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                import boto3
+                started = time.perf_counter()
+                client = _clients[key] = boto3.client(service, region_name=key[1], config=client_config(service))
+                logger.info('aws client created', service=service, region=key[1],
+                            duration_ms=round((time.perf_counter() - started) * 1000, 1))
+    return client
+
+
+class LazyClient:
+    """Module-level stand-in for a boto3 client; resolves through get_client on first attribute access"""
+
+    def __init__(self, service: str, region: Optional[str] = None):
+        self.service = service
+        self.region = region
+        if AWS_CLIENTS_EAGER:
+            get_client(service, region)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_client(self.service, self.region), name)
+
+
+def is_warmup_event(event: Any) -> bool:
+    """`{"warmup": true}` (or `"action": "warmup"`) and scheduled EventBridge pings"""
+    if not isinstance(event, dict):
+        return False
+    return (event.get('warmup') is True or event.get('action') == 'warmup'
+            or (event.get('source') == 'aws.events' and event.get('detail-type') == 'Scheduled Event'))
+
+
+def warm_up(services: Iterable[str], warmers: Optional[Dict[str, Callable[[], Any]]] = None) -> Dict:
+    """Create the clients in `services` and run each named warmer; never calls a model"""
+    started = time.perf_counter()
+    report: Dict[str, Any] = {}
+    for service in services:
+        step = time.perf_counter()
+        try:
+            get_client(service)
+            report[service] = round((time.perf_counter() - step) * 1000, 1)
+        except Exception as e:
+            report[service] = f'error: {e}'
+    for name, warmer in (warmers or {}).items():
+        step = time.perf_counter()
+        try:
+            warmer()
+            report[name] = round((time.perf_counter() - step) * 1000, 1)
+        except Exception as e:
+            report[name] = f'error: {e}'
+    logger.info('warm-up completed', steps=report, duration_ms=round((time.perf_counter() - started) * 1000, 1))
+    return {'warm': True, 'steps_ms': report}
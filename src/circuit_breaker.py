@@ -0,0 +1,192 @@
+import collections
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from request_metrics import increment
+from structured_log import get_logger
+
+# --- CIRCUIT BREAKER CHO DỊCH VỤ PHỤ THUỘC (KNOWLEDGE BASE) ---
+# closed    : gọi bình thường, ghi kết quả (lỗi / chậm) vào cửa sổ trượt theo thời gian.
+# open      : tỉ lệ lỗi hoặc tỉ lệ gọi chậm trong cửa sổ vượt ngưỡng (khi đủ số lần gọi tối thiểu)
+#             => mọi lời gọi bị từ chối ngay bằng CircuitOpenError trong `open_seconds`,
+#             caller chuyển sang nguồn dự phòng thay vì chờ từng request lỗi/timeout.
+# half_open : hết thời gian open, cho tối đa `half_open_max_calls` lời gọi thăm dò; thành công (và
+#             không chậm) => closed, lỗi / chậm => open lại.
+# Trạng thái nằm ở cấp module (một breaker cho mỗi tên trong process) nên được giữ giữa các
+# invocation warm và dùng chung cho mọi handler / thread trong cùng container.
+# Cấu hình qua <PREFIX>_BREAKER_* (xem create_circuit_breaker).
+
+logger = get_logger('breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f'circuit {name} is open (retry in {retry_in:.1f}s)')
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_rate_threshold: float = 0.5, slow_call_rate_threshold: float = 0.5,
+                 slow_call_ms: float = 3000, min_calls: int = 5, window_seconds: float = 60,
+                 open_seconds: float = 30, half_open_max_calls: int = 1, enabled: bool = True,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.slow_call_ms = slow_call_ms
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self.enabled = enabled
+        # Nguồn thời gian (giây, đơn điệu) cho cửa sổ, thời gian open và thời lượng lời gọi; test thay bằng đồng hồ giả
+        self.clock = clock
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.last_trip_reason: Optional[str] = None
+        # (thời điểm, lỗi, chậm) của các lần gọi trong cửa sổ
+        self._outcomes: Deque[Tuple[float, bool, bool]] = collections.deque()
+        self._half_open_calls = 0
+        self.short_circuited = 0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float) -> None:
+        while self._outcomes and self._outcomes[0][0] < now - self.window_seconds:
+            self._outcomes.popleft()
+
+    def _rates(self) -> Tuple[int, float, float]:
+        calls = len(self._outcomes)
+        if not calls:
+            return 0, 0.0, 0.0
+        failures = sum(1 for _, failed, _ in self._outcomes if failed)
+        slow = sum(1 for _, _, is_slow in self._outcomes if is_slow)
+        return calls, failures / calls, slow / calls
+
+    def _transition(self, state: str, now: float, reason: Optional[str] = None) -> None:
+        previous, self.state = self.state, state
+        if state == OPEN:
+            self.opened_at = now
+            self.trips += 1
+            self.last_trip_reason = reason
+            increment(f'{self.name}_breaker_opened')
+        elif state == CLOSED:
+            self._outcomes.clear()
+        self._half_open_calls = 0
+        logger.warning('circuit state changed', breaker=self.name, from_state=previous, to_state=state, reason=reason)
+
+    def allow(self) -> bool:
+        """Whether a call may go through now (half-open admits a limited number of probes)"""
+        if not self.enabled:
+            return True
+        with self._lock:
+            now = self.clock()
+            if self.state == OPEN and now - self.opened_at >= self.open_seconds:
+                self._transition(HALF_OPEN, now)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self._half_open_calls < self.half_open_max_calls:
+                self._half_open_calls += 1
+                return True
+            self.short_circuited += 1
+        increment(f'{self.name}_breaker_short_circuit')
+        return False
+
+    def record(self, duration_ms: float, failed: bool) -> None:
+        if not self.enabled:
+            return
+        slow = duration_ms >= self.slow_call_ms
+        with self._lock:
+            now = self.clock()
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._transition(OPEN, now, 'probe failed' if failed else 'probe slow')
+                else:
+                    self._transition(CLOSED, now)
+                return
+            if self.state == OPEN:
+                # Lời gọi bắt đầu trước khi mạch mở, kết thúc muộn: không ảnh hưởng trạng thái
+                return
+            self._outcomes.append((now, failed, slow))
+            self._prune(now)
+            calls, failure_rate, slow_rate = self._rates()
+            if calls < self.min_calls:
+                return
+            if failure_rate >= self.failure_rate_threshold:
+                self._transition(OPEN, now, f'failure rate {failure_rate:.2f}')
+            elif slow_rate >= self.slow_call_rate_threshold:
+                self._transition(OPEN, now, f'slow call rate {slow_rate:.2f}')
+
+    def call(self, fn: Callable[[], Any]) -> Any:
+        """fn() through the breaker; raises CircuitOpenError without calling fn while open"""
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_in())
+        started = self.clock()
+        try:
+            result = fn()
+        except Exception:
+            self.record((self.clock() - started) * 1000, True)
+            raise
+        self.record((self.clock() - started) * 1000, False)
+        return result
+
+    def retry_in(self) -> float:
+        """Seconds until an open breaker lets a probe through (0 when not open)"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.open_seconds - self.clock())
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Response `metadata` block"""
+        with self._lock:
+            self._prune(self.clock())
+            calls, failure_rate, slow_rate = self._rates()
+            return {
+                'state': self.state if self.enabled else 'disabled',
+                'calls': calls,
+                'failure_rate': round(failure_rate, 3),
+                'slow_call_rate': round(slow_rate, 3),
+                'retry_in_ms': round(self.retry_in() * 1000),
+                'trips': self.trips,
+                'short_circuited': self.short_circuited,
+                **({'last_trip_reason': self.last_trip_reason} if self.last_trip_reason else {})
+            }
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def create_circuit_breaker(prefix: str, name: Optional[str] = None) -> CircuitBreaker:
+    """
+    Process-wide breaker configured from environment variables (created once, shared afterwards):
+    <PREFIX>_BREAKER_ENABLED, _FAILURE_RATE, _SLOW_CALL_RATE, _SLOW_CALL_MS, _MIN_CALLS,
+    _WINDOW_SECONDS, _OPEN_SECONDS, _HALF_OPEN_CALLS.
+    """
+    name = name or prefix.lower()
+    breaker = _breakers.get(name)
+    if breaker is not None:
+        return breaker
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            env = lambda key, default: os.environ.get(f'{prefix}_BREAKER_{key}', default)
+            breaker = _breakers[name] = CircuitBreaker(
+                name,
+                failure_rate_threshold=float(env('FAILURE_RATE', 0.5)),
+                slow_call_rate_threshold=float(env('SLOW_CALL_RATE', 0.5)),
+                slow_call_ms=float(env('SLOW_CALL_MS', 3000)),
+                min_calls=int(env('MIN_CALLS', 5)),
+                window_seconds=float(env('WINDOW_SECONDS', 60)),
+                open_seconds=float(env('OPEN_SECONDS', 30)),
+                half_open_max_calls=int(env('HALF_OPEN_CALLS', 1)),
+                enabled=str(env('ENABLED', 'true')).lower() == 'true'
+            )
+    return breaker
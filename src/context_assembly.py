@@ -0,0 +1,227 @@
+import hashlib
+import math
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from diagram_encoding import estimate_tokens
+
+# --- LẮP RÁP CONTEXT SAU KHI TRUY XUẤT KNOWLEDGE BASE ---
+# Lấy dư K chunk từ Knowledge Base, rồi xử lý tại chỗ (không gọi thêm dịch vụ nào):
+#   1. Lọc theo ngưỡng score vector (như cũ: > 0.2)
+#   2. Xếp hạng lại bằng BM25 trên chính tập chunk, so với nhãn sơ đồ + câu hỏi,
+#      trộn với score vector
+#   3. Bỏ chunk gần trùng (shingle từ + MinHash, ước lượng Jaccard)
+#   4. Xếp các chunk tốt nhất vào ngân sách token; citationId đánh số liên tục 1..n
+#      theo đúng thứ tự xuất hiện trong context
+
+_WORD_RE = re.compile(r'\w+')
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+NO_CONTEXT_MESSAGE = "Không tìm thấy thông tin liên quan trong các tài liệu đã chọn."
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_RE.findall((text or '').lower())
+
+
+def _env_number(name: str, default: float, cast=float):
+    try:
+        return cast(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def bm25_scores(query_terms: List[str], documents: List[List[str]], k1: float = 1.2, b: float = 0.75) -> List[float]:
+    """BM25 of each tokenized document against the query, IDF computed over `documents` itself"""
+    n = len(documents)
+    if n == 0 or not query_terms:
+        return [0.0] * n
+    avg_len = sum(len(doc) for doc in documents) / n or 1.0
+    terms = set(query_terms)
+    doc_freq = dict.fromkeys(terms, 0)
+    term_counts = []
+    for doc in documents:
+        counts: Dict[str, int] = {}
+        for token in doc:
+            if token in terms:
+                counts[token] = counts.get(token, 0) + 1
+        for token in counts:
+            doc_freq[token] += 1
+        term_counts.append(counts)
+
+    idf = {t: math.log(1 + (n - df + 0.5) / (df + 0.5)) for t, df in doc_freq.items()}
+    scores = []
+    for doc, counts in zip(documents, term_counts):
+        norm = k1 * (1 - b + b * len(doc) / avg_len)
+        scores.append(sum(idf[t] * c * (k1 + 1) / (c + norm) for t, c in counts.items()))
+    return scores
+
+
+class MinHasher:
+    """MinHash signatures over word k-shingles; signature agreement estimates Jaccard similarity"""
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5, seed: int = 7):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        # Hoán vị ngẫu nhiên (a*x + b) mod p, cố định theo seed để kết quả ổn định giữa các lần chạy
+        params = hashlib.blake2b(str(seed).encode(), digest_size=64).digest()
+        self._perms: List[Tuple[int, int]] = []
+        counter = 0
+        while len(self._perms) < num_perm:
+            block = hashlib.blake2b(params + counter.to_bytes(4, 'big'), digest_size=64).digest()
+            for offset in range(0, 64, 16):
+                a = int.from_bytes(block[offset:offset + 8], 'big') % (_MERSENNE_PRIME - 1) + 1
+                b = int.from_bytes(block[offset + 8:offset + 16], 'big') % _MERSENNE_PRIME
+                self._perms.append((a, b))
+            counter += 1
+        del self._perms[num_perm:]
+
+    def shingles(self, tokens: List[str]) -> set:
+        k = self.shingle_size
+        if len(tokens) <= k:
+            return {' '.join(tokens)} if tokens else set()
+        return {' '.join(tokens[i:i + k]) for i in range(len(tokens) - k + 1)}
+
+    def signature(self, tokens: List[str]) -> Optional[List[int]]:
+        shingles = self.shingles(tokens)
+        if not shingles:
+            return None
+        hashes = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'big') for s in shingles]
+        p = _MERSENNE_PRIME
+        return [min((a * h + b) % p for h in hashes) & _MAX_HASH for a, b in self._perms]
+
+    @staticmethod
+    def similarity(sig_a: Optional[List[int]], sig_b: Optional[List[int]]) -> float:
+        if sig_a is None or sig_b is None:
+            return 0.0
+        return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+class ContextAssembler:
+    """
+    Turns raw `retrievalResults` into (context, sources) under a token budget.
+    Configured via CONTEXT_* environment variables (see create_context_assembler).
+    """
+
+    def __init__(self, fetch_k: int = 12, min_score: float = 0.2, max_chunks: int = 6,
+                 token_budget: int = 2000, dedupe_threshold: float = 0.8, lexical_weight: float = 0.4,
+                 hasher: Optional[MinHasher] = None):
+        self.fetch_k = fetch_k
+        self.min_score = min_score
+        self.max_chunks = max_chunks
+        self.token_budget = token_budget
+        self.dedupe_threshold = dedupe_threshold
+        self.lexical_weight = lexical_weight
+        self.hasher = hasher or MinHasher()
+
+    @property
+    def signature(self) -> Dict[str, Any]:
+        """Settings that change the assembled output (part of the retrieval cache key)"""
+        return {
+            'fetch_k': self.fetch_k, 'min_score': self.min_score, 'max_chunks': self.max_chunks,
+            'token_budget': self.token_budget, 'dedupe_threshold': self.dedupe_threshold,
+            'lexical_weight': self.lexical_weight
+        }
+
+    def assemble(self, results: List[Dict], rerank_text: str) -> Tuple[str, List[Dict], Dict[str, Any]]:
+        """Return (context, sources, stats); `rerank_text` is the question plus the diagram labels"""
+        candidates = []
+        for rank, result in enumerate(results):
+            score = result.get('score', 0)
+            text = (result.get('content') or {}).get('text') or ''
+            if score > self.min_score and text.strip():
+                # Kết quả đã trộn nhiều query (multi_query.reciprocal_rank_fusion) xếp theo fusedScore
+                candidates.append({'rank': rank, 'score': score, 'rank_score': result.get('fusedScore', score),
+                                   'text': text, 'tokens': tokenize(text), 'result': result})
+
+        # Xếp hạng lại: trộn score vector (hoặc RRF) với BM25, cả hai chuẩn hóa về [0, 1] theo giá trị lớn nhất
+        lexical = bm25_scores(tokenize(rerank_text), [c['tokens'] for c in candidates])
+        max_lexical = max(lexical, default=0.0) or 1.0
+        max_vector = max((c['rank_score'] for c in candidates), default=0.0) or 1.0
+        for candidate, lex in zip(candidates, lexical):
+            candidate['relevance'] = ((1 - self.lexical_weight) * candidate['rank_score'] / max_vector
+                                      + self.lexical_weight * lex / max_lexical)
+        candidates.sort(key=lambda c: (-c['relevance'], c['rank']))
+
+        selected: List[Dict] = []
+        signatures: List[Optional[List[int]]] = []
+        duplicates = over_budget = 0
+        used_tokens = 0
+        for candidate in candidates:
+            if len(selected) >= self.max_chunks:
+                break
+            signature = self.hasher.signature(candidate['tokens'])
+            if any(MinHasher.similarity(signature, other) >= self.dedupe_threshold for other in signatures):
+                duplicates += 1
+                continue
+            text = candidate['text']
+            cost = estimate_tokens(text)
+            if used_tokens + cost > self.token_budget:
+                if selected:
+                    over_budget += 1
+                    continue
+                # Chunk tốt nhất đã vượt ngân sách: cắt bớt thay vì trả về context rỗng
+                text = _truncate_to_budget(text, self.token_budget)
+                cost = estimate_tokens(text)
+            used_tokens += cost
+            signatures.append(signature)
+            selected.append({**candidate, 'text': text})
+
+        context_parts = []
+        sources = []
+        for citation_id, candidate in enumerate(selected, start=1):
+            context_parts.append(f"Nguồn [{citation_id}]:\n{candidate['text']}")
+            sources.append(build_source_info(citation_id, candidate['result'], candidate['relevance']))
+
+        context = "\n\n".join(context_parts) if context_parts else NO_CONTEXT_MESSAGE
+        stats = {
+            'fetched': len(results),
+            'above_threshold': len(candidates),
+            'duplicates_dropped': duplicates,
+            'over_budget_dropped': over_budget,
+            'selected': len(selected),
+            'context_tokens': used_tokens,
+            'token_budget': self.token_budget
+        }
+        return context, sources, stats
+
+
+def _truncate_to_budget(text: str, budget: int) -> str:
+    # estimate_tokens ~ số từ * 1.2 => giữ khoảng budget / 1.2 từ đầu tiên
+    words = text.split()
+    keep = max(1, int(budget / 1.2))
+    return ' '.join(words[:keep]) + (' ...' if len(words) > keep else '')
+
+
+def build_source_info(citation_id: int, result: Dict, relevance: float) -> Dict:
+    """Source entry returned to the frontend; `citationId` matches "Nguồn [n]" in the context"""
+    full_retrieved_text = result['content']['text']
+    metadata = result.get('metadata', {})
+    s3_location = result.get('location', {}).get('s3Location', {})
+    return {
+        'citationId': citation_id,  # ID để trích dẫn trong văn bản, ví dụ: (Nguồn [1])
+        'documentId': metadata.get('document_id', 'N/A'), # Lấy ID thật từ metadata
+        'title': metadata.get('document_name', s3_location.get('uri', '').split('/')[-1]), # Ưu tiên lấy title từ metadata
+        's3_uri': s3_location.get('uri', ''),
+        'score': result.get('score', 0),
+        'relevance': round(relevance, 4),
+        'content_preview': full_retrieved_text[:150] + "..." if len(full_retrieved_text) > 150 else full_retrieved_text,
+        'full_retrieved_text': full_retrieved_text
+    }
+
+
+def create_context_assembler() -> ContextAssembler:
+    """
+    CONTEXT_FETCH_K (số chunk lấy từ KB), CONTEXT_MIN_SCORE, CONTEXT_MAX_CHUNKS,
+    CONTEXT_TOKEN_BUDGET, CONTEXT_DEDUPE_THRESHOLD, CONTEXT_LEXICAL_WEIGHT
+    """
+    return ContextAssembler(
+        fetch_k=_env_number('CONTEXT_FETCH_K', 12, int),
+        min_score=_env_number('CONTEXT_MIN_SCORE', 0.2),
+        max_chunks=_env_number('CONTEXT_MAX_CHUNKS', 6, int),
+        token_budget=_env_number('CONTEXT_TOKEN_BUDGET', 2000, int),
+        dedupe_threshold=_env_number('CONTEXT_DEDUPE_THRESHOLD', 0.8),
+        lexical_weight=_env_number('CONTEXT_LEXICAL_WEIGHT', 0.4)
+    )
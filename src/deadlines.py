@@ -0,0 +1,268 @@
+import collections
+import contextlib
+import contextvars
+import functools
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+from request_metrics import increment, set_value
+from structured_log import copy_log_context, get_logger
+
+# --- DEADLINE THEO REQUEST, NGÂN SÁCH THỜI GIAN THEO CHẶNG, GỌI MODEL "HEDGED" ---
+# Mỗi invocation có một Deadline (gắn qua contextvars như request_metrics) lấy từ
+# context.get_remaining_time_in_millis() của Lambda (hoặc REQUEST_TIMEOUT_MS khi chạy ngoài Lambda),
+# trừ đi DEADLINE_RESERVE_MS để còn thời gian dựng response. Các chặng chậm (truy xuất KB, gọi model)
+# chạy qua call_with_deadline / hedged_call: quá ngân sách => DeadlineExceeded, handler bỏ qua chặng
+# đó hoặc trả kết quả từng phần thay vì bị Lambda kill giữa chừng và không trả về gì.
+#   - Truy xuất được tối đa DEADLINE_RETRIEVAL_SHARE thời gian còn lại; quá hạn => phân tích không có context.
+#   - Gọi model được phần còn lại; MODEL_HEDGE_ENABLED=true => khi lời gọi đầu chậm hơn phân vị
+#     MODEL_HEDGE_PERCENTILE của các lần gọi gần đây thì gửi thêm MỘT request giống hệt, lấy kết quả về trước.
+# Lời gọi boto3 không hủy được: thread bị bỏ lại chạy nốt trong nền (kết quả truy xuất vẫn vào cache).
+
+logger = get_logger('deadline')
+
+REQUEST_DEADLINE_ENABLED = os.environ.get('REQUEST_DEADLINE_ENABLED', 'true').lower() == 'true'
+# Ngoài Lambda (không có context): giới hạn tích hợp của API Gateway là 29s
+REQUEST_TIMEOUT_MS = float(os.environ.get('REQUEST_TIMEOUT_MS', 29000))
+DEADLINE_RESERVE_MS = float(os.environ.get('DEADLINE_RESERVE_MS', 1000))
+DEADLINE_RETRIEVAL_SHARE = float(os.environ.get('DEADLINE_RETRIEVAL_SHARE', 0.3))
+DEADLINE_MAX_WORKERS = int(os.environ.get('DEADLINE_MAX_WORKERS', 16))
+
+MODEL_HEDGE_ENABLED = os.environ.get('MODEL_HEDGE_ENABLED', 'false').lower() == 'true'
+MODEL_HEDGE_PERCENTILE = float(os.environ.get('MODEL_HEDGE_PERCENTILE', 95))
+MODEL_HEDGE_MIN_SAMPLES = int(os.environ.get('MODEL_HEDGE_MIN_SAMPLES', 20))
+MODEL_HEDGE_MIN_DELAY_MS = float(os.environ.get('MODEL_HEDGE_MIN_DELAY_MS', 2000))
+MODEL_HEDGE_WINDOW = int(os.environ.get('MODEL_HEDGE_WINDOW', 200))
+
+_current: contextvars.ContextVar[Optional['Deadline']] = contextvars.ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    def __init__(self, stage: str, budget: Optional[float] = None):
+        super().__init__(f'{stage} exceeded its time budget' + (f' ({budget * 1000:.0f} ms)' if budget is not None else ''))
+        self.stage = stage
+
+
+class Deadline:
+    __slots__ = ('budget_ms', 'expires_at', 'skipped', 'partial')
+
+    def __init__(self, budget_ms: float, reserve_ms: float = DEADLINE_RESERVE_MS):
+        self.budget_ms = budget_ms
+        self.expires_at = time.monotonic() + max(0.0, budget_ms - reserve_ms) / 1000
+        # Chặng bị bỏ qua / cắt ngắn vì hết giờ (trả trong metadata.deadline)
+        self.skipped: List[str] = []
+        self.partial = False
+
+    @classmethod
+    def from_context(cls, context: Any) -> 'Deadline':
+        """Lambda's remaining time when available, otherwise REQUEST_TIMEOUT_MS"""
+        remaining = getattr(context, 'get_remaining_time_in_millis', None)
+        try:
+            return cls(float(remaining()) if callable(remaining) else REQUEST_TIMEOUT_MS)
+        except Exception:
+            return cls(REQUEST_TIMEOUT_MS)
+
+    def remaining(self) -> float:
+        """Seconds left for work (response reserve already subtracted), never negative"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def stage_budget(self, share: float = 1.0) -> float:
+        return self.remaining() * share
+
+    def skip(self, stage: str, partial: bool = True) -> None:
+        """Record that `stage` was skipped or cut short; the result is then incomplete"""
+        self.skipped.append(stage)
+        self.partial = self.partial or partial
+        increment(f'deadline_skipped_{stage}')
+        logger.warning('stage skipped by deadline', stage=stage, budget_ms=self.budget_ms)
+
+    def summary(self) -> Dict[str, Any]:
+        """Response `metadata.deadline` block"""
+        return {
+            'budget_ms': round(self.budget_ms),
+            'remaining_ms': round(self.remaining() * 1000),
+            'skipped': list(self.skipped),
+            'partial': self.partial
+        }
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current.get()
+
+
+def remaining_time(share: float = 1.0) -> Optional[float]:
+    """Seconds the current stage may take (`share` of what is left), or None without a deadline"""
+    deadline = _current.get()
+    return deadline.stage_budget(share) if deadline is not None else None
+
+
+def record_skip(stage: str, partial: bool = True) -> None:
+    deadline = _current.get()
+    if deadline is not None:
+        deadline.skip(stage, partial)
+    else:
+        increment(f'deadline_skipped_{stage}')
+
+
+def deadline_summary() -> Optional[Dict[str, Any]]:
+    deadline = _current.get()
+    return deadline.summary() if deadline is not None else None
+
+
+@contextlib.contextmanager
+def deadline_scope(deadline: Optional[Deadline]) -> Iterator[Optional[Deadline]]:
+    """Run a block under `deadline` (None = unbounded, e.g. background jobs)"""
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def deadline_handler(handler: Callable) -> Callable:
+    """Decorator: one Deadline per invocation, from the Lambda context"""
+    @functools.wraps(handler)
+    def wrapper(event: Any, context: Any = None) -> Any:
+        if not REQUEST_DEADLINE_ENABLED:
+            return handler(event, context)
+        deadline = Deadline.from_context(context)
+        set_value('deadline_budget_ms', round(deadline.budget_ms))
+        with deadline_scope(deadline):
+            return handler(event, context)
+    return wrapper
+
+
+# --- CHẠY CHẶNG CHẬM TRONG NGÂN SÁCH ---
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=DEADLINE_MAX_WORKERS, thread_name_prefix='deadline')
+    return _executor
+
+
+def _submit(fn: Callable[[], Any]) -> Future:
+    # Bản sao context của request: log request_id, metric và deadline vẫn áp dụng bên trong
+    return _pool().submit(copy_log_context().run, fn)
+
+
+def call_with_deadline(fn: Callable[[], Any], stage: str, timeout: Optional[float] = None) -> Any:
+    """
+    fn() bounded by `timeout` seconds (default: what is left of the request deadline).
+    Runs inline when there is no deadline; raises DeadlineExceeded when time runs out.
+    """
+    if timeout is None:
+        timeout = remaining_time()
+        if timeout is None:
+            return fn()
+    if timeout <= 0:
+        raise DeadlineExceeded(stage, 0)
+    future = _submit(fn)
+    done, _ = wait([future], timeout=timeout)
+    if not done:
+        raise DeadlineExceeded(stage, timeout)
+    return future.result()
+
+
+class LatencyTracker:
+    """Sliding window of call latencies (ms) for percentile-based hedging"""
+    __slots__ = ('_samples', '_lock')
+
+    def __init__(self, window: int = MODEL_HEDGE_WINDOW):
+        self._samples: Deque[float] = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, milliseconds: float) -> None:
+        with self._lock:
+            self._samples.append(milliseconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        with self._lock:
+            ordered = sorted(self._samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+_latencies: Dict[str, LatencyTracker] = {}
+_latencies_lock = threading.Lock()
+
+
+def latency_tracker(key: str) -> LatencyTracker:
+    tracker = _latencies.get(key)
+    if tracker is None:
+        with _latencies_lock:
+            tracker = _latencies.setdefault(key, LatencyTracker())
+    return tracker
+
+
+def hedge_delay(key: str) -> Optional[float]:
+    """Seconds to wait before hedging calls of `key`, or None when hedging is off / not enough samples"""
+    if not MODEL_HEDGE_ENABLED:
+        return None
+    tracker = latency_tracker(key)
+    if len(tracker) < MODEL_HEDGE_MIN_SAMPLES:
+        return None
+    return max(MODEL_HEDGE_MIN_DELAY_MS, tracker.percentile(MODEL_HEDGE_PERCENTILE)) / 1000
+
+
+def hedged_call(fn: Callable[[], Any], key: str, stage: str = 'model_invoke') -> Any:
+    """
+    fn() within the request deadline; when the first call is slower than the recent
+    MODEL_HEDGE_PERCENTILE latency of `key`, one identical backup call is started and the
+    first successful result wins. fn must be idempotent (a model invocation is).
+    """
+    tracker = latency_tracker(key)
+
+    def timed() -> Any:
+        started = time.perf_counter()
+        result = fn()
+        tracker.record((time.perf_counter() - started) * 1000)
+        return result
+
+    timeout = remaining_time()
+    delay = hedge_delay(key)
+    if delay is None:
+        return call_with_deadline(timed, stage, timeout)
+    if timeout is not None and timeout <= 0:
+        raise DeadlineExceeded(stage, 0)
+
+    end = None if timeout is None else time.monotonic() + timeout
+    primary = _submit(timed)
+    pending = {primary}
+    if timeout is None or delay < timeout:
+        done, _ = wait(pending, timeout=delay)
+        if not done:
+            increment('model_hedged')
+            logger.info('hedging slow call', key=key, after_ms=round(delay * 1000))
+            pending.add(_submit(timed))
+
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, timeout=None if end is None else max(0.0, end - time.monotonic()),
+                             return_when=FIRST_COMPLETED)
+        if not done:
+            raise DeadlineExceeded(stage, timeout)
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    increment('model_hedge_won')
+                return future.result()
+            error = future.exception()
+    raise error
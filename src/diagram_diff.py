@@ -0,0 +1,150 @@
+from typing import Any, Dict, List, Set, Tuple, Union
+
+from diagram_graph import DiagramGraph, as_graph
+
+# --- SO SÁNH HAI PHIÊN BẢN SƠ ĐỒ (PHÂN TÍCH LẠI TĂNG DẦN) ---
+# Node khớp theo id; edge khớp theo id (hoặc cặp source/target nếu thiếu id).
+# Mỗi loại thay đổi kích hoạt một tập section cần phân tích lại (SECTION_TRIGGERS);
+# section không bị ảnh hưởng được giữ nguyên từ lần phân tích trước.
+
+NODES_ADDED = 'nodes_added'
+NODES_REMOVED = 'nodes_removed'
+NODES_CHANGED = 'nodes_changed'
+EDGES_ADDED = 'edges_added'
+EDGES_REMOVED = 'edges_removed'
+EDGES_CHANGED = 'edges_changed'
+
+SECTION_TRIGGERS: Dict[str, Set[str]] = {
+    'overview': {NODES_ADDED, NODES_REMOVED, EDGES_ADDED, EDGES_REMOVED},
+    'components': {NODES_ADDED, NODES_REMOVED, NODES_CHANGED, EDGES_ADDED, EDGES_REMOVED},
+    'execution': {NODES_ADDED, NODES_REMOVED, NODES_CHANGED, EDGES_CHANGED},
+    'evaluation': {NODES_ADDED, NODES_REMOVED, NODES_CHANGED, EDGES_ADDED, EDGES_REMOVED, EDGES_CHANGED},
+    'improvement': {NODES_ADDED, NODES_REMOVED, EDGES_ADDED, EDGES_REMOVED, EDGES_CHANGED},
+    'summary': {NODES_ADDED, NODES_REMOVED, EDGES_ADDED, EDGES_REMOVED},
+}
+
+
+def _edge_key(raw_edge: Dict) -> Any:
+    edge_id = raw_edge.get('id')
+    return edge_id if edge_id is not None else ('__pair__', raw_edge.get('source'), raw_edge.get('target'))
+
+
+def _edge_semantics(raw_edge: Dict) -> Tuple[Any, Any, Any]:
+    data = raw_edge.get('data') if isinstance(raw_edge.get('data'), dict) else {}
+    return raw_edge.get('label'), data.get('logic'), data.get('rules')
+
+
+class DiagramDiff:
+    """Added / removed / changed nodes and edges between two diagram versions"""
+
+    def __init__(self):
+        self.nodes_added: List[Dict] = []
+        self.nodes_removed: List[Dict] = []
+        # (node cũ, node mới) có nhãn hoặc loại thay đổi
+        self.nodes_changed: List[Tuple[Dict, Dict]] = []
+        self.edges_added: List[Dict] = []
+        self.edges_removed: List[Dict] = []
+        # (edge cũ, edge mới) có nhãn, logic hoặc luật điều kiện thay đổi
+        self.edges_changed: List[Tuple[Dict, Dict]] = []
+        self.node_total = 0
+        self.edge_total = 0
+
+    @property
+    def kinds(self) -> Set[str]:
+        return {kind for kind in (NODES_ADDED, NODES_REMOVED, NODES_CHANGED, EDGES_ADDED, EDGES_REMOVED, EDGES_CHANGED)
+                if getattr(self, kind)}
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.kinds
+
+    @property
+    def change_ratio(self) -> float:
+        """Share of nodes and edges touched, relative to the larger of the two versions"""
+        touched = sum(len(getattr(self, kind)) for kind in self.kinds)
+        return touched / max(self.node_total + self.edge_total, 1)
+
+    def affected_sections(self, sections: Tuple[str, ...]) -> List[str]:
+        kinds = self.kinds
+        return [section for section in sections if SECTION_TRIGGERS.get(section, kinds) & kinds]
+
+    def describe(self) -> List[str]:
+        """Vietnamese one-line descriptions of every change, for the revision prompt"""
+        lines = []
+        for node in self.nodes_added:
+            lines.append(f"+ Thêm bước {node['id']}: {node['label']}")
+        for node in self.nodes_removed:
+            lines.append(f"- Xóa bước {node['id']}: {node['label']}")
+        for old, new in self.nodes_changed:
+            lines.append(f"~ Sửa bước {new['id']}: {old['label']} [{old['type']}] => {new['label']} [{new['type']}]")
+        for edge in self.edges_added:
+            lines.append(f"+ Thêm luồng {edge['source']} -> {edge['target']}{_describe_rules(edge)}")
+        for edge in self.edges_removed:
+            lines.append(f"- Xóa luồng {edge['source']} -> {edge['target']}{_describe_rules(edge)}")
+        for old, new in self.edges_changed:
+            lines.append(f"~ Sửa điều kiện luồng {new['source']} -> {new['target']}:"
+                         f"{_describe_rules(old) or ' (không có)'} =>{_describe_rules(new) or ' (không có)'}")
+        return lines
+
+    def summary(self) -> Dict[str, int]:
+        return {kind: len(getattr(self, kind)) for kind in
+                (NODES_ADDED, NODES_REMOVED, NODES_CHANGED, EDGES_ADDED, EDGES_REMOVED, EDGES_CHANGED)}
+
+
+def _describe_rules(edge: Dict) -> str:
+    parts = []
+    if edge.get('label'):
+        parts.append(f"nhãn '{edge['label']}'")
+    if edge.get('logic') is not None or edge.get('rules'):
+        rules = '; '.join(
+            ' '.join(str(rule.get(k, '')) for k in ('field', 'operator', 'value')).strip() if isinstance(rule, dict) else str(rule)
+            for rule in edge.get('rules') or []
+        )
+        parts.append(f"{edge.get('logic') or ''}: {rules}".strip())
+    return f" ({', '.join(parts)})" if parts else ''
+
+
+def _node_view(graph: DiagramGraph) -> Dict[Any, Dict]:
+    return {node.id: {'id': node.id, 'label': node.label, 'type': node.type or 'default'} for node in graph.nodes}
+
+
+def _edge_view(graph: DiagramGraph) -> Dict[Any, Dict]:
+    view = {}
+    for edge in graph.edges:
+        label, logic, rules = _edge_semantics(edge.raw)
+        view[_edge_key(edge.raw)] = {
+            'id': edge.id, 'source': edge.raw.get('source'), 'target': edge.raw.get('target'),
+            'label': label, 'logic': logic, 'rules': rules
+        }
+    return view
+
+
+def diff_diagrams(old: Union[Dict, DiagramGraph], new: Union[Dict, DiagramGraph]) -> DiagramDiff:
+    """Compare two diagrams; layout and styling fields are ignored"""
+    old_graph, new_graph = as_graph(old), as_graph(new)
+    diff = DiagramDiff()
+    diff.node_total = max(old_graph.node_count, new_graph.node_count)
+    diff.edge_total = max(old_graph.edge_count, new_graph.edge_count)
+
+    old_nodes, new_nodes = _node_view(old_graph), _node_view(new_graph)
+    for node_id, node in new_nodes.items():
+        previous = old_nodes.get(node_id)
+        if previous is None:
+            diff.nodes_added.append(node)
+        elif (previous['label'], previous['type']) != (node['label'], node['type']):
+            diff.nodes_changed.append((previous, node))
+    diff.nodes_removed = [node for node_id, node in old_nodes.items() if node_id not in new_nodes]
+
+    old_edges, new_edges = _edge_view(old_graph), _edge_view(new_graph)
+    for key, edge in new_edges.items():
+        previous = old_edges.get(key)
+        if previous is None:
+            diff.edges_added.append(edge)
+        elif (previous['source'], previous['target']) != (edge['source'], edge['target']):
+            # Đổi đầu mút = xóa luồng cũ + thêm luồng mới
+            diff.edges_removed.append(previous)
+            diff.edges_added.append(edge)
+        elif (previous['label'], previous['logic'], previous['rules']) != (edge['label'], edge['logic'], edge['rules']):
+            diff.edges_changed.append((previous, edge))
+    diff.edges_removed.extend(edge for key, edge in old_edges.items() if key not in new_edges)
+    return diff
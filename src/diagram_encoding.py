@@ -0,0 +1,114 @@
+import json
+import math
+import re
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from diagram_graph import DiagramGraph, as_graph
+
+# --- MÃ HÓA SƠ ĐỒ GỌN CHO PROMPT ---
+# 'json'    : json.dumps(indent=2) như trước (giữ nguyên position, markerEnd, type của edge...)
+# 'compact' : danh sách kề dạng DSL, chỉ giữ nhãn, loại node, edge và luật điều kiện.
+#             Node được đặt mã ngắn N1, N2... ; bảng node_aliases cho phép map ngược về id gốc
+#             (ví dụ khi model trích dẫn [N3]). Mã được đặt theo thứ tự id đã sắp xếp, giống
+#             canonical_diagram (key cache), nên cùng một sơ đồ gửi với thứ tự node khác vẫn có
+#             cùng bảng mã và trích dẫn [Nk] trong kết quả cache / dùng chung vẫn đúng node.
+# Số token của bản JSON gốc (để so sánh) chỉ có trong metadata khi request bật includeTimings
+# (encoding_details), không tính cho mọi request.
+
+DIAGRAM_FORMATS = ('json', 'compact')
+_TOKEN_PIECE_RE = re.compile(r'\w+|[^\w\s]')
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate: words and punctuation marks, +20% for sub-word splits"""
+    return int(math.ceil(len(_TOKEN_PIECE_RE.findall(text)) * 1.2))
+
+
+def _one_line(value: Any) -> str:
+    return ' '.join(str(value).split())
+
+
+def _format_rule(rule: Any) -> str:
+    if not isinstance(rule, dict):
+        return _one_line(rule)
+    parts = [_one_line(rule.get('field', '')), _one_line(rule.get('operator', ''))]
+    value = rule.get('value')
+    if value not in (None, ''):
+        parts.append(_one_line(value))
+    return ' '.join(part for part in parts if part)
+
+
+def _node_aliases(graph: DiagramGraph) -> List[str]:
+    """'N<k>' for each node in diagram order, numbered in canonical (sorted id) order"""
+    # Cùng khóa sắp xếp với canonical_diagram; id trùng nhau giữ thứ tự xuất hiện
+    order = sorted(graph.nodes, key=lambda node: str(node.raw.get('id', '')))
+    aliases = [''] * graph.node_count
+    for rank, node in enumerate(order, start=1):
+        aliases[node.index] = f'N{rank}'
+    return aliases
+
+
+def encode_diagram_compact(diagram: Union[Dict, DiagramGraph]) -> Tuple[str, Dict[str, Any]]:
+    """
+    Encode a diagram as a compact adjacency-list DSL.
+    Returns (text, node_aliases) where node_aliases maps 'N<k>' -> original node id.
+    """
+    graph = as_graph(diagram)
+    aliases = _node_aliases(graph)
+    lines: List[str] = [
+        'Node: <mã> [<loại nếu khác default>] <nhãn>  (dùng mã, ví dụ [N3], khi cần chỉ rõ một bước)',
+        'Edge: <nguồn> -> <đích> (<nhãn edge>) {<logic>: <field> <operator> <value>; ...}'
+    ]
+
+    # Node liệt kê theo thứ tự mã (N1, N2...); edge giữ thứ tự gốc (thứ tự các nhánh điều kiện)
+    ordered = sorted(graph.nodes, key=lambda node: int(aliases[node.index][1:]))
+    for node in ordered:
+        node_type = f' [{node.type}]' if node.type and node.type != 'default' else ''
+        label = _one_line(node.label) if node.label is not None else ''
+        lines.append(f'{aliases[node.index]}{node_type} {label}'.rstrip())
+
+    for edge in graph.edges:
+        source = aliases[edge.source] if edge.source != -1 else _one_line(edge.raw.get('source'))
+        target = aliases[edge.target] if edge.target != -1 else _one_line(edge.raw.get('target'))
+        line = f'{source} -> {target}'
+        edge_label = edge.raw.get('label')
+        if edge_label:
+            line += f' ({_one_line(edge_label)})'
+        if edge.logic is not None or edge.rules:
+            rules = '; '.join(_format_rule(rule) for rule in (edge.rules or []))
+            line += f' {{{_one_line(edge.logic or "")}: {rules}}}'
+        lines.append(line)
+
+    return '\n'.join(lines), {aliases[node.index]: node.id for node in ordered}
+
+
+def render_diagram_for_prompt(diagram: Union[Dict, DiagramGraph], diagram_format: str = 'json') -> Tuple[str, Dict[str, Any]]:
+    """
+    Render the diagram section of a prompt in the requested format.
+    Returns (text, info) where info holds the format, the prompt's token estimate and, for the
+    compact form, the node alias table clients use to resolve [Nk] citations.
+    """
+    graph = as_graph(diagram)
+    if diagram_format != 'compact':
+        baseline = json.dumps(graph.raw, ensure_ascii=False, indent=2)
+        return baseline, {'format': 'json', 'estimated_tokens': estimate_tokens(baseline)}
+
+    # Không dựng bản JSON đầy đủ ở đây: đó chính là chi phí mà compact muốn tránh (xem encoding_details)
+    text, aliases = encode_diagram_compact(graph)
+    return text, {'format': 'compact', 'estimated_tokens': estimate_tokens(text), 'node_aliases': aliases}
+
+
+def encoding_details(diagram: Union[Dict, DiagramGraph], info: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    `info` from render_diagram_for_prompt plus, for the compact form, the indented-JSON baseline
+    estimate and the savings. Only for debug responses (includeTimings): the baseline serializes
+    the whole diagram.
+    """
+    if not info or info.get('format') != 'compact':
+        return info
+    baseline_tokens = estimate_tokens(json.dumps(as_graph(diagram).raw, ensure_ascii=False, indent=2))
+    return {
+        **info,
+        'baseline_estimated_tokens': baseline_tokens,
+        'estimated_token_savings': baseline_tokens - info['estimated_tokens']
+    }
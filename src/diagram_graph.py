@@ -0,0 +1,178 @@
+from array import array
+from typing import Any, Dict, List, Optional, Union
+
+# --- BIỂU DIỄN SƠ ĐỒ DẠNG ĐỒ THỊ CÓ CHỈ MỤC, XÂY MỘT LẦN CHO MỖI REQUEST ---
+# Thay vì mỗi helper tự duyệt lại list dict của React Flow, request dựng một DiagramGraph:
+# id node được intern thành số nguyên, kề cận lưu dạng CSR (offsets + targets) trong array,
+# bậc vào/ra và số edge có điều kiện được tính sẵn trong cùng một lượt duyệt.
+
+
+class GraphNode:
+    __slots__ = ('index', 'id', 'type', 'label', 'raw')
+
+    def __init__(self, index: int, node_id: Any, node_type: Optional[str], label: Any, raw: Dict):
+        self.index = index
+        self.id = node_id
+        self.type = node_type
+        self.label = label
+        self.raw = raw
+
+
+class GraphEdge:
+    __slots__ = ('index', 'id', 'source', 'target', 'logic', 'rules', 'raw')
+
+    def __init__(self, index: int, edge_id: Any, source: int, target: int,
+                 logic: Optional[str], rules: Optional[List[Dict]], raw: Dict):
+        self.index = index
+        self.id = edge_id
+        # Chỉ số node nguồn/đích; -1 nếu edge trỏ tới id không tồn tại
+        self.source = source
+        self.target = target
+        self.logic = logic
+        self.rules = rules
+        self.raw = raw
+
+    @property
+    def is_conditional(self) -> bool:
+        return self.logic is not None
+
+
+class DiagramGraph:
+    """
+    Indexed, read-mostly view over a React Flow diagram dict ({"nodes": [...], "edges": [...]}).
+
+    `error` is None when the diagram is structurally sound (every node has an id and a
+    data.label, every edge has source/target pointing at existing nodes); otherwise it
+    describes the first problem found. The raw dict is kept in `raw` and never copied.
+    """
+
+    __slots__ = (
+        'raw', 'nodes', 'edges', 'id_to_index', 'out_offsets', 'out_targets', 'out_edges',
+        'in_degree', 'out_degree', 'conditional_edge_count', 'error'
+    )
+
+    def __init__(self, raw: Dict):
+        self.raw = raw
+        self.nodes: List[GraphNode] = []
+        self.edges: List[GraphEdge] = []
+        self.id_to_index: Dict[Any, int] = {}
+        self.out_offsets = array('i')
+        self.out_targets = array('i')
+        self.out_edges = array('i')
+        self.in_degree = array('i')
+        self.out_degree = array('i')
+        self.conditional_edge_count = 0
+        self.error: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, diagram: Any) -> 'DiagramGraph':
+        graph = cls(diagram if isinstance(diagram, dict) else {})
+        if not isinstance(diagram, dict):
+            graph.error = 'Diagram must be an object'
+            return graph
+
+        raw_nodes = diagram.get('nodes', [])
+        raw_edges = diagram.get('edges', [])
+        if not isinstance(raw_nodes, list) or not isinstance(raw_edges, list):
+            graph.error = 'nodes and edges must be lists'
+            raw_nodes = raw_nodes if isinstance(raw_nodes, list) else []
+            raw_edges = raw_edges if isinstance(raw_edges, list) else []
+
+        nodes = graph.nodes
+        id_to_index = graph.id_to_index
+        for raw_node in raw_nodes:
+            if not isinstance(raw_node, dict):
+                graph._fail('Node must be an object')
+                continue
+            data = raw_node.get('data')
+            if 'id' not in raw_node or not isinstance(data, dict) or 'label' not in data:
+                graph._fail('Node requires id and data.label')
+            node_id = raw_node.get('id')
+            label = data.get('label') if isinstance(data, dict) else None
+            index = len(nodes)
+            nodes.append(GraphNode(index, node_id, raw_node.get('type'), label, raw_node))
+            try:
+                id_to_index.setdefault(node_id, index)
+            except TypeError:
+                graph._fail('Node id must be hashable')
+
+        n = len(nodes)
+        in_degree = array('i', bytes(4 * n))
+        out_degree = array('i', bytes(4 * n))
+        edges = graph.edges
+        conditional = 0
+        for raw_edge in raw_edges:
+            if not isinstance(raw_edge, dict):
+                graph._fail('Edge must be an object')
+                continue
+            if 'source' not in raw_edge or 'target' not in raw_edge:
+                graph._fail('Edge requires source and target')
+            try:
+                source = id_to_index.get(raw_edge.get('source'), -1)
+                target = id_to_index.get(raw_edge.get('target'), -1)
+            except TypeError:
+                source = target = -1
+            if source == -1 or target == -1:
+                graph._fail('Edge references an unknown node')
+            data = raw_edge.get('data')
+            logic = data.get('logic') if isinstance(data, dict) and 'logic' in data else None
+            rules = data.get('rules') if isinstance(data, dict) else None
+            if logic is not None:
+                conditional += 1
+            edges.append(GraphEdge(len(edges), raw_edge.get('id'), source, target, logic, rules, raw_edge))
+            if source != -1:
+                out_degree[source] += 1
+            if target != -1:
+                in_degree[target] += 1
+
+        # CSR: các edge đi ra từ node i nằm ở out_targets[out_offsets[i]:out_offsets[i + 1]]
+        offsets = array('i', bytes(4 * (n + 1)))
+        for i in range(n):
+            offsets[i + 1] = offsets[i] + out_degree[i]
+        fill = array('i', offsets[:n])
+        out_targets = array('i', bytes(4 * offsets[n]))
+        out_edges = array('i', bytes(4 * offsets[n]))
+        for edge in edges:
+            if edge.source != -1 and edge.target != -1:
+                slot = fill[edge.source]
+                out_targets[slot] = edge.target
+                out_edges[slot] = edge.index
+                fill[edge.source] = slot + 1
+
+        graph.in_degree = in_degree
+        graph.out_degree = out_degree
+        graph.out_offsets = offsets
+        graph.out_targets = out_targets
+        graph.out_edges = out_edges
+        graph.conditional_edge_count = conditional
+        return graph
+
+    def _fail(self, message: str) -> None:
+        if self.error is None:
+            self.error = message
+
+    @property
+    def node_count(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.edges)
+
+    @property
+    def is_valid(self) -> bool:
+        return self.error is None
+
+    def labels(self, default: Any = '') -> List[Any]:
+        return [default if node.label is None else node.label for node in self.nodes]
+
+    def successors(self, index: int) -> array:
+        return self.out_targets[self.out_offsets[index]:self.out_offsets[index + 1]]
+
+    def outgoing_edges(self, index: int) -> List[GraphEdge]:
+        return [self.edges[e] for e in self.out_edges[self.out_offsets[index]:self.out_offsets[index + 1]]]
+
+
+def as_graph(diagram: Union[Dict, DiagramGraph]) -> DiagramGraph:
+    """Accept either a raw diagram dict or an already-built DiagramGraph"""
+    return diagram if isinstance(diagram, DiagramGraph) else DiagramGraph.from_dict(diagram)
@@ -0,0 +1,371 @@
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from diagram_graph import DiagramGraph, as_graph
+
+# --- BỐ CỤC PHÂN TẦNG (SUGIYAMA) PHÍA SERVER ---
+# Tính lại position cho mọi node để sơ đồ lớn hiển thị được ngay, không phải dàn lại trên trình duyệt:
+#   1. Phá chu trình: DFS, cạnh quay lui (vòng lặp "làm lại") được đảo chiều khi xếp tầng
+#   2. Xếp tầng: đường dài nhất từ các node bắt đầu (Kahn); cạnh dài được chia bằng node ảo
+#   3. Giảm giao cắt: quét barycenter xuống/lên từng tầng (tầng sau phụ thuộc tầng vừa xếp nên
+#      phần này tuần tự, O(số cạnh) mỗi lượt); thứ tự các nhánh điều kiện đi ra từ cùng một node
+#      được giữ theo thứ tự edge model trả về (Path A bên trái / phía trên Path B).
+#      Số giao cắt của mỗi lượt đếm bằng NumPy (broadcast theo nhóm), giữ thứ tự tốt nhất.
+#   4. Tọa độ: kéo node về trung bình láng giềng, rồi đẩy ra đủ khoảng cách tối thiểu trong tầng
+#      (cummax phân đoạn theo tầng, hai chiều rồi lấy trung bình)
+# NumPy là phụ thuộc tùy chọn: thiếu NumPy thì caller giữ nguyên cách đặt vị trí cũ.
+
+LAYOUT_DIRECTIONS = ('TB', 'LR')
+# Khoảng cách mặc định khớp với prompt sinh sơ đồ: "x cách 250px, y cách 120px"
+_SPACING = {'TB': (250.0, 120.0), 'LR': (120.0, 250.0)}
+_ORIGIN = (100.0, 100.0)
+# Nhóm cạnh giữa hai tầng kề nhau được đếm giao cắt bằng ma trận (nhóm x K x K) theo từng khối
+_CROSSING_CHUNK = 4_000_000
+_MAX_BROADCAST_GROUP = 1024
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise RuntimeError('Layered layout requires numpy (pip install numpy)') from e
+    return numpy
+
+
+def _break_cycles(n: int, sources: List[int], targets: List[int], roots: List[int]) -> List[bool]:
+    """Iterative DFS in edge order; returns for each edge whether it closes a cycle (back edge)"""
+    adjacency: List[List[int]] = [[] for _ in range(n)]
+    for e, s in enumerate(sources):
+        adjacency[s].append(e)
+    state = bytearray(n)  # 0 chưa thăm, 1 đang trên stack, 2 xong
+    cursor = [0] * n
+    reversed_edges = [False] * len(sources)
+    for root in roots + list(range(n)):
+        if state[root]:
+            continue
+        state[root] = 1
+        stack = [root]
+        while stack:
+            node = stack[-1]
+            out = adjacency[node]
+            position = cursor[node]
+            if position == len(out):
+                state[node] = 2
+                stack.pop()
+                continue
+            cursor[node] = position + 1
+            e = out[position]
+            target = targets[e]
+            if state[target] == 1:
+                reversed_edges[e] = True
+            elif state[target] == 0:
+                state[target] = 1
+                stack.append(target)
+    return reversed_edges
+
+
+def _longest_path_layers(n: int, sources: List[int], targets: List[int]) -> Tuple[List[int], bool]:
+    """
+    Layer = length of the longest path from any start node (Kahn order).
+    The flag is False when some nodes were never released, i.e. the graph has a cycle.
+    """
+    adjacency: List[List[int]] = [[] for _ in range(n)]
+    in_degree = [0] * n
+    for s, t in zip(sources, targets):
+        adjacency[s].append(t)
+        in_degree[t] += 1
+    layer = [0] * n
+    queue = [i for i in range(n) if in_degree[i] == 0]
+    head = 0
+    while head < len(queue):
+        node = queue[head]
+        head += 1
+        next_layer = layer[node] + 1
+        for t in adjacency[node]:
+            if layer[t] < next_layer:
+                layer[t] = next_layer
+            in_degree[t] -= 1
+            if in_degree[t] == 0:
+                queue.append(t)
+    return layer, len(queue) == n
+
+
+def _flow_rank(n: int, sources: List[int], targets: List[int], roots: List[int]) -> List[int]:
+    """BFS discovery order following edges in their original order (initial in-layer ordering)"""
+    adjacency: List[List[int]] = [[] for _ in range(n)]
+    for s, t in zip(sources, targets):
+        adjacency[s].append(t)
+    rank = [-1] * n
+    counter = 0
+    for start in roots + list(range(n)):
+        if rank[start] != -1:
+            continue
+        rank[start] = counter
+        counter += 1
+        queue = [start]
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for t in adjacency[node]:
+                if rank[t] == -1:
+                    rank[t] = counter
+                    counter += 1
+                    queue.append(t)
+    return rank
+
+
+def _split_long_edges(np, layer, src, dst, port, max_virtual):
+    """
+    Insert one virtual node per intermediate layer; every returned edge spans exactly one layer.
+    Beyond `max_virtual` virtual nodes the longest edges are left out of ordering (still drawn).
+    """
+    span = layer[dst] - layer[src]
+    extra = np.maximum(span - 1, 0)
+    ignored = 0
+    if extra.sum() > max_virtual:
+        # Giữ các cạnh ngắn trước; cạnh quá dài (thường là đường nối tắt) không tạo node ảo
+        by_span = np.argsort(extra, kind='stable')
+        keep = np.ones(len(src), dtype=bool)
+        keep[by_span[np.cumsum(extra[by_span]) > max_virtual]] = False
+        ignored = int((~keep).sum())
+        src, dst, port, span = src[keep], dst[keep], port[keep], span[keep]
+    long_edges = span > 1
+    if not long_edges.any():
+        return layer, src, dst, port, np.zeros(0, dtype=np.int64), 0, ignored
+
+    n = len(layer)
+    hops = np.where(long_edges, span, 1)               # số đoạn của mỗi cạnh sau khi chia
+    dummies = hops - 1
+    dummy_base = n + np.concatenate(([0], np.cumsum(dummies)[:-1]))
+    edge_of_hop = np.repeat(np.arange(len(src)), hops)
+    step = np.arange(hops.sum()) - np.repeat(np.cumsum(hops) - hops, hops)
+    last = step == hops[edge_of_hop] - 1
+
+    new_src = np.where(step == 0, src[edge_of_hop], dummy_base[edge_of_hop] + step - 1)
+    new_dst = np.where(last, dst[edge_of_hop], dummy_base[edge_of_hop] + step)
+    dummy_owner = np.repeat(np.arange(len(src)), dummies)
+    dummy_layer = layer[src[dummy_owner]] + 1 + (np.arange(dummies.sum()) - np.repeat(dummy_base - n, dummies))
+    return (np.concatenate((layer, dummy_layer)), new_src, new_dst, port[edge_of_hop],
+            src[dummy_owner], int(dummies.sum()), ignored)
+
+
+def _order_positions(np, layer, key, tie):
+    """Rank of each node inside its layer after sorting by (layer, key, tie)"""
+    order = np.lexsort((tie, key, layer))
+    sorted_layers = layer[order]
+    starts = np.searchsorted(sorted_layers, sorted_layers, side='left')
+    position = np.empty(len(layer), dtype=np.float64)
+    position[order] = np.arange(len(layer)) - starts
+    return position
+
+
+def _csr(np, keys, values, weights, total):
+    """Group `values` / `weights` by `keys` as flat lists plus offsets (fewer small Python objects)"""
+    order = np.argsort(keys, kind='stable')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=total))))
+    return offsets.tolist(), values[order].tolist(), weights[order].tolist()
+
+
+def _sweep(position: List[float], layers: List[List[int]], csr: Tuple[List[int], List[int], List[float]],
+           downward: bool) -> None:
+    """
+    One barycenter pass, layer by layer (each layer is ordered against the one just reordered).
+    `csr` holds each node's neighbours on the side the sweep comes from, with a port bias.
+    """
+    offsets, neighbours, biases = csr
+    sequence = range(1, len(layers)) if downward else range(len(layers) - 2, -1, -1)
+    for index in sequence:
+        keyed = []
+        for v in layers[index]:
+            start, end = offsets[v], offsets[v + 1]
+            if end > start:
+                key = (sum([position[u] for u in neighbours[start:end]]) + sum(biases[start:end])) / (end - start)
+            else:
+                key = position[v]
+            keyed.append((key, position[v], v))
+        keyed.sort()
+        for rank, (_, _, v) in enumerate(keyed):
+            position[v] = rank
+
+
+def _count_inversions(values: List[float]) -> int:
+    """Pairs i < j with values[i] > values[j] (bottom-up merge sort)"""
+    inversions = 0
+    width = 1
+    n = len(values)
+    while width < n:
+        merged = []
+        for left in range(0, n, 2 * width):
+            a, b = values[left:left + width], values[left + width:left + 2 * width]
+            i = j = 0
+            while i < len(a) and j < len(b):
+                if b[j] < a[i]:
+                    merged.append(b[j])
+                    inversions += len(a) - i
+                    j += 1
+                else:
+                    merged.append(a[i])
+                    i += 1
+            merged.extend(a[i:])
+            merged.extend(b[j:])
+        values = merged
+        width *= 2
+    return inversions
+
+
+def count_crossings(np, layer, position, src, dst) -> int:
+    """Edge crossings between adjacent layers (all edges span one layer)"""
+    if len(src) < 2:
+        return 0
+    order = np.lexsort((position[dst], position[src], layer[src]))
+    group = layer[src][order]
+    values = position[dst][order]
+    boundaries = np.flatnonzero(np.diff(group)) + 1
+    starts = np.concatenate(([0], boundaries))
+    sizes = np.diff(np.concatenate((starts, [len(group)])))
+    crossings = 0
+    # Gom các nhóm theo kích thước (lũy thừa 2) để đếm nghịch thế bằng broadcast (nhóm x K x K);
+    # nhóm rất lớn (tầng cực rộng) đếm bằng merge sort để không cấp phát ma trận K x K khổng lồ
+    buckets = np.ceil(np.log2(np.maximum(sizes, 2))).astype(np.int64)
+    for group in np.flatnonzero(sizes > _MAX_BROADCAST_GROUP):
+        crossings += _count_inversions(values[starts[group]:starts[group] + sizes[group]].tolist())
+    for bucket in np.unique(buckets):
+        chosen = np.flatnonzero((buckets == bucket) & (sizes > 1) & (sizes <= _MAX_BROADCAST_GROUP))
+        if len(chosen) == 0:
+            continue
+        k = 1 << int(bucket)
+        per_chunk = max(1, _CROSSING_CHUNK // (k * k))
+        for begin in range(0, len(chosen), per_chunk):
+            part = chosen[begin:begin + per_chunk]
+            matrix = np.full((len(part), k), np.inf)
+            offsets = np.arange(k)
+            valid = offsets[None, :] < sizes[part][:, None]
+            index = (starts[part][:, None] + offsets[None, :])[valid]
+            matrix[valid] = values[index]
+            upper = np.triu(np.ones((k, k), dtype=bool), 1)
+            crossings += int(((matrix[:, :, None] > matrix[:, None, :]) & upper).sum())
+    return crossings
+
+
+def _push_apart(np, values, segment, spacing):
+    """Smallest sequence >= values that grows by at least `spacing` inside each segment (segments sorted)"""
+    steps = np.arange(len(values)) * spacing
+    # Dịch mỗi tầng đi một khoảng lớn để cummax không tràn sang tầng kế tiếp
+    stride = (np.ptp(values) + spacing * (len(values) + 1)) * 2 + 1.0
+    shift = segment * stride
+    return np.maximum.accumulate(values - steps + shift) - shift + steps
+
+
+def _assign_coordinates(np, layer, position, src, dst, spacing, iterations=8):
+    """Pull nodes towards their neighbours' mean, then restore order and minimum spacing per layer"""
+    n = len(layer)
+    x = position * spacing
+    order = np.lexsort((position, layer))
+    sorted_layers = layer[order]
+    reversed_segments = sorted_layers.max() - sorted_layers[::-1]
+    both_from = np.concatenate((src, dst))
+    both_to = np.concatenate((dst, src))
+    degree = np.bincount(both_to, minlength=n).astype(np.float64)
+    for _ in range(iterations):
+        total = np.bincount(both_to, weights=x[both_from], minlength=n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # Chỉ đi nửa đường về phía trung bình láng giềng: cập nhật đồng thời mà không tắt dần
+            # thì cha và các con đổi chỗ qua lại giữa hai vòng lặp
+            target = ((x + np.where(degree > 0, total / degree, x)) / 2)[order]
+        pushed_right = _push_apart(np, target, sorted_layers, spacing)
+        pushed_left = -_push_apart(np, -target[::-1], reversed_segments, spacing)[::-1]
+        # Cả hai đều giữ khoảng cách >= spacing nên trung bình của chúng cũng vậy
+        x[order] = (pushed_right + pushed_left) / 2
+    return x
+
+
+def layered_layout(diagram: Union[Dict, DiagramGraph], direction: str = 'TB', sweeps: int = 8,
+                   node_spacing: Optional[float] = None, layer_spacing: Optional[float] = None,
+                   max_virtual_nodes: Optional[int] = None) -> Tuple[List[Tuple[float, float]], Dict[str, Any]]:
+    """
+    Sugiyama-style layout. Returns ((x, y) for each node in diagram order, stats).
+    Edges to unknown nodes and self-loops are ignored.
+    """
+    if direction not in LAYOUT_DIRECTIONS:
+        raise ValueError(f'direction must be one of {list(LAYOUT_DIRECTIONS)}')
+    np = _numpy()
+    started = time.perf_counter()
+    graph = as_graph(diagram)
+    n = graph.node_count
+    default_node_spacing, default_layer_spacing = _SPACING[direction]
+    node_spacing = node_spacing or default_node_spacing
+    layer_spacing = layer_spacing or default_layer_spacing
+    if n == 0:
+        return [], {'layers': 0, 'crossings': 0, 'reversed_edges': 0, 'virtual_nodes': 0}
+
+    # Cạnh hợp lệ theo thứ tự gốc; port = thứ tự của cạnh trong các cạnh đi ra từ cùng node
+    sources, targets, ports = [], [], []
+    out_count = [0] * n
+    for edge in graph.edges:
+        if edge.source == -1 or edge.target == -1 or edge.source == edge.target:
+            continue
+        sources.append(edge.source)
+        targets.append(edge.target)
+        ports.append(out_count[edge.source])
+        out_count[edge.source] += 1
+
+    roots = [i for i in range(n) if graph.in_degree[i] == 0]
+    dag_src, dag_dst = sources, targets
+    layers, acyclic = _longest_path_layers(n, sources, targets)
+    reversed_count = 0
+    if not acyclic:
+        # Chỉ chạy DFS phá chu trình khi thực sự có vòng lặp (đa số sơ đồ là DAG)
+        reversed_flags = _break_cycles(n, sources, targets, roots)
+        reversed_count = sum(reversed_flags)
+        dag_src = [t if r else s for s, t, r in zip(sources, targets, reversed_flags)]
+        dag_dst = [s if r else t for s, t, r in zip(sources, targets, reversed_flags)]
+        layers, _ = _longest_path_layers(n, dag_src, dag_dst)
+    layer = np.array(layers, dtype=np.int64)
+    flow_rank = np.array(_flow_rank(n, dag_src, dag_dst, roots), dtype=np.float64)
+
+    src = np.array(dag_src, dtype=np.int64)
+    dst = np.array(dag_dst, dtype=np.int64)
+    port = np.array(ports, dtype=np.float64)
+    if max_virtual_nodes is None:
+        max_virtual_nodes = max(1000, 10 * n)
+    layer, src, dst, port, dummy_source, virtual, ignored = _split_long_edges(np, layer, src, dst, port, max_virtual_nodes)
+    total = len(layer)
+    # Node ảo bắt đầu ở cạnh node nguồn của cạnh dài
+    initial = np.concatenate((flow_rank, flow_rank[dummy_source] + 0.5)) if virtual else flow_rank
+
+    position = _order_positions(np, layer, initial, np.arange(total, dtype=np.float64))
+    best_position = position
+    best_crossings = count_crossings(np, layer, position, src, dst)
+    if sweeps and best_crossings:
+        # Các nhánh điều kiện của cùng một node: port nhỏ (edge đứng trước) xếp trước
+        layers: List[List[int]] = [[] for _ in range(int(layer.max()) + 1)]
+        for v, l in enumerate(layer.tolist()):
+            layers[l].append(v)
+        above = _csr(np, dst, src, port * 1e-3, total)
+        below = _csr(np, src, dst, np.zeros(len(src)), total)
+        current = position.tolist()
+        for sweep in range(sweeps):
+            _sweep(current, layers, above if sweep % 2 == 0 else below, downward=sweep % 2 == 0)
+            candidate = np.array(current)
+            crossings = count_crossings(np, layer, candidate, src, dst)
+            if crossings < best_crossings:
+                best_position, best_crossings = candidate, crossings
+            if best_crossings == 0:
+                break
+
+    across = _assign_coordinates(np, layer, best_position, src, dst, node_spacing)[:n]
+    across = across - across.min()
+    along = layer[:n] * layer_spacing
+    x, y = (across, along) if direction == 'TB' else (along, across)
+    coordinates = [(float(a) + _ORIGIN[0], float(b) + _ORIGIN[1]) for a, b in zip(x.round(1), y.round(1))]
+    stats = {
+        'layers': int(layer[:n].max()) + 1,
+        'max_layer_width': int(np.bincount(layer).max()),
+        'crossings': int(best_crossings),
+        'reversed_edges': reversed_count,
+        'virtual_nodes': virtual,
+        'unordered_long_edges': ignored,
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1)
+    }
+    return coordinates, stats
@@ -0,0 +1,558 @@
+import argparse
+import asyncio
+import base64
+import contextvars
+import hmac
+import importlib
+import importlib.util
+import json
+import os
+import signal
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+# --- HTTP SERVICE CHẠY LÂU (ASYNCIO) CHO CÁC HANDLER LAMBDA ---
+# Một process phục vụ cả create (super-create.py), analyze (src/lambda_function.py) và
+# super-analyze (src/super.py) trên cùng một event loop, thay vì mỗi request một execution
+# environment Lambda. Handler giữ nguyên: mỗi request HTTP được dịch thành event API Gateway
+# (proxy) + context giả lập Lambda (get_remaining_time_in_millis => deadline theo request),
+# chạy trên pool thread dùng chung; response proxy {statusCode, headers, body} được dịch ngược lại.
+# Event Lambda nguyên bản vẫn dùng được qua POST /2015-03-31/functions/{name}/invocations
+# (cùng đường dẫn với Lambda Invoke API / Runtime Interface Emulator). Đường dẫn này chạy được cả các
+# action nội bộ (worker job, vô hiệu hóa cache) nên chỉ nhận từ loopback, hoặc kèm X-Invoke-Token
+# khớp SERVICE_INVOKE_TOKEN.
+# Phân tích stream=true được gửi dần dạng server-sent events (Transfer-Encoding: chunked): handler
+# gọi context.open_response_stream(...) rồi ghi từng event, service chuyển ngay từng chunk cho client.
+#
+# Lời gọi Bedrock của boto3 là đồng bộ: chúng chờ I/O trên pool thread (không chiếm event loop), còn
+# client / pool kết nối HTTP dùng chung cho cả process (aws_clients.py). Pool thread và pool kết nối
+# được định cỡ theo SERVICE_MAX_CONCURRENCY để một pod giữ được hàng trăm lời gọi model chậm cùng lúc.
+# Backpressure: tối đa SERVICE_MAX_CONCURRENCY request đang xử lý, SERVICE_MAX_QUEUE request chờ
+# (chờ quá SERVICE_QUEUE_TIMEOUT giây); vượt nữa => 503 + Retry-After ngay, không nhận thêm việc.
+#
+#   python src/http_service.py [--host 0.0.0.0] [--port 8080]
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+SRC = os.path.join(ROOT, 'src')
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+
+SERVICE_HOST = os.environ.get('SERVICE_HOST', '0.0.0.0')
+SERVICE_PORT = int(os.environ.get('SERVICE_PORT', 8080))
+SERVICE_MAX_CONCURRENCY = int(os.environ.get('SERVICE_MAX_CONCURRENCY', 256))
+SERVICE_MAX_QUEUE = int(os.environ.get('SERVICE_MAX_QUEUE', 512))
+SERVICE_QUEUE_TIMEOUT = float(os.environ.get('SERVICE_QUEUE_TIMEOUT', 10))
+# Ảnh inline tối đa 20MB => ~27MB sau base64
+SERVICE_MAX_BODY_BYTES = int(os.environ.get('SERVICE_MAX_BODY_BYTES', 32 * 1024 * 1024))
+SERVICE_MAX_HEADER_BYTES = int(os.environ.get('SERVICE_MAX_HEADER_BYTES', 64 * 1024))
+# Thời gian tối đa của một request (như timeout của Lambda), tính từ lúc nhận request kể cả lúc chờ
+SERVICE_REQUEST_TIMEOUT_MS = float(os.environ.get('SERVICE_REQUEST_TIMEOUT_MS', 29000))
+SERVICE_KEEPALIVE_SECONDS = float(os.environ.get('SERVICE_KEEPALIVE_SECONDS', 15))
+SERVICE_DRAIN_SECONDS = float(os.environ.get('SERVICE_DRAIN_SECONDS', 30))
+SERVICE_ROUTE_PREFIX = os.environ.get('SERVICE_ROUTE_PREFIX', '').rstrip('/')
+SERVICE_INVOKE_TOKEN = os.environ.get('SERVICE_INVOKE_TOKEN', '')
+
+# Pool dùng chung phải đủ cho số request đồng thời (đặt trước khi import handler: chúng đọc env lúc import).
+# Mỗi request chiếm một kết nối HTTP tới Bedrock, thêm một thread chặng có deadline (+ request hedged)
+os.environ.setdefault('AWS_MAX_POOL_CONNECTIONS', str(SERVICE_MAX_CONCURRENCY * 2))
+os.environ.setdefault('DEADLINE_MAX_WORKERS', str(SERVICE_MAX_CONCURRENCY * 2))
+os.environ.setdefault('REQUEST_TIMEOUT_MS', str(int(SERVICE_REQUEST_TIMEOUT_MS)))
+
+from structured_log import get_logger  # noqa: E402
+
+logger = get_logger('service')
+
+# Tên handler => (module, đường dẫn file nếu không import được theo tên)
+HANDLER_MODULES: Dict[str, Tuple[str, Optional[str]]] = {
+    'create': ('super_create', os.path.join(ROOT, 'super-create.py')),
+    'analysis': ('lambda_function', None),
+    'super': ('super', None),
+}
+
+# (method, mẫu đường dẫn, handler); {name} là path parameter như API Gateway
+ROUTES: List[Tuple[str, str, str]] = [
+    ('POST', '/create', 'create'),
+    ('POST', '/analyze', 'analysis'),
+    ('GET', '/analysis-status/{jobId}', 'analysis'),
+    ('POST', '/super-analyze', 'super'),
+]
+LAMBDA_INVOKE_PATH = '/2015-03-31/functions/{name}/invocations'
+
+_BINARY_CONTENT_TYPES = ('image/', 'application/octet-stream')
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type'
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+
+class ResponseStream:
+    """Response head and body chunks sent by a handler thread while it is still running"""
+    __slots__ = ('_loop', 'queue', 'opened')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.opened = False
+
+    def open(self, status: int, headers: Dict[str, str]) -> Callable[[Any], None]:
+        self.opened = True
+        self._put(('head', status, headers))
+        return self.write
+
+    def write(self, data: Any) -> None:
+        if data:
+            self._put(('data', data.encode('utf-8') if isinstance(data, str) else bytes(data)))
+
+    def _put(self, item: Tuple) -> None:
+        # Gọi từ thread của handler: chuyển sang event loop
+        self._loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+
+class ServiceContext:
+    """Stand-in for the Lambda context object: request ID, remaining time and optional response streaming"""
+    __slots__ = ('aws_request_id', 'function_name', '_expires_at', '_stream')
+
+    def __init__(self, function_name: str, timeout_ms: float = SERVICE_REQUEST_TIMEOUT_MS,
+                 request_id: Optional[str] = None, started: Optional[float] = None,
+                 stream: Optional[ResponseStream] = None):
+        self.aws_request_id = request_id or str(uuid.uuid4())
+        self.function_name = function_name
+        self._expires_at = (started or time.monotonic()) + timeout_ms / 1000
+        self._stream = stream
+
+    def get_remaining_time_in_millis(self) -> int:
+        return max(0, int((self._expires_at - time.monotonic()) * 1000))
+
+    def open_response_stream(self, status: int, headers: Dict[str, str]) -> Optional[Callable[[Any], None]]:
+        """Send the response head now and return a chunk writer; None when the client cannot stream"""
+        return self._stream.open(status, headers) if self._stream is not None else None
+
+
+def load_handler(name: str) -> Callable[[Dict[str, Any], Any], Any]:
+    module_name, path = HANDLER_MODULES[name]
+    module = sys.modules.get(module_name)
+    if module is None:
+        if path is None:
+            module = importlib.import_module(module_name)
+        else:
+            # super-create.py không import được theo tên (có dấu gạch ngang)
+            spec = importlib.util.spec_from_file_location(module_name, path)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[module_name] = module
+            spec.loader.exec_module(module)
+    return module.lambda_handler
+
+
+def match_route(method: str, path: str) -> Optional[Tuple[str, Dict[str, str], str]]:
+    """(handler name, path parameters, route pattern) or None"""
+    if SERVICE_ROUTE_PREFIX and path.startswith(SERVICE_ROUTE_PREFIX + '/'):
+        path = path[len(SERVICE_ROUTE_PREFIX):]
+    parts = path.rstrip('/').split('/') or ['']
+    for route_method, pattern, handler in ROUTES:
+        if route_method != method:
+            continue
+        pattern_parts = pattern.split('/')
+        if len(pattern_parts) != len(parts):
+            continue
+        params = {}
+        for expected, actual in zip(pattern_parts, parts):
+            if expected.startswith('{') and expected.endswith('}'):
+                if not actual:
+                    break
+                params[expected[1:-1]] = unquote(actual)
+            elif expected != actual:
+                break
+        else:
+            return handler, params, pattern
+    return None
+
+
+def build_proxy_event(method: str, path: str, query: str, headers: Dict[str, str], body: bytes,
+                      path_parameters: Dict[str, str], resource: str, request_id: str) -> Dict[str, Any]:
+    """API Gateway (REST, proxy integration) event for one HTTP request"""
+    content_type = headers.get('content-type', '').lower()
+    binary = content_type.startswith(_BINARY_CONTENT_TYPES)
+    return {
+        'resource': resource,
+        'path': path,
+        'httpMethod': method,
+        'headers': headers,
+        'queryStringParameters': dict(parse_qsl(query, keep_blank_values=True)) or None,
+        'pathParameters': path_parameters or None,
+        'requestContext': {'requestId': request_id, 'httpMethod': method, 'path': path},
+        'body': (base64.b64encode(body).decode('ascii') if binary else body.decode('utf-8')) if body else None,
+        'isBase64Encoded': bool(body) and binary
+    }
+
+
+def proxy_response(result: Any) -> Tuple[int, Dict[str, str], bytes]:
+    """Lambda proxy result ({statusCode, headers, body, isBase64Encoded}) -> (status, headers, bytes)"""
+    if not isinstance(result, dict) or 'statusCode' not in result:
+        return 200, {'Content-Type': 'application/json'}, json.dumps(result, ensure_ascii=False, default=str).encode('utf-8')
+    headers = {str(k): str(v) for k, v in (result.get('headers') or {}).items()}
+    body = result.get('body')
+    if body is None:
+        payload = b''
+    elif result.get('isBase64Encoded'):
+        payload = base64.b64decode(body)
+    elif isinstance(body, (bytes, bytearray)):
+        payload = bytes(body)
+    else:
+        payload = (body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)).encode('utf-8')
+    headers.setdefault('Content-Type', 'application/json')
+    return int(result['statusCode']), headers, payload
+
+
+def response_head(status: int, headers: Dict[str, str]) -> bytes:
+    reason = HTTPStatus(status).phrase if status in HTTPStatus._value2member_map_ else ''
+    return (f'HTTP/1.1 {status} {reason}\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n').encode('latin-1')
+
+
+def invoke_allowed(headers: Dict[str, str], peer: Any) -> bool:
+    """Raw Lambda invocations: X-Invoke-Token when SERVICE_INVOKE_TOKEN is set, otherwise loopback clients only"""
+    if SERVICE_INVOKE_TOKEN:
+        return hmac.compare_digest(headers.get('x-invoke-token', ''), SERVICE_INVOKE_TOKEN)
+    host = peer[0] if isinstance(peer, (tuple, list)) and peer else ''
+    return host in ('127.0.0.1', '::1') or host.startswith('::ffff:127.')
+
+
+class Backpressure:
+    """At most `max_concurrency` requests running and `max_queue` waiting; beyond that, reject"""
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.completed = 0
+
+    async def acquire(self) -> bool:
+        if self.active >= self.max_concurrency and self.waiting >= self.max_queue:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        return True
+
+    def release(self) -> None:
+        self.active -= 1
+        self.completed += 1
+        self._semaphore.release()
+
+    @property
+    def saturated(self) -> bool:
+        return self.active >= self.max_concurrency and self.waiting >= self.max_queue
+
+    def stats(self) -> Dict[str, Any]:
+        return {'active': self.active, 'waiting': self.waiting, 'rejected': self.rejected, 'completed': self.completed,
+                'max_concurrency': self.max_concurrency, 'max_queue': self.max_queue}
+
+
+class HandlerService:
+    def __init__(self, max_concurrency: int = SERVICE_MAX_CONCURRENCY, max_queue: int = SERVICE_MAX_QUEUE,
+                 queue_timeout: float = SERVICE_QUEUE_TIMEOUT):
+        self.backpressure = Backpressure(max_concurrency, max_queue, queue_timeout)
+        # Handler chạy ở đây; phần lớn thời gian là chờ Bedrock / KB nên số thread >> số CPU
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='handler')
+        self.handlers: Dict[str, Callable] = {}
+        self.draining = False
+        self.started = time.monotonic()
+        self.requests: Dict[str, int] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: set = set()
+
+    def handler(self, name: str) -> Callable:
+        handler = self.handlers.get(name)
+        if handler is None:
+            handler = self.handlers[name] = load_handler(name)
+        return handler
+
+    async def warm(self) -> None:
+        """Import every handler and send it a warm-up event (clients, caches, pools) before serving"""
+        loop = asyncio.get_running_loop()
+        for name in HANDLER_MODULES:
+            started = time.perf_counter()
+            try:
+                handler = self.handler(name)
+                await loop.run_in_executor(self.executor, handler, {'warmup': True}, ServiceContext(name))
+                logger.info('handler ready', handler=name, duration_ms=round((time.perf_counter() - started) * 1000, 1))
+            except Exception as e:
+                logger.error('handler warm-up failed', handler=name, error=str(e))
+
+    async def invoke(self, name: str, event: Dict[str, Any], context: ServiceContext) -> Any:
+        """Run a handler on the pool under backpressure; raises HttpError(503) when overloaded"""
+        if not await self.backpressure.acquire():
+            raise HttpError(503, 'Service overloaded, retry later', {'Retry-After': '1'})
+        try:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            loop = asyncio.get_running_loop()
+            # Context riêng cho mỗi request (log request_id, metric, deadline đều là contextvars)
+            return await loop.run_in_executor(self.executor, contextvars.Context().run,
+                                              self.handler(name), event, context)
+        finally:
+            self.backpressure.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'uptime_s': round(time.monotonic() - self.started, 1),
+            'draining': self.draining,
+            'connections': len(self._connections),
+            'requests': dict(self.requests),
+            **self.backpressure.stats()
+        }
+
+    # --- HTTP/1.1 ---
+
+    async def dispatch(self, method: str, target: str, version: str, headers: Dict[str, str], body: bytes,
+                       started: float, writer: asyncio.StreamWriter, keep_alive: bool,
+                       peer: Any = None) -> Tuple[int, Optional[Dict[str, str]], Optional[bytes]]:
+        """(status, headers, payload); headers / payload are None when the response was already streamed"""
+        url = urlsplit(target)
+        path = url.path or '/'
+        if method == 'OPTIONS':
+            return 204, dict(CORS_HEADERS), b''
+        if method == 'GET' and path in ('/healthz', '/readyz', '/stats'):
+            if path == '/readyz' and (self.draining or self.backpressure.saturated):
+                return 503, {'Content-Type': 'application/json'}, json.dumps(self.stats()).encode('utf-8')
+            payload = self.stats() if path == '/stats' else {'status': 'ok'}
+            return 200, {'Content-Type': 'application/json'}, json.dumps(payload).encode('utf-8')
+
+        request_id = headers.get('x-request-id') or str(uuid.uuid4())
+        invoke_parts = path.strip('/').split('/')
+        if method == 'POST' and len(invoke_parts) == 4 and invoke_parts[:2] == ['2015-03-31', 'functions'] \
+                and invoke_parts[3] == 'invocations':
+            # Event Lambda nguyên bản (tương thích aws lambda invoke --endpoint-url)
+            if not invoke_allowed(headers, peer):
+                raise HttpError(403, 'Direct invocation requires a loopback client or X-Invoke-Token')
+            name = invoke_parts[2]
+            if name not in HANDLER_MODULES:
+                raise HttpError(404, f'Unknown function {name}')
+            try:
+                event = json.loads(body or b'{}')
+            except ValueError:
+                raise HttpError(400, 'Invocation payload must be JSON')
+            result = await self.invoke(name, event, ServiceContext(name, request_id=request_id, started=started))
+            return 200, {'Content-Type': 'application/json'}, json.dumps(result, ensure_ascii=False, default=str).encode('utf-8')
+
+        route = match_route(method, path)
+        if route is None:
+            raise HttpError(404, f'No route for {method} {path}')
+        name, path_parameters, resource = route
+        event = build_proxy_event(method, path, url.query, headers, body, path_parameters, resource, request_id)
+        # Chunked transfer chỉ có từ HTTP/1.1
+        stream = ResponseStream(asyncio.get_running_loop()) if version == 'HTTP/1.1' else None
+        task = asyncio.ensure_future(
+            self.invoke(name, event, ServiceContext(name, request_id=request_id, started=started, stream=stream)))
+        if stream is not None:
+            status = await self.relay_stream(stream, task, writer, keep_alive)
+            if status is not None:
+                return status, None, None
+        status, response_headers, payload = proxy_response(await task)
+        for key, value in CORS_HEADERS.items():
+            response_headers.setdefault(key, value)
+        return status, response_headers, payload
+
+    async def relay_stream(self, stream: ResponseStream, task: asyncio.Future, writer: asyncio.StreamWriter,
+                           keep_alive: bool) -> Optional[int]:
+        """
+        Forward the handler's streamed head and chunks to the client as they arrive.
+        Returns the status when the handler streamed, None when it returned a regular response.
+        """
+        status = None
+        connected = True
+
+        async def forward(item: Tuple) -> None:
+            nonlocal status, connected
+            try:
+                if item[0] == 'head':
+                    status = item[1]
+                    response_headers = {**CORS_HEADERS, **item[2], 'Transfer-Encoding': 'chunked',
+                                        'Connection': 'keep-alive' if keep_alive else 'close'}
+                    writer.write(response_head(status, response_headers))
+                elif connected:
+                    writer.write(b'%x\r\n%s\r\n' % (len(item[1]), item[1]))
+                await writer.drain()
+            except ConnectionError:
+                # Client ngắt giữa chừng: handler vẫn chạy xong (kết quả vẫn vào cache)
+                connected = False
+
+        while not task.done():
+            getter = asyncio.ensure_future(stream.queue.get())
+            done, _ = await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                await forward(getter.result())
+            else:
+                getter.cancel()
+        # Chunk được đưa vào queue trước khi handler trả về
+        while not stream.queue.empty():
+            await forward(stream.queue.get_nowait())
+        if not stream.opened:
+            return None
+        if task.exception() is not None:
+            logger.error('streamed request failed', error=str(task.exception()))
+            raise ConnectionError('stream aborted')
+        if not connected:
+            raise ConnectionError('client disconnected')
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return status
+
+    async def read_request(self, reader: asyncio.StreamReader,
+                           writer: asyncio.StreamWriter) -> Optional[Tuple[str, str, str, Dict[str, str], bytes]]:
+        """(method, target, version, lower-cased headers, body), or None when the client closed"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), SERVICE_KEEPALIVE_SECONDS)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(431, 'Request headers too large')
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            raise HttpError(400, 'Malformed request line')
+        headers: Dict[str, str] = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise HttpError(411, 'Chunked request bodies are not supported; send Content-Length')
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HttpError(400, 'Invalid Content-Length')
+        if length > SERVICE_MAX_BODY_BYTES:
+            raise HttpError(413, f'Request body exceeds {SERVICE_MAX_BODY_BYTES} bytes')
+        body = await self.read_body(reader, writer, headers, length) if length else b''
+        return method.upper(), target, version, headers, body
+
+    @staticmethod
+    async def read_body(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                        headers: Dict[str, str], length: int) -> bytes:
+        if headers.get('expect', '').lower() == '100-continue':
+            # Client (curl với ảnh lớn) chờ xác nhận trước khi gửi body
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+            await writer.drain()
+        return await reader.readexactly(length)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections.add(writer)
+        try:
+            while True:
+                keep_alive = False
+                method = target = '-'
+                started = time.monotonic()
+                try:
+                    request = await self.read_request(reader, writer)
+                    if request is None:
+                        break
+                    method, target, version, headers, body = request
+                    started = time.monotonic()
+                    connection = headers.get('connection', '').lower()
+                    keep_alive = (connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive') \
+                        and not self.draining
+                    status, response_headers, payload = await self.dispatch(
+                        method, target, version, headers, body, started, writer, keep_alive,
+                        writer.get_extra_info('peername'))
+                except HttpError as e:
+                    status, response_headers = e.status, {'Content-Type': 'application/json', **CORS_HEADERS, **e.headers}
+                    payload = json.dumps({'success': False, 'error': str(e)}, ensure_ascii=False).encode('utf-8')
+                    # Lỗi ở tầng HTTP (header quá lớn, body sai...) => đóng kết nối, trạng thái stream không còn chắc chắn
+                    keep_alive = keep_alive and status == 503
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    logger.error('request failed', error=str(e))
+                    status, response_headers = 500, {'Content-Type': 'application/json', **CORS_HEADERS}
+                    payload = json.dumps({'success': False, 'error': f'Internal error: {e}'}, ensure_ascii=False).encode('utf-8')
+
+                if response_headers is not None:
+                    response_headers['Content-Length'] = str(len(payload))
+                    response_headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+                    writer.write(response_head(status, response_headers) + payload)
+                    await writer.drain()
+                logger.info('request served', method=method, path=urlsplit(target).path if target != '-' else target,
+                            status=status, duration_ms=round((time.monotonic() - started) * 1000, 1))
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def serve(self, host: str = SERVICE_HOST, port: int = SERVICE_PORT, warm: bool = True) -> None:
+        if warm:
+            await self.warm()
+        self._server = await asyncio.start_server(self.handle_connection, host, port, limit=SERVICE_MAX_HEADER_BYTES,
+                                                  backlog=SERVICE_MAX_CONCURRENCY + SERVICE_MAX_QUEUE)
+        logger.info('service listening', host=host, port=port, max_concurrency=self.backpressure.max_concurrency,
+                    max_queue=self.backpressure.max_queue)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        async with self._server:
+            await stop.wait()
+            await self.shutdown()
+
+    async def shutdown(self, drain_seconds: float = SERVICE_DRAIN_SECONDS) -> None:
+        """Stop accepting, let in-flight requests finish (up to drain_seconds), then close"""
+        self.draining = True
+        if self._server is not None:
+            self._server.close()
+        deadline = time.monotonic() + drain_seconds
+        while (self.backpressure.active or self.backpressure.waiting) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        logger.info('service stopped', **self.backpressure.stats())
+        self.executor.shutdown(wait=False)
+
+
+def config_problems() -> List[str]:
+    """Settings without which every request would fail (checked before serving)"""
+    problems = []
+    if 'bedrock' in os.environ.get('RETRIEVER', 'bedrock').lower() and not os.environ.get('KNOWLEDGE_BASE_ID'):
+        problems.append('KNOWLEDGE_BASE_ID is not set (or set RETRIEVER=local)')
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the FlowLens Lambda handlers over HTTP')
+    parser.add_argument('--host', default=SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument('--no-warm', action='store_true', help='skip importing and warming handlers at startup')
+    args = parser.parse_args()
+    problems = config_problems()
+    if problems:
+        for problem in problems:
+            logger.error('invalid service configuration', problem=problem)
+        sys.exit(1)
+    asyncio.run(HandlerService().serve(args.host, args.port, warm=not args.no_warm))
@@ -0,0 +1,269 @@
+import base64
+import binascii
+import hashlib
+import io
+import math
+import os
+import struct
+from typing import Any, Dict, Optional, Tuple
+
+from aws_clients import get_client
+from structured_log import get_logger
+
+# --- ẢNH ĐẦU VÀO CHO SINH SƠ ĐỒ: GIẢI MÃ MỘT LẦN, THU NHỎ, GỬI GỌN ---
+# Nguồn ảnh của request (theo thứ tự ưu tiên):
+#   1. body nhị phân: Content-Type image/* (API Gateway / Function URL gửi kèm isBase64Encoded),
+#      text / language đi qua query string
+#   2. "imageRef": "s3://bucket/key" hoặc {"bucket", "key"} — ảnh đã được upload sẵn lên S3
+#   3. "image": base64 (có hoặc không có tiền tố data:image/...;base64,) như trước
+# Ảnh được giải mã đúng MỘT lần ra bytes; định dạng và kích thước đọc từ header của bytes.
+# Ảnh chụp màn hình lớn / high-DPI được thu nhỏ về cạnh dài IMAGE_MAX_EDGE và tối đa
+# IMAGE_MAX_PIXELS (vẫn đọc được chữ, token ảnh ~ rộng x cao / 750) rồi mới mã hóa lại.
+# Pillow là phụ thuộc tùy chọn: không có Pillow thì ảnh được gửi nguyên trạng nếu còn dưới giới hạn.
+
+logger = get_logger('image')
+
+IMAGE_MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', 1568))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 1_150_000))
+# Giới hạn một ảnh (sau giải mã) mà model chấp nhận
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 3_750_000))
+# Giới hạn ảnh gốc nhận vào (trước khi thu nhỏ)
+IMAGE_MAX_INPUT_BYTES = int(os.environ.get('IMAGE_MAX_INPUT_BYTES', 20 * 1024 * 1024))
+IMAGE_JPEG_QUALITY = int(os.environ.get('IMAGE_JPEG_QUALITY', 85))
+# imageRef chỉ được đọc từ bucket upload này (không cho đọc bucket tùy ý)
+IMAGE_UPLOAD_BUCKET = os.environ.get('IMAGE_UPLOAD_BUCKET', '')
+
+_RAW_CONTENT_TYPES = ('image/', 'application/octet-stream')
+
+
+class PreparedImage:
+    __slots__ = ('data', 'media_type', 'width', 'height', 'input_bytes', 'resized', 'source')
+
+    def __init__(self, data: bytes, media_type: str, width: Optional[int], height: Optional[int],
+                 input_bytes: int, resized: bool, source: str):
+        self.data = data
+        self.media_type = media_type
+        self.width = width
+        self.height = height
+        self.input_bytes = input_bytes
+        self.resized = resized
+        self.source = source
+
+    def content_block(self) -> Dict[str, Any]:
+        """Anthropic message image block; the base64 text is produced here, once"""
+        return {
+            "type": "image",
+            "source": {
+                "type": "base64",
+                "media_type": self.media_type,
+                "data": base64.b64encode(self.data).decode('ascii')
+            }
+        }
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'media_type': self.media_type,
+            'width': self.width,
+            'height': self.height,
+            'input_bytes': self.input_bytes,
+            'sent_bytes': len(self.data),
+            'resized': self.resized,
+            'source': self.source
+        }
+
+
+def sniff_media_type(data: bytes) -> Optional[str]:
+    """Media type from the magic bytes; None when it is not a supported image"""
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def image_dimensions(data: bytes, media_type: str) -> Optional[Tuple[int, int]]:
+    """(width, height) read from the header only, without decoding pixels"""
+    try:
+        if media_type == 'image/png':
+            return struct.unpack('>II', data[16:24])
+        if media_type == 'image/gif':
+            return struct.unpack('<HH', data[6:10])
+        if media_type == 'image/webp':
+            chunk = data[12:16]
+            if chunk == b'VP8 ':
+                width, height = struct.unpack('<HH', data[26:30])
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b'VP8L':
+                bits = int.from_bytes(data[21:25], 'little')
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b'VP8X':
+                return int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+            return None
+        if media_type == 'image/jpeg':
+            # Duyệt các marker tới SOFn (bỏ qua DHT C4, JPG C8, DAC CC)
+            i, n = 2, len(data)
+            while i + 9 < n:
+                if data[i] != 0xFF:
+                    i += 1
+                    continue
+                marker = data[i + 1]
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                    i += 1 if marker == 0xFF else 2
+                    continue
+                length = struct.unpack('>H', data[i + 2:i + 4])[0]
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                    return width, height
+                i += 2 + length
+    except struct.error:
+        return None
+    return None
+
+
+def decode_base64_image(value: str) -> bytes:
+    """Inline base64 (optionally a data URL) to bytes"""
+    if value.startswith('data:'):
+        value = value.partition(',')[2]
+    try:
+        return base64.b64decode(value)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError(f'image is not valid base64: {e}') from e
+
+
+def parse_image_ref(ref: Any) -> Tuple[str, str]:
+    """`s3://bucket/key` or {"bucket", "key"} -> (bucket, key), restricted to IMAGE_UPLOAD_BUCKET"""
+    if isinstance(ref, str) and ref.startswith('s3://'):
+        bucket, _, key = ref[len('s3://'):].partition('/')
+    elif isinstance(ref, str):
+        bucket, key = IMAGE_UPLOAD_BUCKET, ref
+    elif isinstance(ref, dict):
+        bucket, key = ref.get('bucket') or IMAGE_UPLOAD_BUCKET, ref.get('key') or ''
+    else:
+        raise ValueError('imageRef must be "s3://bucket/key" or {"bucket", "key"}')
+    if not IMAGE_UPLOAD_BUCKET:
+        raise ValueError('imageRef is not enabled (IMAGE_UPLOAD_BUCKET is not set)')
+    if bucket != IMAGE_UPLOAD_BUCKET:
+        raise ValueError(f'imageRef must point to bucket {IMAGE_UPLOAD_BUCKET}')
+    if not key:
+        raise ValueError('imageRef key is required')
+    return bucket, key
+
+
+def fetch_image_ref(ref: Any) -> bytes:
+    bucket, key = parse_image_ref(ref)
+    response = get_client('s3').get_object(Bucket=bucket, Key=key)
+    if response.get('ContentLength', 0) > IMAGE_MAX_INPUT_BYTES:
+        response['Body'].close()
+        raise ValueError(f'Image exceeds {IMAGE_MAX_INPUT_BYTES} bytes')
+    return response['Body'].read()
+
+
+def is_raw_image_event(event: Any) -> bool:
+    """API Gateway / Function URL event whose body is the image itself"""
+    if not isinstance(event, dict) or event.get('body') is None:
+        return False
+    headers = event.get('headers') or {}
+    content_type = next((value for name, value in headers.items() if name.lower() == 'content-type'), '') or ''
+    return content_type.lower().startswith(_RAW_CONTENT_TYPES)
+
+
+def _target_size(width: int, height: int) -> Tuple[int, int]:
+    scale = min(1.0, IMAGE_MAX_EDGE / max(width, height), math.sqrt(IMAGE_MAX_PIXELS / (width * height)))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def _needs_resize(size: int, dimensions: Optional[Tuple[int, int]]) -> bool:
+    if size > IMAGE_MAX_BYTES:
+        return True
+    if dimensions is None:
+        return False
+    width, height = dimensions
+    return max(width, height) > IMAGE_MAX_EDGE or width * height > IMAGE_MAX_PIXELS
+
+
+def _resize(data: bytes, media_type: str, dimensions: Optional[Tuple[int, int]]) -> Optional[Tuple[bytes, str, int, int]]:
+    """Downscale and re-encode with Pillow; None when Pillow is not installed"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = dimensions or image.size
+        size = _target_size(width, height)
+        if media_type == 'image/jpeg':
+            # JPEG giải mã thẳng ở độ phân giải giảm (1/2, 1/4, 1/8) => nhanh và ít RAM hơn
+            image.draft('RGB', size)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        resized = image.resize(size, Image.LANCZOS, reducing_gap=3.0) if image.size != size else image
+        out = io.BytesIO()
+        # Sơ đồ / ảnh chụp màn hình giữ PNG (chữ sắc nét); JPEG và WebP (nén mất dữ liệu) giữ định dạng gốc
+        if media_type == 'image/webp':
+            resized.save(out, format='WEBP', quality=IMAGE_JPEG_QUALITY)
+            if out.tell() <= IMAGE_MAX_BYTES:
+                return out.getvalue(), 'image/webp', size[0], size[1]
+            out = io.BytesIO()
+        elif media_type != 'image/jpeg':
+            resized.save(out, format='PNG')
+            if out.tell() <= IMAGE_MAX_BYTES:
+                return out.getvalue(), 'image/png', size[0], size[1]
+            out = io.BytesIO()
+        if resized.mode not in ('RGB', 'L'):
+            resized = resized.convert('RGB')
+        resized.save(out, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+        return out.getvalue(), 'image/jpeg', size[0], size[1]
+
+
+def prepare_image(data: bytes, source: str = 'inline') -> PreparedImage:
+    """Validate the bytes and downscale them when too large for the model"""
+    if not data:
+        raise ValueError('Image is empty')
+    if len(data) > IMAGE_MAX_INPUT_BYTES:
+        raise ValueError(f'Image exceeds {IMAGE_MAX_INPUT_BYTES} bytes')
+    media_type = sniff_media_type(data)
+    if media_type is None:
+        raise ValueError('Unsupported image format (expected JPEG, PNG, GIF or WebP)')
+    dimensions = image_dimensions(data, media_type)
+    width, height = dimensions or (None, None)
+    input_bytes = len(data)
+
+    if not _needs_resize(input_bytes, dimensions):
+        return PreparedImage(data, media_type, width, height, input_bytes, False, source)
+
+    resized = None
+    try:
+        resized = _resize(data, media_type, dimensions)
+    except Exception as e:
+        logger.warning('image resize failed', error=str(e), media_type=media_type)
+    if resized is None:
+        if input_bytes > IMAGE_MAX_BYTES:
+            raise ValueError(f'Image exceeds {IMAGE_MAX_BYTES} bytes and cannot be downscaled here')
+        logger.warning('image sent at full size (Pillow unavailable)', width=width, height=height)
+        return PreparedImage(data, media_type, width, height, input_bytes, False, source)
+
+    resized_data, media_type, width, height = resized
+    logger.info('image downscaled', input_bytes=input_bytes, sent_bytes=len(resized_data),
+                width=width, height=height, media_type=media_type)
+    return PreparedImage(resized_data, media_type, width, height, input_bytes, True, source)
+
+
+def read_request_image(event: Dict[str, Any], body: Dict[str, Any]) -> Optional[Tuple[bytes, str]]:
+    """(bytes, source) of a create request's image (raw body, imageRef or inline base64), or None"""
+    if is_raw_image_event(event):
+        raw = event['body']
+        return (base64.b64decode(raw) if event.get('isBase64Encoded') else raw.encode('latin-1')), 'raw'
+    if body.get('imageRef'):
+        return fetch_image_ref(body['imageRef']), 's3'
+    if body.get('image'):
+        # Bỏ chuỗi base64 khỏi body ngay sau khi giải mã: không giữ hai bản của ảnh
+        return decode_base64_image(body.pop('image')), 'inline'
+    return None
+
+
+def image_fingerprint(data: bytes) -> str:
+    """Content hash of the received bytes (before any downscaling), for cache keys"""
+    return hashlib.sha256(data).hexdigest()
@@ -0,0 +1,339 @@
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# --- PARSER JSON TĂNG DẦN CHO OUTPUT DẠNG STREAM CỦA MODEL ---
+# Nhận từng đoạn text (chunk) và trả về các cặp (key, value) cấp 1 của object ngoài cùng
+# ngay khi value tương ứng đóng lại, không cần chờ model sinh xong toàn bộ JSON.
+
+_WHITESPACE = ' \t\r\n'
+# Phần thân chuỗi JSON (xử lý escape), group 1 là dấu " đóng chuỗi nếu đã có
+_STRING_REST_RE = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*(")?', re.S)
+_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*(")?|[{}]', re.S)
+_DECODER = json.JSONDecoder()
+_MAX_DECODE_FAILURES = 8
+
+
+class TopLevelSectionParser:
+    """
+    Incremental, string-aware parser emitting top-level members of the outermost JSON object.
+
+    Usage:
+        parser = TopLevelSectionParser()
+        for chunk in chunks:
+            for key, value in parser.feed(chunk):
+                ...
+    Text before the first '{' (model preamble) is ignored. Each character is scanned once.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.started = False
+        self.finished = False
+        self.key: Optional[str] = None
+        self.key_start = -1
+        self.value_start = -1
+        self.value_emitted = False
+        self.expect_value = False
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        self.buffer += chunk
+        emitted: List[Tuple[str, Any]] = []
+        buf = self.buffer
+        i = self.pos
+        n = len(buf)
+        while i < n and not self.finished:
+            ch = buf[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 1 and self.key_start != -1:
+                        # Kết thúc một key cấp 1
+                        self.key = json.loads(buf[self.key_start:i + 1])
+                        self.key_start = -1
+            elif not self.started:
+                if ch == '{':
+                    self.started = True
+                    self.depth = 1
+            elif ch == '"':
+                self.in_string = True
+                if self.depth == 1 and self.key is None:
+                    self.key_start = i
+                elif self.expect_value:
+                    self._begin_value(i)
+            elif ch in '{[':
+                if self.expect_value:
+                    self._begin_value(i)
+                self.depth += 1
+            elif ch in '}]':
+                self.depth -= 1
+                if self.depth == 1 and self.key is not None and not self.value_emitted:
+                    # Value dạng object/array vừa đóng: phát ngay
+                    emitted.append(self._emit(buf, i + 1))
+                elif self.depth == 0:
+                    if self.key is not None and not self.value_emitted and self.value_start != -1:
+                        emitted.append(self._emit(buf, i))
+                    self.finished = True
+            elif self.depth == 1:
+                if ch == ':' and self.key is not None:
+                    self.expect_value = True
+                elif ch == ',':
+                    if self.key is not None and not self.value_emitted and self.value_start != -1:
+                        emitted.append(self._emit(buf, i))
+                    self._reset_member()
+                elif self.expect_value and ch not in _WHITESPACE:
+                    # Value vô hướng (số, true/false/null)
+                    self._begin_value(i)
+            i += 1
+        self.pos = i
+        return emitted
+
+    def _begin_value(self, i: int) -> None:
+        self.value_start = i
+        self.expect_value = False
+
+    def _emit(self, buf: str, end: int) -> Tuple[str, Any]:
+        key = self.key
+        raw = buf[self.value_start:end].strip()
+        self.value_emitted = True
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            value = raw
+        return key, value
+
+    def _reset_member(self) -> None:
+        self.key = None
+        self.key_start = -1
+        self.value_start = -1
+        self.value_emitted = False
+        self.expect_value = False
+
+
+# --- TRÍCH XUẤT OBJECT JSON TỪ OUTPUT CỦA MODEL (MỘT LẦN QUÉT, O(n)) ---
+# Dùng chung cho super-create.py (sinh sơ đồ) và lambda_function.py (phân tích).
+# Quét từng ký tự đúng một lần, nhận biết chuỗi (bỏ qua ngoặc nằm trong "..."),
+# ghi lại các cặp {...} ngoài cùng rồi mới json.loads từng ứng viên. Các ứng viên
+# ngoài cùng không chồng lên nhau nên tổng chi phí parse cũng tuyến tính.
+
+
+class ExtractionResult:
+    """Outcome of extract_json_object; `error`/`error_pos` describe why nothing usable was found"""
+
+    __slots__ = ('value', 'start', 'end', 'method', 'candidates', 'error', 'error_pos')
+
+    def __init__(self, value: Optional[Dict] = None, start: int = -1, end: int = -1, method: str = 'none',
+                 candidates: int = 0, error: Optional[str] = None, error_pos: int = -1):
+        self.value = value
+        self.start = start
+        self.end = end
+        self.method = method
+        self.candidates = candidates
+        self.error = error
+        self.error_pos = error_pos
+
+    def __bool__(self) -> bool:
+        return self.value is not None
+
+
+class JsonObjectScanner:
+    """
+    Incremental scanner locating outermost balanced {...} spans in arbitrary text.
+    Quotes only start a string inside an object, so apostrophes/quotes in the
+    model's prose preamble cannot desynchronize the scan.
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0
+        self.stack: List[int] = []
+        self.in_string = False
+        self.escape = False
+        # Các cặp (start, end) ngoài cùng đã đóng, theo thứ tự xuất hiện
+        self.spans: List[Tuple[int, int]] = []
+
+    def feed(self, chunk: str) -> None:
+        self.buffer += chunk
+        buf = self.buffer
+        n = len(buf)
+        stack = self.stack
+        spans = self.spans
+        i = self.pos
+
+        if self.in_string:
+            # Tiếp tục một chuỗi bị cắt ở cuối chunk trước
+            if self.escape:
+                if i >= n:
+                    return
+                i += 1
+                self.escape = False
+            match = _STRING_REST_RE.match(buf, i)
+            if match.group(1) is None:
+                self.escape = match.end() < n
+                self.pos = n
+                return
+            i = match.end()
+            self.in_string = False
+
+        # Ngoài object: chỉ cần tìm '{'. Trong object: regex (chạy bằng C) nhảy qua nguyên
+        # cả chuỗi "..." và chỉ dừng ở ngoặc nhọn, nên mỗi ký tự chỉ được xem một lần.
+        search = _TOKEN_RE.search
+        while i < n:
+            if not stack:
+                j = buf.find('{', i)
+                if j == -1:
+                    i = n
+                    break
+                stack.append(j)
+                i = j + 1
+                continue
+            match = search(buf, i)
+            if match is None:
+                i = n
+                break
+            j = match.start()
+            ch = buf[j]
+            if ch == '"':
+                if match.group(1) is None:
+                    # Chuỗi chưa đóng: chờ chunk tiếp theo
+                    self.in_string = True
+                    self.escape = match.end() < n
+                    i = n
+                    break
+            elif ch == '{':
+                stack.append(j)
+            else:
+                start = stack.pop()
+                # Cặp mới đóng bao trùm mọi span đã ghi nhận bắt đầu sau nó
+                while spans and spans[-1][0] > start:
+                    spans.pop()
+                spans.append((start, j + 1))
+            i = match.end()
+        self.pos = i
+
+    def result(self, required_keys: Tuple[str, ...] = ()) -> ExtractionResult:
+        return _pick_candidate(self.buffer, self.spans, required_keys)
+
+
+def _has_keys(value: Any, required_keys: Tuple[str, ...]) -> bool:
+    return isinstance(value, dict) and all(key in value for key in required_keys)
+
+
+def _pick_candidate(text: str, spans: List[Tuple[int, int]], required_keys: Tuple[str, ...],
+                    parsed: Optional[Dict[int, Any]] = None, method: str = 'scan') -> ExtractionResult:
+    """Choose the largest span whose JSON has `required_keys`; `parsed` maps start -> already-decoded value"""
+    parsed = parsed or {}
+    best: Optional[ExtractionResult] = None
+    nested: Optional[ExtractionResult] = None
+    first_error: Optional[Tuple[str, int]] = None
+
+    # Ưu tiên ứng viên dài nhất (giống hành vi cũ "largest JSON object")
+    for start, end in sorted(spans, key=lambda span: span[0] - span[1]):
+        if start in parsed:
+            value = parsed[start]
+        else:
+            try:
+                value = json.loads(text[start:end])
+            except json.JSONDecodeError as e:
+                if first_error is None:
+                    first_error = (e.msg, start + e.pos)
+                continue
+            except RecursionError:
+                if first_error is None:
+                    first_error = ('Nesting too deep', start)
+                continue
+        if _has_keys(value, required_keys):
+            best = ExtractionResult(value, start, end, method)
+            break
+        # Sơ đồ bị bọc trong một object khác, ví dụ {"diagram": {"nodes": ..., "edges": ...}}
+        if nested is None and required_keys and isinstance(value, dict):
+            for inner in value.values():
+                if _has_keys(inner, required_keys):
+                    nested = ExtractionResult(inner, start, end, 'nested')
+                    break
+
+    result = best or nested
+    if result is not None:
+        result.candidates = len(spans)
+        return result
+    if first_error is not None:
+        message, position = first_error
+        return ExtractionResult(candidates=len(spans), error=f'Invalid JSON: {message}', error_pos=position)
+    if spans:
+        return ExtractionResult(candidates=len(spans), error=f'No JSON object with keys {list(required_keys)}')
+    return ExtractionResult(error='No balanced JSON object found', error_pos=text.find('{'))
+
+
+def extract_json_object(text: str, required_keys: Tuple[str, ...] = ()) -> ExtractionResult:
+    """
+    Locate the largest outermost JSON object in `text` that contains `required_keys`,
+    in linear time. Returns an ExtractionResult (falsy when nothing was found).
+
+    Candidates are decoded with the C JSON decoder (raw_decode) starting at each
+    top-level '{'. Each failed attempt can cost O(n) (including building the
+    error's line/column), so after _MAX_DECODE_FAILURES failures the remainder is
+    handled by JsonObjectScanner; adversarial inputs cannot make it quadratic.
+    """
+    if not text:
+        return ExtractionResult(error='Empty response')
+
+    # Đường nhanh: đoạn từ '{' đầu tiên tới '}' cuối cùng là JSON hợp lệ (trường hợp phổ biến,
+    # kể cả khi có lời dẫn hoặc code fence)
+    start = text.find('{')
+    end = text.rfind('}') + 1
+    if start == -1:
+        return ExtractionResult(error='No JSON object found')
+    if end > start:
+        try:
+            value = json.loads(text[start:end])
+            if _has_keys(value, required_keys):
+                return ExtractionResult(value, start, end, 'direct', 1)
+        except (json.JSONDecodeError, RecursionError):
+            pass
+
+    decode = _DECODER.raw_decode
+    spans: List[Tuple[int, int]] = []
+    parsed: Dict[int, Any] = {}
+    failures = 0
+    first_error: Optional[Tuple[str, int]] = None
+    i = start
+    while i != -1:
+        try:
+            value, end = decode(text, i)
+        except json.JSONDecodeError as e:
+            if first_error is None:
+                first_error = (e.msg, e.pos)
+            failures += 1
+            if failures > _MAX_DECODE_FAILURES:
+                break
+            i = text.find('{', i + 1)
+            continue
+        except RecursionError:
+            # Lồng quá sâu cho decoder đệ quy: chuyển ngay sang scanner
+            if first_error is None:
+                first_error = ('Nesting too deep', i)
+            break
+        if isinstance(value, dict):
+            spans.append((i, end))
+            parsed[i] = value
+        i = text.find('{', end)
+
+    if i != -1:
+        # Quá nhiều lần decode lỗi: phần còn lại quét bằng scanner một lượt
+        scanner = JsonObjectScanner()
+        scanner.feed(text[i:])
+        spans.extend((i + s, i + e) for s, e in scanner.spans)
+
+    result = _pick_candidate(text, spans, required_keys, parsed, method='decode')
+    if not result and first_error is not None and result.error_pos == -1:
+        result.error = f'Invalid JSON: {first_error[0]}'
+        result.error_pos = first_error[1]
+    return result
@@ -1,56 +1,207 @@
 import json
-import boto3
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, Callable, Iterator, List, Optional, Tuple, Union
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from result_cache import canonical_diagram, make_cache_key, create_tiered_cache
+from retrieval_cache import INVALIDATE_ACTION, create_retrieval_cache, invalidation_allowed
+from context_assembly import create_context_assembler
+from multi_query import MultiQueryRetriever, build_sub_queries
+from local_retrieval import create_retriever
+from circuit_breaker import CircuitOpenError, create_circuit_breaker
+from single_flight import SingleFlight
+from structured_log import Payload, copy_log_context, get_logger, logged_handler
+from aws_clients import LazyClient, get_client, is_warmup_event, warm_up
+from request_metrics import increment, instrumented_handler, set_property, set_value, span, timings
+from json_stream import TopLevelSectionParser, extract_json_object
+from diagram_graph import DiagramGraph, as_graph
+from diagram_encoding import DIAGRAM_FORMATS, encoding_details, render_diagram_for_prompt
+from diagram_diff import DiagramDiff, diff_diagrams
+from model_routing import ModelRoute, analysis_failure, create_model_router
+from deadlines import (
+    DEADLINE_RETRIEVAL_SHARE, DeadlineExceeded, call_with_deadline, current_deadline, deadline_handler,
+    deadline_summary, hedged_call, record_skip, remaining_time
+)
+from analysis_jobs import (
+    JobRunner, create_job_store, new_job_record, STATUS_PROCESSING, STATUS_COMPLETED, STATUS_FAILED
+)
 
 # --- KHỞI TẠO CLIENTS BÊN NGOÀI HANDLER ĐỂ TÁI SỬ DỤNG (BEST PRACTICE) ---
-bedrock_runtime = boto3.client('bedrock-runtime', region_name='us-east-1')
-bedrock_agent = boto3.client('bedrock-agent-runtime', region_name='us-east-1')
+# Client dùng chung, tạo lười ở lần gọi đầu tiên (pool / timeout / retry: xem aws_clients.py)
+bedrock_runtime = LazyClient('bedrock-runtime')
+bedrock_agent = LazyClient('bedrock-agent-runtime')
 kb_id = os.environ.get('KNOWLEDGE_BASE_ID', 'YOUR-KB-ID')
+logger = get_logger('analysis')
 
+# Cache kết quả truy xuất KB (cấu hình qua RETRIEVAL_CACHE_*), dùng lại giữa các lần gọi warm
+retrieval_cache = create_retrieval_cache()
+context_assembler = create_context_assembler()
+# 'single': một query gộp (như cũ). 'multi': vài query tập trung chạy song song, trộn bằng RRF
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'single')
+RETRIEVAL_MAX_SUBQUERIES = int(os.environ.get('RETRIEVAL_MAX_SUBQUERIES', 4))
+multi_query_retriever = MultiQueryRetriever(max_workers=int(os.environ.get('RETRIEVAL_MAX_WORKERS', 8)))
+# Cấu hình làm thay đổi kết quả truy xuất đã lắp ráp => một phần của key cache truy xuất
+# Nguồn truy xuất (RETRIEVER=bedrock | local | bedrock+local, xem local_retrieval.py)
+knowledge_retriever = create_retriever(kb_id, lambda: bedrock_agent)
+# Circuit breaker của Knowledge Base (dùng chung trong process với retriever, cấu hình qua KB_BREAKER_*)
+kb_breaker = create_circuit_breaker('KB')
+# Context dự phòng khi truy xuất lỗi / mạch đang mở; phân tích dựa trên nó không được cache
+RETRIEVAL_ERROR_CONTEXT = "Lỗi truy xuất Knowledge Base. Sử dụng kiến thức cơ bản để phân tích."
+RETRIEVAL_CACHE_VARIANT = {**context_assembler.signature, 'mode': RETRIEVAL_MODE, 'retriever': knowledge_retriever.name}
 
+# Chọn tier model + max_tokens theo độ phức tạp của sơ đồ (cấu hình qua MODEL_ROUTING_*, xem model_routing.py)
+model_router = create_model_router()
+# Tăng giá trị này mỗi khi sửa prompt/schema để cache cũ tự động bị bỏ qua
+ANALYSIS_PROMPT_VERSION = 'analysis-v1'
+# Thứ tự các section cấp 1 trong schema phân tích (cũng là thứ tự phát khi stream)
+ANALYSIS_SECTIONS = ('overview', 'components', 'execution', 'evaluation', 'improvement', 'summary')
+# Định dạng sơ đồ mặc định trong prompt: 'json' (như cũ) hoặc 'compact' (xem diagram_encoding.py)
+ANALYSIS_DIAGRAM_FORMAT = os.environ.get('ANALYSIS_DIAGRAM_FORMAT', 'json')
+
+# Hết thời gian của request trước khi truy xuất / model trả về (xem deadlines.py)
+RETRIEVAL_SKIPPED_CONTEXT = "Bỏ qua truy xuất Knowledge Base do hết thời gian xử lý. Sử dụng kiến thức cơ bản để phân tích."
+DEADLINE_ANALYSIS_TEXT = "Hết thời gian xử lý trước khi mô hình trả về kết quả. Vui lòng thử lại."
+
+# Phân tích lại tăng dần: nếu tỉ lệ node/edge thay đổi vượt ngưỡng này thì phân tích lại từ đầu
+ANALYSIS_INCREMENTAL_MAX_CHANGE_RATIO = float(os.environ.get('ANALYSIS_INCREMENTAL_MAX_CHANGE_RATIO', 0.5))
+
+# Cache kết quả phân tích: LRU trong process + SQLite trong /tmp (cấu hình qua ANALYSIS_CACHE_*)
+analysis_cache = create_tiered_cache('ANALYSIS', default_max_entries=64, default_ttl=6 * 3600)
+# Request giống hệt (cùng key cache) đến khi một request khác đang phân tích => chờ và dùng chung kết quả
+ANALYSIS_COALESCE = os.environ.get('ANALYSIS_COALESCE', 'true').lower() == 'true'
+analysis_flight = SingleFlight('analysis')
+
+# Trả block `metadata.timings` (thời gian từng chặng + bộ đếm) cho mọi request; từng request
+# cũng có thể tự bật bằng `"includeTimings": true`. Metric EMF luôn được ghi ra log (METRICS_ENABLED).
+ANALYSIS_RESPONSE_TIMINGS = os.environ.get('ANALYSIS_RESPONSE_TIMINGS', 'false').lower() == 'true'
+
+# --- CẤU HÌNH JOB BẤT ĐỒNG BỘ ---
+# ANALYSIS_DEFAULT_MODE=async để mọi request không chỉ định `mode` đều chạy theo kiểu submit/poll
+ANALYSIS_DEFAULT_MODE = os.environ.get('ANALYSIS_DEFAULT_MODE', 'sync')
+ANALYSIS_JOB_TTL_SECONDS = float(os.environ.get('ANALYSIS_JOB_TTL_SECONDS', 3600))
+# 'thread': pool trong process (local / server chạy lâu). 'lambda': tự gọi Lambda dạng Event,
+# bắt buộc dùng store chia sẻ (ANALYSIS_JOB_STORE=dynamodb) vì worker chạy ở môi trường khác.
+ANALYSIS_JOB_EXECUTOR = os.environ.get(
+    'ANALYSIS_JOB_EXECUTOR',
+    'lambda' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') and os.environ.get('ANALYSIS_JOB_STORE') == 'dynamodb' else 'thread'
+)
+analysis_job_store = create_job_store()
+analysis_job_runner = JobRunner(max_workers=int(os.environ.get('ANALYSIS_JOB_MAX_WORKERS', 4)))
+# Trên Lambda, store memory / sqlite nằm trong /tmp của riêng một container và thread worker bị đóng băng
+# ngay sau khi trả 202 => job không bao giờ xong, poll từ container khác thì 404. Từ chối mode=async
+# thay vì trả về một jobId không bao giờ poll được.
+ANALYSIS_ASYNC_UNAVAILABLE = None
+if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+    if not analysis_job_store.shared:
+        ANALYSIS_ASYNC_UNAVAILABLE = 'mode=async requires a shared job store on Lambda (set ANALYSIS_JOB_STORE=dynamodb and ANALYSIS_JOB_TABLE)'
+    elif ANALYSIS_JOB_EXECUTOR != 'lambda':
+        ANALYSIS_ASYNC_UNAVAILABLE = 'mode=async on Lambda requires ANALYSIS_JOB_EXECUTOR=lambda'
+    if ANALYSIS_ASYNC_UNAVAILABLE:
+        logger.warning('async analysis disabled', reason=ANALYSIS_ASYNC_UNAVAILABLE)
+
+# --- CẤU HÌNH BATCH ---
+ANALYSIS_BATCH_MAX_ITEMS = int(os.environ.get('ANALYSIS_BATCH_MAX_ITEMS', 50))
+ANALYSIS_BATCH_CONCURRENCY = int(os.environ.get('ANALYSIS_BATCH_CONCURRENCY', 4))
+ANALYSIS_BATCH_MAX_CONCURRENCY = int(os.environ.get('ANALYSIS_BATCH_MAX_CONCURRENCY', 16))
+
+
+@logged_handler(logger)
+@instrumented_handler('analysis')
+@deadline_handler
 def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     """
     Analyze diagram using RAG with Knowledge Base, now with document filtering.
+    Also serves async jobs: mode=async submits a job, GET .../analysis-status/{jobId} polls it.
     """
-    print("--- LAMBDA INPUT (RAW EVENT) ---")
-    print(json.dumps(event, indent=2, ensure_ascii=False))
+    # Ping giữ ấm: khởi tạo sẵn client, cache và thread pool rồi trả về, không gọi model
+    if is_warmup_event(event):
+        set_property('mode', 'warmup')
+        return {'statusCode': 200, 'body': json.dumps(warm_up(
+            ['bedrock-runtime', 'bedrock-agent-runtime'],
+            {'analysis_cache': analysis_cache.stats, 'retrieval_cache': retrieval_cache.stats,
+             'retrieval_pool': multi_query_retriever.warm}
+        ))}
+
+    # GET /analysis-status/{jobId}: API Gateway gửi jobId qua pathParameters, không có body
+    status_job_id = (event.get('pathParameters') or {}).get('jobId')
+    if status_job_id:
+        return get_analysis_job_status(status_job_id)
+
+    # Worker bất đồng bộ (Lambda tự gọi chính nó với InvocationType=Event)
+    if event.get('action') == 'runAnalysisJob':
+        run_analysis_job(event['jobId'], event['payload'])
+        return {'statusCode': 200, 'body': json.dumps({'success': True, 'jobId': event['jobId']})}
+
     try:
         # Nhất quán hóa việc xử lý body để hoạt động với cả API Gateway và Test Console
-        if isinstance(event.get('body'), str):
-            body = json.loads(event['body'])
-        else:
-            body = event.get('body', event)
+        with span('parse'):
+            if isinstance(event.get('body'), str):
+                body = json.loads(event['body'])
+            else:
+                body = event.get('body', event)
 
-        diagram_json = body.get('diagram', {})
-        user_question = body.get('question', 'Hãy phân tích sơ đồ này')
-        
-        # === THAY ĐỔI 1: NHẬN THÊM MẢNG `selectedDocumentIds` TỪ INPUT ===
-        # Nếu không có key này, nó sẽ mặc định là một mảng rỗng, đảm bảo tính tương thích ngược.
-        selected_document_ids = body.get('selectedDocumentIds', [])
+        # Pipeline ingest gọi action này sau khi tài liệu được nạp lại vào Knowledge Base
+        # (gọi trực tiếp Lambda bằng IAM; qua HTTP phải kèm X-Invalidation-Token)
+        if body.get('action') == INVALIDATE_ACTION:
+            if not invalidation_allowed(event):
+                return create_error_response(403, 'Retrieval cache invalidation is not allowed on this route')
+            retrieval_cache.invalidate_documents(body.get('documentIds', []))
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True, 'invalidated': body.get('documentIds', [])}, ensure_ascii=False)
+            }
+
+        # Batch: nhiều sơ đồ/câu hỏi trong một request, chạy song song có giới hạn
+        if 'items' in body:
+            set_property('mode', 'batch')
+            return handle_batch_analysis(body)
+
+        request = parse_analysis_request(body)
+        # stream=true: trả về từng section dưới dạng server-sent events thay vì một JSON duy nhất
+        stream = bool(body.get('stream', False))
+        # mode=async: trả jobId ngay, client poll qua endpoint analysis-status
+        async_mode = body.get('mode', ANALYSIS_DEFAULT_MODE) == 'async'
+        set_property('mode', 'async' if async_mode else 'stream' if stream else 'sync')
         
-        if not diagram_json:
+        if not request['diagram']:
             return create_error_response(400, 'Diagram data is required')
+        if request['diagramFormat'] not in DIAGRAM_FORMATS:
+            return create_error_response(400, f"diagramFormat must be one of {list(DIAGRAM_FORMATS)}")
 
     except Exception as e:
         return create_error_response(400, f'Invalid input format: {str(e)}')
 
     try:
-        # Step 1: Truy xuất context, truyền thêm `selected_document_ids` để lọc
-        context, sources = retrieve_from_knowledge_base_with_sources(
-            diagram_json,
-            user_question,
-            selected_document_ids
-        )
+        # Step 0: Tra cache theo hash chuẩn hóa của (sơ đồ, câu hỏi, tài liệu, model, prompt)
+        cache_key = build_analysis_cache_key(request)
 
-        # Step 2: Phân tích với Claude, sử dụng context đã được lọc và sources đã được làm giàu
-        analysis = analyze_with_claude_structured(
-            bedrock_runtime,
-            diagram_json,
-            user_question,
-            context,
-            sources
-        )
+        if async_mode:
+            if ANALYSIS_ASYNC_UNAVAILABLE:
+                return create_error_response(501, ANALYSIS_ASYNC_UNAVAILABLE)
+            return submit_analysis_job(cache_key, request)
+
+        cached, cache_tier = lookup_analysis_cache(request, cache_key)
+
+        if stream:
+            events = iter_analysis_events(request, cache_key, cached, cache_tier)
+            stream_headers = {
+                'Content-Type': 'text/event-stream; charset=utf-8',
+                'Cache-Control': 'no-cache',
+                'Access-Control-Allow-Origin': '*'
+            }
+            # Host hỗ trợ streaming (context.open_response_stream, xem http_service.py) => gửi từng
+            # section ngay khi có; Lambda (buffered) gộp toàn bộ event vào một body.
+            open_stream = getattr(context, 'open_response_stream', None)
+            write = open_stream(200, stream_headers) if callable(open_stream) else None
+            if write is not None:
+                for frame in events:
+                    write(frame)
+                return {'statusCode': 200, 'headers': stream_headers, 'body': None}
+            return {'statusCode': 200, 'headers': stream_headers, 'body': ''.join(events)}
+
+        result = perform_analysis(request, cache_key, cached, cache_tier)
 
         return {
             'statusCode': 200,
@@ -58,28 +209,446 @@ def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps({
-                'success': True,
-                'analysis': analysis,
-                'sources': sources, # `sources` giờ đã chứa thông tin chi tiết hơn
-                'metadata': {
-                    'context_sources': len(sources), # Giờ đếm theo số source thật
-                    'diagram_complexity': calculate_complexity(diagram_json),
-                    'question': user_question,
-                    'is_filtered': bool(selected_document_ids) # Thêm metadata cho biết có lọc hay không
-                }
-            }, ensure_ascii=False)
+            'body': json.dumps(result, ensure_ascii=False)
         }
 
     except Exception as e:
         return create_error_response(500, f'Analysis error: {str(e)}')
 
-def retrieve_from_knowledge_base_with_sources(diagram_json: Dict, question: str, selected_document_ids: List[str]) -> Tuple[str, List[Dict]]:
-    diagram_summary = create_diagram_summary(diagram_json)
-    
+def parse_analysis_request(body: Dict) -> Dict:
+    """
+    Normalize an analysis request body; the same dict is used as the async job payload.
+    Raises ValueError for a diagram that is not an object with list-valued nodes/edges.
+    """
+    diagram = body.get('diagram', {})
+    # Key cache (canonical_diagram) và đồ thị đều cần object => lỗi 400 thay vì 500 ở bước sau
+    if diagram and not isinstance(diagram, dict):
+        raise ValueError('diagram must be an object')
+    if diagram and any(not isinstance(diagram.get(key, []), list) for key in ('nodes', 'edges')):
+        raise ValueError('diagram nodes and edges must be lists')
+    return {
+        'diagram': diagram,
+        'question': body.get('question', 'Hãy phân tích sơ đồ này'),
+        # === THAY ĐỔI 1: NHẬN THÊM MẢNG `selectedDocumentIds` TỪ INPUT ===
+        # Nếu không có key này, nó sẽ mặc định là một mảng rỗng, đảm bảo tính tương thích ngược.
+        'selectedDocumentIds': body.get('selectedDocumentIds', []),
+        'useCache': body.get('useCache', True),
+        # 'json' (mặc định, như cũ) hoặc 'compact' (DSL gọn, ít token hơn)
+        'diagramFormat': body.get('diagramFormat', ANALYSIS_DIAGRAM_FORMAT),
+        # analysis_id của lần phân tích trước (metadata.analysis_id) => chỉ phân tích lại phần bị ảnh hưởng
+        'previousAnalysisId': body.get('previousAnalysisId'),
+        # Thêm metadata.timings vào response (không ảnh hưởng key cache)
+        'includeTimings': bool(body.get('includeTimings', ANALYSIS_RESPONSE_TIMINGS))
+    }
+
+def lookup_analysis_cache(request: Dict, cache_key: str) -> Tuple[Any, Any]:
+    """(cached entry, tier) or (None, None); skipped when the request disables the cache"""
+    if not request['useCache']:
+        return None, None
+    with span('analysis_cache'):
+        cached, cache_tier = analysis_cache.get(cache_key)
+    increment('analysis_cache_hit' if cached is not None else 'analysis_cache_miss')
+    return cached, cache_tier
+
+def perform_analysis(request: Dict, cache_key: str, cached: Any = None, cache_tier: Any = None,
+                     on_section: Optional[Callable[[str, Any], None]] = None,
+                     retrieve_fn: Optional[Callable[[Any, str, List[str]], Tuple[str, List[Dict], bool]]] = None) -> Dict:
+    """
+    Run (or serve from cache) one analysis and build the response payload.
+    When `on_section` is given the model is streamed and each finished section is reported to it.
+    `retrieve_fn` overrides the retrieval step (batch mode uses it to share identical retrievals).
+    Identical blocking analyses already running in this process are joined instead of repeated.
+    """
+    # Dựng đồ thị một lần, dùng chung cho query truy xuất, prompt và metadata
+    graph = as_graph(request['diagram'])
+
+    def compute() -> Dict:
+        if request['useCache']:
+            # Một request giống hệt có thể vừa xong giữa lần tra cache của request này và lúc vào single-flight
+            late, _ = analysis_cache.get(cache_key)
+            if late is not None:
+                increment('analysis_cache_late_hit')
+                return late
+        for kind, value in run_analysis_pipeline(request, graph, cache_key, on_section is not None, retrieve_fn):
+            if kind == 'section' and on_section is not None:
+                on_section(*value)
+            elif kind == 'done':
+                return value
+
+    entry = cached
+    coalesced = False
+    if entry is None:
+        if on_section is None and ANALYSIS_COALESCE:
+            # Metadata (timings, deadline...) vẫn dựng riêng cho từng request bên dưới
+            try:
+                entry, coalesced = analysis_flight.do(cache_key, compute, timeout=remaining_time())
+            except TimeoutError:
+                # Request dẫn đầu chưa xong trong thời gian còn lại của request này: trả kết quả dự phòng
+                record_skip('coalesced_wait')
+                entry, coalesced = {'analysis': create_fallback_structure(DEADLINE_ANALYSIS_TEXT),
+                                    'sources': [], 'complete': False}, True
+            else:
+                if coalesced and not entry.get('complete', True):
+                    # Kết quả dùng chung bị cắt ngắn => metadata.deadline của request này cũng phải báo partial
+                    for stage in entry.get('deadline_skipped') or []:
+                        record_skip(stage)
+        else:
+            entry = compute()
+
+    return {
+        'success': True,
+        'analysis': entry['analysis'],
+        'sources': entry['sources'], # `sources` giờ đã chứa thông tin chi tiết hơn
+        'metadata': build_analysis_metadata(request, graph, cache_key, entry, cached, cache_tier, coalesced)
+    }
+
+def run_analysis_pipeline(request: Dict, graph: DiagramGraph, cache_key: str, stream: bool,
+                          retrieve_fn: Optional[Callable[[Any, str, List[str]], Tuple[str, List[Dict], bool]]] = None
+                          ) -> Iterator[Tuple[str, Any]]:
+    """
+    Cache-miss path shared by the blocking, streaming and job modes.
+    Yields ('sources', sources), then ('section', (name, value)) for each section as it becomes
+    available (only when `stream` or revising incrementally), then ('done', cache_entry).
+    """
+    user_question = request['question']
+    previous, diff, incremental = plan_incremental_analysis(request, graph)
+    diagram_text, encoding_info = render_diagram_for_prompt(graph, request['diagramFormat'])
+    complete = True
+
+    if incremental and incremental['applied']:
+        # Dùng lại context/sources của lần phân tích trước, chỉ viết lại các section bị ảnh hưởng
+        sources = previous['sources']
+        context = previous.get('context') or build_context_from_sources(sources)
+        yield 'sources', sources
+
+        route = route_analysis(graph, user_question, context)
+        revised = revise_analysis_sections(
+            bedrock_runtime, graph.raw, user_question, context, sources,
+            previous['analysis'], diff, incremental['revised_sections'], diagram_text, route
+        ) if incremental['revised_sections'] else {}
+        incremental['unrevised_sections'] = [s for s in incremental['revised_sections'] if s not in revised]
+        complete = not incremental['unrevised_sections']
+        analysis = {**previous['analysis'], **revised}
+        for section in ANALYSIS_SECTIONS:
+            if section in analysis:
+                yield 'section', (section, analysis[section])
+    else:
+        # Step 1: Truy xuất context, truyền thêm `selected_document_ids` để lọc
+        # Truy xuất chỉ được một phần thời gian còn lại của request; quá hạn => phân tích không có context
+        retrieve = retrieve_fn or retrieve_from_knowledge_base_with_sources
+        try:
+            context, sources, complete = call_with_deadline(
+                lambda: retrieve(graph, user_question, request['selectedDocumentIds']),
+                'retrieval',
+                remaining_time(DEADLINE_RETRIEVAL_SHARE)
+            )
+        except DeadlineExceeded:
+            record_skip('retrieval')
+            context, sources, complete = RETRIEVAL_SKIPPED_CONTEXT, [], False
+        # Context dự phòng / thiếu (hết giờ, KB lỗi, mạch mở, sub-query lỗi) => kết quả không được cache
+        yield 'sources', sources
+
+        # Step 2: Phân tích với Claude, sử dụng context đã được lọc và sources đã được làm giàu
+        # Tier model + ngân sách output theo độ phức tạp sơ đồ và độ dài input
+        route = route_analysis(graph, user_question, context)
+        if not stream:
+            analysis, route = analyze_with_claude_structured(
+                bedrock_runtime,
+                graph.raw,
+                user_question,
+                context,
+                sources,
+                diagram_text=diagram_text,
+                route=route
+            )
+        else:
+            analysis = {}
+            for section, value in stream_analysis_sections(bedrock_runtime, graph.raw, user_question, context, sources,
+                                                           diagram_text=diagram_text, route=route):
+                if section == '__complete__':
+                    analysis = value
+                else:
+                    yield 'section', (section, value)
+        # Không cache kết quả fallback / thiếu context để lần sau còn cơ hội nhận kết quả đầy đủ
+        complete = complete and 'detailed_analysis' not in analysis
+
+    selected_document_ids = sorted(str(doc_id) for doc_id in request['selectedDocumentIds'] or [])
+    deadline = current_deadline()
+    entry = {
+        'analysis': analysis,
+        'sources': sources,
+        'context': context,
+        'diagram_encoding': encoding_info,
+        'incremental': incremental,
+        'route': route.as_dict(),
+        # Phục vụ phân tích lại tăng dần khi client gửi analysis_id này làm previousAnalysisId
+        'diagram': canonical_diagram(graph.raw),
+        'question': (user_question or '').strip(),
+        'selectedDocumentIds': selected_document_ids,
+        'generations': retrieval_cache.generations(selected_document_ids),
+        # False = context dự phòng / thiếu section; các request gộp vào (single-flight) dựa vào đây để báo partial
+        'complete': complete,
+        'deadline_skipped': list(deadline.skipped) if deadline is not None else []
+    }
+    if request['useCache'] and complete:
+        analysis_cache.set(cache_key, entry)
+    yield 'done', entry
+
+def plan_incremental_analysis(request: Dict, graph: DiagramGraph) -> Tuple[Optional[Dict], Optional[DiagramDiff], Optional[Dict]]:
+    """
+    Decide whether this request can revise a previous analysis instead of starting over.
+    Returns (previous cache entry, diff, info); info is None when no previousAnalysisId was sent,
+    and info['applied'] is False with a 'reason' when a full analysis is needed.
+    """
+    previous_id = request.get('previousAnalysisId')
+    if not previous_id:
+        return None, None, None
+    info: Dict[str, Any] = {'previous_analysis_id': previous_id, 'applied': False}
+
+    previous, _ = analysis_cache.get(str(previous_id))
+    selected_document_ids = sorted(str(doc_id) for doc_id in request['selectedDocumentIds'] or [])
+    if previous is None or 'diagram' not in previous:
+        info['reason'] = 'previous analysis not found or expired'
+    elif previous['question'] != (request['question'] or '').strip() or previous['selectedDocumentIds'] != selected_document_ids:
+        info['reason'] = 'question or selected documents changed'
+    elif previous['generations'] != retrieval_cache.generations(selected_document_ids):
+        info['reason'] = 'selected documents were re-ingested'
+    else:
+        diff = diff_diagrams(previous['diagram'], graph)
+        info['changes'] = diff.summary()
+        if diff.change_ratio > ANALYSIS_INCREMENTAL_MAX_CHANGE_RATIO:
+            info['reason'] = f'too many changes ({diff.change_ratio:.0%} of the diagram)'
+        else:
+            info['applied'] = True
+            info['revised_sections'] = diff.affected_sections(ANALYSIS_SECTIONS)
+            info['reused_sections'] = [s for s in ANALYSIS_SECTIONS if s not in info['revised_sections']]
+            return previous, diff, info
+    return None, None, info
+
+def build_analysis_metadata(request: Dict, graph: DiagramGraph, cache_key: str, entry: Dict,
+                            cached: Any, cache_tier: Any, coalesced: bool = False) -> Dict:
+    return {
+        # Gửi lại giá trị này trong `previousAnalysisId` để phân tích lại tăng dần sau khi sửa sơ đồ
+        'analysis_id': cache_key,
+        'context_sources': len(entry['sources']), # Giờ đếm theo số source thật
+        'diagram_complexity': calculate_complexity(graph),
+        'question': request['question'],
+        'is_filtered': bool(request['selectedDocumentIds']), # Thêm metadata cho biết có lọc hay không
+        # node_aliases (compact) luôn có; bản JSON gốc để so sánh chỉ khi includeTimings (phải serialize cả sơ đồ)
+        'diagram_encoding': (encoding_details(graph, entry.get('diagram_encoding')) if request.get('includeTimings')
+                             else entry.get('diagram_encoding')),
+        # Tier model / max_tokens đã dùng (kể cả các lần nâng tier khi output không đạt)
+        'route': entry.get('route'),
+        'incremental': entry.get('incremental') if cached is None else None,
+        'cache': {
+            'hit': cached is not None,
+            'tier': cache_tier,
+            **analysis_cache.stats()
+        },
+        # True = kết quả của một request giống hệt đang chạy cùng lúc (không gọi lại KB / model)
+        'coalesced': coalesced,
+        'retrieval_cache': retrieval_cache.stats(),
+        # Trạng thái circuit breaker của Knowledge Base (closed / open / half_open)
+        'kb_breaker': kb_breaker.snapshot(),
+        # Ngân sách thời gian của request; `partial` = có chặng bị bỏ qua / cắt ngắn vì hết giờ
+        'deadline': deadline_summary(),
+        **({'timings': timings()} if request.get('includeTimings') else {})
+    }
+
+# --- BATCH MODE ---
+
+def handle_batch_analysis(body: Dict) -> Dict:
+    """
+    Analyze `items` ([{diagram, question?, selectedDocumentIds?, diagramFormat?}]) concurrently.
+    Results come back in input order; one failing item does not fail the batch.
+    """
+    items = body.get('items')
+    if not isinstance(items, list) or not items:
+        return create_error_response(400, 'items must be a non-empty list')
+    if len(items) > ANALYSIS_BATCH_MAX_ITEMS:
+        return create_error_response(400, f'Batch too large: {len(items)} items (max {ANALYSIS_BATCH_MAX_ITEMS})')
+
+    try:
+        concurrency = int(body.get('concurrency', ANALYSIS_BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return create_error_response(400, 'concurrency must be an integer')
+    concurrency = max(1, min(concurrency, ANALYSIS_BATCH_MAX_CONCURRENCY))
+
+    # Các tùy chọn cấp batch làm mặc định cho từng item
+    defaults = {key: body[key] for key in ('useCache', 'diagramFormat', 'selectedDocumentIds') if key in body}
+    results = run_batch_analysis(items, concurrency, defaults)
+    succeeded = sum(1 for r in results if r['success'])
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({
+            'success': succeeded == len(results),
+            'results': results,
+            'metadata': {
+                'items': len(results),
+                'succeeded': succeeded,
+                'failed': len(results) - succeeded,
+                'concurrency': concurrency
+            }
+        }, ensure_ascii=False)
+    }
+
+def run_batch_analysis(items: List[Dict], concurrency: int, defaults: Dict) -> List[Dict]:
+    """Run items on a bounded pool; identical retrieval queries and identical analyses execute once"""
+    # Gộp trong phạm vi batch: item trùng đến sau khi item đầu đã xong vẫn nhận cùng kết quả
+    shared: Dict[str, Future] = {}
+    shared_lock = threading.Lock()
+
+    def single_flight(key: str, fn: Callable[[], Any]) -> Any:
+        # Item đầu tiên với key này thực thi; các item trùng chờ cùng một Future
+        with shared_lock:
+            future = shared.get(key)
+            owner = future is None
+            if owner:
+                future = shared[key] = Future()
+        if owner:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def shared_retrieval(diagram_json: Union[Dict, DiagramGraph], question: str, selected_document_ids: List[str]) -> Tuple[str, List[Dict], bool]:
+        filter_dict = build_retrieval_config(selected_document_ids)['vectorSearchConfiguration'].get('filter')
+        key = 'retrieval:' + retrieval_cache.build_key('\n'.join(build_retrieval_queries(diagram_json, question)),
+                                                        filter_dict, kb_id, RETRIEVAL_CACHE_VARIANT)
+        return single_flight(key, lambda: retrieve_from_knowledge_base_with_sources(diagram_json, question, selected_document_ids))
+
+    def run_item(index: int, item: Any) -> Dict:
+        try:
+            if not isinstance(item, dict) or not item.get('diagram'):
+                raise ValueError('Diagram data is required')
+            request = parse_analysis_request({**defaults, **item})
+            if request['diagramFormat'] not in DIAGRAM_FORMATS:
+                raise ValueError(f"diagramFormat must be one of {list(DIAGRAM_FORMATS)}")
+            cache_key = build_analysis_cache_key(request)
+
+            def compute() -> Dict:
+                cached, cache_tier = lookup_analysis_cache(request, cache_key)
+                return perform_analysis(request, cache_key, cached, cache_tier, retrieve_fn=shared_retrieval)
+
+            return {'index': index, **single_flight('analysis:' + cache_key, compute)}
+        except Exception as e:
+            return {'index': index, 'success': False, 'error': f'Analysis error: {str(e)}'}
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='analysis-batch') as pool:
+        # Mỗi item chạy trong bản sao log context của request (request_id, level debug)
+        futures = [pool.submit(copy_log_context().run, run_item, i, item) for i, item in enumerate(items)]
+        return [f.result() for f in futures]
+
+# --- JOB MODE: SUBMIT / POLL ---
+
+def submit_analysis_job(cache_key: str, payload: Dict) -> Dict:
+    """Create (or reuse) a job for this request and start it; returns immediately with the job ID"""
+    # Job ID suy ra từ hash nội dung => các lần submit trùng lặp dùng chung một job
+    job_id = cache_key[:32]
+    created = analysis_job_store.create(new_job_record(job_id, ANALYSIS_JOB_TTL_SECONDS))
+    if created:
+        if ANALYSIS_JOB_EXECUTOR == 'lambda':
+            get_client('lambda').invoke(
+                FunctionName=os.environ['AWS_LAMBDA_FUNCTION_NAME'],
+                InvocationType='Event',
+                Payload=json.dumps({'action': 'runAnalysisJob', 'jobId': job_id, 'payload': payload}, ensure_ascii=False).encode('utf-8')
+            )
+        else:
+            analysis_job_runner.submit(run_analysis_job, job_id, payload)
+        status = STATUS_PROCESSING
+    else:
+        existing = analysis_job_store.get(job_id)
+        status = existing['status'] if existing else STATUS_PROCESSING
+
+    return {
+        'statusCode': 202,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'jobId': job_id, 'status': status, 'deduplicated': not created}, ensure_ascii=False)
+    }
+
+def run_analysis_job(job_id: str, payload: Dict) -> None:
+    """Worker body: retrieval + streamed analysis, recording partial sections in the job store"""
+    partial = {}
+
+    def record_section(section: str, value: Any) -> None:
+        partial[section] = value
+        analysis_job_store.update(job_id, {'partial': dict(partial)})
+
+    try:
+        request = parse_analysis_request(payload)
+        cache_key = build_analysis_cache_key(request)
+        cached, cache_tier = lookup_analysis_cache(request, cache_key)
+
+        result = perform_analysis(request, cache_key, cached, cache_tier, on_section=record_section)
+        analysis_job_store.update(job_id, {'status': STATUS_COMPLETED, 'result': result})
+    except Exception as e:
+        logger.error('analysis job failed', job_id=job_id, error=str(e))
+        analysis_job_store.update(job_id, {'status': STATUS_FAILED, 'error': f'Analysis error: {str(e)}'})
+
+def get_analysis_job_status(job_id: str) -> Dict:
+    """Shape matches StatusResponse on the frontend (jobId, status, result?, error?)"""
+    record = analysis_job_store.get(job_id)
+    if record is None:
+        return create_error_response(404, 'Job không tồn tại hoặc đã hết hạn')
+
+    status_body = {'jobId': job_id, 'status': record['status']}
+    if record['status'] == STATUS_COMPLETED:
+        status_body['result'] = record['result']
+    elif record['status'] == STATUS_FAILED:
+        status_body['error'] = record['error']
+    else:
+        status_body['partial'] = record['partial']
+
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(status_body, ensure_ascii=False)
+    }
+
+def format_sse_event(event: str, data: Any) -> str:
+    """Serialize one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def iter_analysis_events(request: Dict, cache_key: str, cached: Any, cache_tier: Any) -> Iterator[str]:
+    """
+    Yield SSE events for a streaming analysis: `sources`, one `section` per analysis section
+    as soon as it is complete, then `done` with the metadata block (or `error`).
+    """
+    try:
+        graph = as_graph(request['diagram'])
+        entry = cached
+        if cached is not None:
+            yield format_sse_event('sources', cached['sources'])
+            for section in ANALYSIS_SECTIONS:
+                if section in cached['analysis']:
+                    yield format_sse_event('section', {'name': section, 'value': cached['analysis'][section]})
+        else:
+            for kind, value in run_analysis_pipeline(request, graph, cache_key, stream=True):
+                if kind == 'sources':
+                    yield format_sse_event('sources', value)
+                elif kind == 'section':
+                    yield format_sse_event('section', {'name': value[0], 'value': value[1]})
+                else:
+                    entry = value
+
+        yield format_sse_event('done', {
+            'success': True,
+            'metadata': {
+                **build_analysis_metadata(request, graph, cache_key, entry, cached, cache_tier),
+                'streamed': True
+            }
+        })
+    except Exception as e:
+        yield format_sse_event('error', {'success': False, 'error': f'Analysis error: {str(e)}'})
+
+def build_retrieval_query(diagram_json: Union[Dict, DiagramGraph], question: str) -> str:
+    """Retrieval query built from the user's question and the diagram's node labels"""
     # --- THAY ĐỔI CÁCH TẠO QUERY ---
     # Trích xuất các thực thể chính từ sơ đồ để làm giàu query
-    node_labels = [node.get('data', {}).get('label', '') for node in diagram_json.get('nodes', [])]
+    node_labels = [str(label) for label in as_graph(diagram_json).labels('')]
     keywords_from_diagram = ", ".join(node_labels)
 
     # Tạo query mới, tập trung vào câu hỏi của người dùng và các từ khóa cụ thể
@@ -89,14 +658,25 @@ def retrieve_from_knowledge_base_with_sources(diagram_json: Dict, question: str,
     {keywords_from_diagram}, mở tài khoản ngân hàng, xác minh danh tính khách hàng, KYC, eKYC, rủi ro gian lận, trải nghiệm khách hàng online.
     """
     # ===============================
+    return query
 
-    print("--- NEW RETRIEVAL QUERY ---")
-    print(query)
-    
+def build_retrieval_queries(diagram_json: Union[Dict, DiagramGraph], question: str) -> List[str]:
+    """One combined query, or focused sub-queries (question / node clusters / rule fields) in multi mode"""
+    if RETRIEVAL_MODE == 'multi':
+        return build_sub_queries(diagram_json, question, RETRIEVAL_MAX_SUBQUERIES)
+    return [build_retrieval_query(diagram_json, question)]
+
+def build_rerank_text(diagram_json: Union[Dict, DiagramGraph], question: str) -> str:
+    """Text the retrieved chunks are lexically reranked against: the question plus node labels"""
+    return ' '.join([question or ''] + [str(label) for label in as_graph(diagram_json).labels('')])
+
+def build_retrieval_config(selected_document_ids: List[str]) -> Dict:
+    """Knowledge Base retrieval configuration, with a document_id filter when documents are selected"""
     # === THAY ĐỔI 2: XÂY DỰNG CẤU HÌNH TRUY XUẤT ĐỘNG VỚI BỘ LỌC ===
     retrieval_config = {
         'vectorSearchConfiguration': {
-            'numberOfResults': 4,
+            # Lấy dư để ContextAssembler có chỗ xếp hạng lại / bỏ trùng
+            'numberOfResults': context_assembler.fetch_k,
             'overrideSearchType': 'HYBRID'
         }
     }
@@ -125,61 +705,84 @@ def retrieve_from_knowledge_base_with_sources(diagram_json: Dict, question: str,
         # Gán bộ lọc đã được xây dựng đúng cách vào cấu hình
         retrieval_config['vectorSearchConfiguration']['filter'] = filter_dict
 
-    print("--- Retrieval Config ---")
-    print(json.dumps(retrieval_config, indent=2, ensure_ascii=False))
+    return retrieval_config
+
+def retrieve_from_knowledge_base_with_sources(diagram_json: Union[Dict, DiagramGraph], question: str, selected_document_ids: List[str]) -> Tuple[str, List[Dict], bool]:
+    """(context, sources, complete); complete is False for fallback context or when any sub-query failed"""
+    with span('retrieval'):
+        return _retrieve_with_sources(diagram_json, question, selected_document_ids)
+
+def _retrieve_with_sources(diagram_json: Union[Dict, DiagramGraph], question: str, selected_document_ids: List[str]) -> Tuple[str, List[Dict], bool]:
+    with span('retrieval.query_build'):
+        queries = build_retrieval_queries(diagram_json, question)
+        query = '\n'.join(queries)
+        retrieval_config = build_retrieval_config(selected_document_ids)
+    logger.debug('retrieval query', query=Payload(query), config=Payload(retrieval_config))
     
+    filter_dict = retrieval_config['vectorSearchConfiguration'].get('filter')
+    increment('retrieval_filtered' if filter_dict else 'retrieval_unfiltered')
+    cached = retrieval_cache.get(query, filter_dict, kb_id, selected_document_ids, variant=RETRIEVAL_CACHE_VARIANT)
+    if cached is not None:
+        increment('retrieval_cache_hit')
+        logger.info('retrieval cache hit', sources=len(cached[1]))
+        return cached[0], cached[1], True
+    increment('retrieval_cache_miss')
+
     try:
-        response = bedrock_agent.retrieve(
-            knowledgeBaseId=kb_id,
-            retrievalQuery={'text': query},
-            retrievalConfiguration=retrieval_config # Sử dụng cấu hình động
-        )
-        
-        print("--- Bedrock Raw Response ---")
-        print(json.dumps(response, indent=2))
+        # Nhiều sub-query: chạy đồng thời rồi trộn bằng reciprocal-rank fusion
+        with span('retrieval.kb'):
+            retrieval_results, failed_queries = multi_query_retriever.retrieve(
+                queries,
+                lambda query_text: knowledge_retriever.retrieve(query_text, retrieval_config) # Sử dụng cấu hình động
+            )
+        increment('retrieval_queries', len(queries))
+        increment('retrieval_hits', len(retrieval_results))
         
-        context_parts = []
-        sources = []
+        logger.debug('retrieval results', results=Payload(retrieval_results))
         
-        for i, result in enumerate(response['retrievalResults']):
-            score = result.get('score', 0)
-            if score > 0.2:
-                print(f"--- Processing Result {i+1} (Score: {score}) ---")
-                # Thêm vào context để AI đọc
-                full_retrieved_text = result['content']['text']
-                context_parts.append(f"Nguồn [{i+1}]:\n{result['content']['text']}")
-                
-                # === THAY ĐỔI 3: LÀM GIÀU THÔNG TIN NGUỒN TRẢ VỀ ===
-                metadata = result.get('metadata', {})
-                s3_location = result.get('location', {}).get('s3Location', {})
-                
-                source_info = {
-                    'citationId': i + 1,  # ID tạm thời để trích dẫn trong văn bản, ví dụ: (Nguồn [1])
-                    'documentId': metadata.get('document_id', 'N/A'), # Lấy ID thật từ metadata
-                    'title': metadata.get('document_name', s3_location.get('uri', '').split('/')[-1]), # Ưu tiên lấy title từ metadata
-                    's3_uri': s3_location.get('uri', ''),
-                    'score': score,
-                    'content_preview': full_retrieved_text[:150] + "..." if len(full_retrieved_text) > 150 else full_retrieved_text,
-                    'full_retrieved_text': full_retrieved_text
-                }
-                sources.append(source_info)
-        
-        context = "\n\n".join(context_parts) if context_parts else "Không tìm thấy thông tin liên quan trong các tài liệu đã chọn."
+        # Lấy dư K chunk, xếp hạng lại theo nhãn sơ đồ + câu hỏi, bỏ trùng và cắt theo ngân sách token
+        with span('retrieval.assembly'):
+            context, sources, assembly_stats = context_assembler.assemble(
+                retrieval_results,
+                build_rerank_text(diagram_json, question)
+            )
+        increment('context_chunks', assembly_stats['selected'])
+        increment('context_tokens', assembly_stats['context_tokens'])
+        logger.info('context assembled', queries=len(queries), failed_queries=failed_queries, **assembly_stats)
+
+        # Có sub-query lỗi (throttle, timeout, mạch mở giữa chừng) => kết quả chỉ là một phần:
+        # không cache, và phân tích dựa trên nó cũng không được cache
+        if failed_queries:
+            increment('retrieval_partial')
+        else:
+            retrieval_cache.set(query, filter_dict, kb_id, selected_document_ids, context, sources,
+                                variant=RETRIEVAL_CACHE_VARIANT)
 
-        print("--- FINAL CONTEXT (SENT TO CLAUDE) ---")
-        print(context)
-        print("--- FINAL SOURCES (SENT TO FRONTEND) ---")
-        print(json.dumps(sources, indent=2, ensure_ascii=False))
+        logger.debug('final context', context=Payload(context),
+                     sources=Payload(lambda: [{k: v for k, v in source.items() if k != 'full_retrieved_text'} for source in sources]))
 
-        return context, sources
+        return context, sources, not failed_queries
         
+    except CircuitOpenError as e:
+        # KB đang lỗi / chậm: trả context dự phòng ngay, không chờ lời gọi thất bại
+        increment('retrieval_short_circuit')
+        logger.info('knowledge base circuit open, using fallback context', retry_in_s=round(e.retry_in, 1))
+        return RETRIEVAL_ERROR_CONTEXT, [], False
     except Exception as e:
-        print(f"Knowledge Base retrieval error: {e}")
-        return "Lỗi truy xuất Knowledge Base. Sử dụng kiến thức cơ bản để phân tích.", []
+        increment('retrieval_error')
+        logger.error('knowledge base retrieval error', error=str(e))
+        return RETRIEVAL_ERROR_CONTEXT, [], False
+    finally:
+        set_property('kb_breaker_state', kb_breaker.state)
 
-def analyze_with_claude_structured(bedrock_runtime, diagram_json: Dict, question: str, context: str, sources: List[Dict]) -> Dict:
-    """Analyze diagram with Claude using RAG context and return structured JSON"""
-    
+def build_analysis_prompt(diagram_json: Dict, question: str, context: str, sources: List[Dict],
+                          diagram_text: Optional[str] = None) -> str:
+    """
+    Build the structured-analysis prompt shared by the blocking and streaming paths.
+    `diagram_text` is the pre-rendered diagram (see render_diagram_for_prompt); defaults to indented JSON.
+    """
+    if diagram_text is None:
+        diagram_text = json.dumps(diagram_json, ensure_ascii=False, indent=2)
     source_refs = ""
     if sources:
         source_refs = "\n\nNGUỒN THAM KHẢO:\n"
@@ -193,7 +796,7 @@ def analyze_with_claude_structured(bedrock_runtime, diagram_json: Dict, question
     Bạn là chuyên gia phân tích quy trình và sơ đồ hệ thống. Hãy phân tích chi tiết sơ đồ sau và trả về kết quả dưới dạng JSON theo schema đã định.
     
     SƠ ĐỒ CẦN PHÂN TÍCH:
-    {json.dumps(diagram_json, ensure_ascii=False, indent=2)}
+    {diagram_text}
     
     CÂU HỎI CỦA NGƯỜI DÙNG:
     {question}
@@ -251,50 +854,259 @@ def analyze_with_claude_structured(bedrock_runtime, diagram_json: Dict, question
     
     Hãy phân tích chi tiết và trả về JSON hoàn chỉnh. Nhớ trích dẫn nguồn khi sử dụng thông tin từ tài liệu tham khảo.
     """
+    return prompt
 
-    print("--- PROMPT FOR CLAUDE 3 SONNET ---")
-    print(prompt)
-    
-    response = bedrock_runtime.invoke_model(
-        modelId='anthropic.claude-3-sonnet-20240229-v1:0',
-        body=json.dumps({
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 4000,
-            "temperature": 0.2,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        })
-    )
+def build_analysis_request_body(prompt: str, max_tokens: int = 4000) -> str:
+    return json.dumps({
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "temperature": 0.2,
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    })
+
+def route_analysis(graph: DiagramGraph, question: str, context: str) -> ModelRoute:
+    """Model tier and output budget for one analysis"""
+    route = model_router.route('analysis', {
+        'nodes': graph.node_count,
+        'edges': graph.edge_count,
+        'conditional_edges': graph.conditional_edge_count,
+        'input_chars': len(question or '') + len(context or ''),
+        'complexity': calculate_complexity(graph)
+    })
+    record_route(route)
+    return route
+
+def record_route(route: ModelRoute) -> None:
+    set_property('model_tier', route.tier)
+    set_value('max_tokens', route.max_tokens)
+
+def analyze_with_claude_structured(bedrock_runtime, diagram_json: Dict, question: str, context: str, sources: List[Dict],
+                                   diagram_text: Optional[str] = None,
+                                   route: Optional[ModelRoute] = None) -> Tuple[Dict, ModelRoute]:
+    """
+    Analyze diagram with Claude using RAG context and return (structured JSON, route used).
+    An answer that is truncated or not valid JSON is retried once on the next model tier.
+    """
+    route = route or route_analysis(as_graph(diagram_json), question, context)
+    with span('prompt_build'):
+        prompt = build_analysis_prompt(diagram_json, question, context, sources, diagram_text)
+    increment('prompt_chars', len(prompt))
+
+    logger.debug('analysis prompt', prompt=Payload(prompt))
     
-    response_body = json.loads(response['body'].read())
-    analysis_text = response_body['content'][0]['text']
+    def invoke(route: ModelRoute) -> Tuple[Dict, Optional[str]]:
+        with span('model_invoke'):
+            response_body = invoke_model_json(bedrock_runtime, route.model_id,
+                                              build_analysis_request_body(prompt, max_tokens=route.max_tokens))
+        analysis_text = response_body['content'][0]['text']
+        increment('response_chars', len(analysis_text))
+
+        logger.debug('analysis response', text=Payload(analysis_text), tier=route.tier)
+        return parse_analysis_text(analysis_text), response_body.get('stop_reason')
+
+    analysis, route = model_router.run_with_escalation(
+        route, invoke, lambda analysis, stop_reason: analysis_failure(analysis, stop_reason, ANALYSIS_SECTIONS))
+    if analysis is None:
+        # Hết giờ: trả cấu trúc dự phòng (kèm sources đã truy xuất) thay vì để Lambda timeout
+        return create_fallback_structure(DEADLINE_ANALYSIS_TEXT), route
+    return analysis, route
+
+def invoke_model_json(bedrock_runtime, model_id: str, body: str) -> Dict:
+    """invoke_model + parsed response body, bounded by the request deadline (hedged when enabled)"""
+    def invoke() -> Dict:
+        response = bedrock_runtime.invoke_model(modelId=model_id, body=body)
+        return json.loads(response['body'].read())
+    return hedged_call(invoke, model_id)
+
+def stream_analysis_sections(bedrock_runtime, diagram_json: Dict, question: str, context: str, sources: List[Dict],
+                             diagram_text: Optional[str] = None,
+                             route: Optional[ModelRoute] = None) -> Iterator[Tuple[str, Any]]:
+    """
+    Streaming variant of analyze_with_claude_structured.
+    Yields (section_name, section_value) as soon as each top-level section of the JSON closes,
+    then ('__complete__', full_analysis) once the model finishes.
+    No escalation here: sections already sent to the client cannot be taken back.
+    """
+    route = route or route_analysis(as_graph(diagram_json), question, context)
+    with span('prompt_build'):
+        prompt = build_analysis_prompt(diagram_json, question, context, sources, diagram_text)
+    increment('prompt_chars', len(prompt))
+    started = time.perf_counter()
+    with span('model_invoke'):
+        response = bedrock_runtime.invoke_model_with_response_stream(
+            modelId=route.model_id,
+            body=build_analysis_request_body(prompt, max_tokens=route.max_tokens)
+        )
+
+    parser = TopLevelSectionParser()
+    text_parts = []
+    emitted = {}
+    for event in response['body']:
+        # Hết giờ: dừng đọc stream, giữ các section đã xong, phần còn lại lấy từ cấu trúc dự phòng
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            record_skip('model_stream')
+            close_stream(response['body'])
+            break
+        chunk = event.get('chunk')
+        if not chunk:
+            continue
+        payload = json.loads(chunk['bytes'])
+        if payload.get('type') != 'content_block_delta':
+            continue
+        text = payload.get('delta', {}).get('text', '')
+        if not text:
+            continue
+        text_parts.append(text)
+        for section, value in parser.feed(text):
+            if not emitted:
+                set_value('model_first_section_ms', round((time.perf_counter() - started) * 1000, 1))
+            emitted[section] = value
+            if section in ANALYSIS_SECTIONS:
+                yield section, value
+
+    # Bao gồm cả thời gian phía tiêu thụ generator (gửi SSE) giữa các chunk
+    set_value('model_stream_ms', round((time.perf_counter() - started) * 1000, 1))
+    analysis_text = ''.join(text_parts)
+    increment('response_chars', len(analysis_text))
+    analysis = emitted if all(section in emitted for section in ANALYSIS_SECTIONS) else {**parse_analysis_text(analysis_text), **emitted}
+    # Các section chưa phát được (ví dụ output lỗi JSON) sẽ lấy từ cấu trúc fallback
+    for section in ANALYSIS_SECTIONS:
+        if section not in emitted and section in analysis:
+            yield section, analysis[section]
+    yield '__complete__', analysis
+
+def close_stream(stream: Any) -> None:
+    try:
+        stream.close()
+    except Exception:
+        pass
+
+def build_context_from_sources(sources: List[Dict]) -> str:
+    """Rebuild the prompt context from stored sources (entries cached before `context` was kept)"""
+    if not sources:
+        return "Không tìm thấy thông tin liên quan trong các tài liệu đã chọn."
+    return "\n\n".join(f"Nguồn [{source['citationId']}]:\n{source['full_retrieved_text']}" for source in sources)
+
+def build_revision_prompt(diagram_text: str, question: str, context: str, sources: List[Dict],
+                          previous_analysis: Dict, diff: DiagramDiff, sections: List[str]) -> str:
+    """Prompt asking the model to rewrite only `sections` of a previous analysis after a diagram edit"""
+    source_refs = ""
+    if sources:
+        source_refs = "\n\nNGUỒN THAM KHẢO:\n"
+        for source in sources:
+            source_refs += f"- Nguồn [{source['citationId']}]: {source['title']} (ID: {source['documentId']})\n"
+    changes = "\n    ".join(diff.describe())
+    to_revise = {section: previous_analysis.get(section) for section in sections}
+    kept = {section: value for section, value in previous_analysis.items()
+            if section in ANALYSIS_SECTIONS and section not in sections}
 
-    print("--- CLAUDE RAW RESPONSE TEXT ---")
-    print(analysis_text)
+    return f"""
+    Bạn là chuyên gia phân tích quy trình và sơ đồ hệ thống. Sơ đồ dưới đây vừa được người dùng chỉnh sửa.
+    Hãy CẬP NHẬT bản phân tích trước đó cho khớp với sơ đồ mới, chỉ viết lại các phần được yêu cầu.
     
+    SƠ ĐỒ SAU KHI SỬA:
+    {diagram_text}
+    
+    CÁC THAY ĐỔI SO VỚI LẦN PHÂN TÍCH TRƯỚC:
+    {changes}
+    
+    CÂU HỎI CỦA NGƯỜI DÙNG:
+    {question}
+    
+    KIẾN THỨC THAM KHẢO (chỉ sử dụng các nguồn này):
+    {context}
+    {source_refs}
+
+    CÁC PHẦN GIỮ NGUYÊN (chỉ để tham khảo, KHÔNG trả về):
+    {json.dumps(kept, ensure_ascii=False)}
+
+    CÁC PHẦN CẦN VIẾT LẠI (bản cũ):
+    {json.dumps(to_revise, ensure_ascii=False, indent=2)}
+
+    YÊU CẦU:
+    1. Giữ nguyên cấu trúc key của từng phần; giữ lại nội dung cũ nếu vẫn còn đúng với sơ đồ mới.
+    2. Khi trích dẫn thông tin từ nguồn tham khảo, hãy sử dụng định dạng: "(Nguồn [số])"
+    3. Chỉ trả về MỘT object JSON có đúng các key: {", ".join(sections)}
+    """
+
+def revise_analysis_sections(bedrock_runtime, diagram_json: Dict, question: str, context: str, sources: List[Dict],
+                             previous_analysis: Dict, diff: DiagramDiff, sections: List[str],
+                             diagram_text: Optional[str] = None, route: Optional[ModelRoute] = None) -> Dict:
+    """Re-generate only `sections`; returns the revised sections that came back well-formed"""
+    if diagram_text is None:
+        diagram_text = json.dumps(diagram_json, ensure_ascii=False, indent=2)
+    with span('prompt_build'):
+        prompt = build_revision_prompt(diagram_text, question, context, sources, previous_analysis, diff, sections)
+    increment('prompt_chars', len(prompt))
+
+    logger.debug('revision prompt', prompt=Payload(prompt))
+
     try:
-        start_idx = analysis_text.find('{')
-        end_idx = analysis_text.rfind('}') + 1
-        if start_idx != -1 and end_idx != -1:
-            json_str = analysis_text[start_idx:end_idx]
-            return json.loads(json_str)
-        else:
-            return create_fallback_structure(analysis_text)
-    except json.JSONDecodeError:
+        with span('model_invoke'):
+            response_body = invoke_model_json(
+                bedrock_runtime,
+                route.model_id if route else model_router.model_id(),
+                # Ngân sách output tỉ lệ với số section cần viết lại
+                build_analysis_request_body(prompt, max_tokens=min(4000, 800 * len(sections)))
+            )
+    except DeadlineExceeded:
+        # Các section chưa viết lại giữ nguyên bản trước (unrevised_sections, không cache)
+        record_skip('revision')
+        return {}
+    revision_text = response_body['content'][0]['text']
+    increment('response_chars', len(revision_text))
+
+    logger.debug('revision response', text=Payload(revision_text))
+
+    with span('json_extract'):
+        result = extract_json_object(revision_text)
+    set_property('json_extraction_method', result.method)
+    if not result:
+        logger.warning('revision JSON extraction failed', error=result.error, position=result.error_pos)
+        return {}
+    return {section: result.value[section] for section in sections if isinstance(result.value.get(section), dict)}
+
+def parse_analysis_text(analysis_text: str) -> Dict:
+    """Extract the analysis JSON object from the model text, falling back to a fixed structure"""
+    with span('json_extract'):
+        result = extract_json_object(analysis_text)
+    set_property('json_extraction_method', result.method)
+    if not result:
+        increment('analysis_fallback_structure')
+        logger.warning('analysis JSON extraction failed', error=result.error, position=result.error_pos)
         return create_fallback_structure(analysis_text)
+    return result.value
 
 # --- CÁC HÀM HELPER KHÁC GIỮ NGUYÊN KHÔNG THAY ĐỔI ---
 
-def create_diagram_summary(diagram_json: Dict) -> str:
+def build_analysis_cache_key(request: Dict) -> str:
+    """Content hash of an analysis request, ignoring node positions and edge styling"""
+    selected_document_ids = request['selectedDocumentIds']
+    return make_cache_key(
+        'analysis',
+        canonical_diagram(request['diagram']),
+        (request['question'] or '').strip(),
+        sorted(str(doc_id) for doc_id in selected_document_ids or []),
+        request['diagramFormat'],
+        # Bảng định tuyến model (tier / ngân sách) thay cho một model ID cố định
+        model_router.signature,
+        ANALYSIS_PROMPT_VERSION,
+        # Tài liệu được ingest lại => generation đổi => phân tích cũ không còn khớp
+        retrieval_cache.generations(sorted(str(doc_id) for doc_id in selected_document_ids or []))
+    )
+
+def create_diagram_summary(diagram_json: Union[Dict, DiagramGraph]) -> str:
     """Create concise diagram summary for KB query"""
     try:
-        nodes = diagram_json.get('nodes', [])
-        node_labels = [node.get('data', {}).get('label', 'Unknown') for node in nodes]
-        return f"Sơ đồ có {len(nodes)} bước: {' -> '.join(node_labels[:5])}{'...' if len(node_labels) > 5 else ''}"
+        graph = as_graph(diagram_json)
+        node_labels = graph.labels('Unknown')
+        return f"Sơ đồ có {graph.node_count} bước: {' -> '.join(node_labels[:5])}{'...' if len(node_labels) > 5 else ''}"
     except:
         return "Sơ đồ quy trình"
 
@@ -311,12 +1123,12 @@ def create_fallback_structure(analysis_text: str) -> Dict:
         "detailed_analysis": analysis_text
     }
 
-def calculate_complexity(diagram_json: Dict) -> str:
+def calculate_complexity(diagram_json: Union[Dict, DiagramGraph]) -> str:
     """Calculate diagram complexity"""
-    # This function remains unchanged.
     try:
-        nodes_count = len(diagram_json.get('nodes', []))
-        edges_count = len(diagram_json.get('edges', []))
+        graph = as_graph(diagram_json)
+        nodes_count = graph.node_count
+        edges_count = graph.edge_count
         branching_score = edges_count / max(nodes_count, 1)
         if nodes_count <= 3: return "Đơn giản"
         elif nodes_count <= 6 and branching_score < 1.5: return "Trung bình"
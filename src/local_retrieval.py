@@ -0,0 +1,357 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError, create_circuit_breaker
+from request_metrics import increment
+from structured_log import get_logger
+
+# --- RETRIEVER CÓ THỂ THAY THẾ: BEDROCK KB HOẶC INDEX CỤC BỘ ---
+# Mọi retriever nhận (query, retrievalConfiguration) giống bedrock_agent.retrieve và trả về
+# list `retrievalResults` cùng định dạng (score, content.text, location.s3Location.uri, metadata),
+# nên phần lắp ráp context phía sau không cần biết kết quả đến từ đâu.
+#
+# Index cục bộ: chunk tài liệu theo cửa sổ từ, BM25 (postings dạng CSR) + vector dày NumPy,
+# tất cả lưu thành file nhị phân và mở bằng np.memmap (mở index gần như tức thì, dùng chung
+# page cache giữa các process). Bộ lọc metadata hỗ trợ equals / orAll / andAll như Bedrock.
+
+logger = get_logger('retrieval')
+_WORD_RE = re.compile(r'\w+')
+INDEX_META_FILE = 'index.json'
+DEFAULT_DIMENSIONS = 512
+
+
+def _numpy():
+    # NumPy chỉ cần khi dùng index cục bộ; Lambda chỉ gọi Bedrock không phải đóng gói thêm
+    try:
+        import numpy
+    except ImportError as e:
+        raise RuntimeError('Local retrieval requires numpy (pip install numpy)') from e
+    return numpy
+
+
+def tokenize(text: str) -> List[str]:
+    return _WORD_RE.findall((text or '').lower())
+
+
+def hashing_embedding(text: str, dimensions: int = DEFAULT_DIMENSIONS):
+    """
+    Deterministic dense vector: signed feature hashing of unigrams and bigrams, L2-normalized.
+    Stand-in for a neural embedding; any callable text -> 1-D float32 array of the same size works.
+    """
+    np = _numpy()
+    vector = np.zeros(dimensions, dtype=np.float32)
+    tokens = tokenize(text)
+    for feature in tokens + [a + ' ' + b for a, b in zip(tokens, tokens[1:])]:
+        digest = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+        vector[digest % dimensions] += 1.0 if (digest >> 63) else -1.0
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+def chunk_words(text: str, chunk_words_count: int = 200, overlap: int = 40) -> List[str]:
+    words = (text or '').split()
+    if not words:
+        return []
+    step = max(1, chunk_words_count - overlap)
+    return [' '.join(words[i:i + chunk_words_count]) for i in range(0, max(len(words) - overlap, 1), step)]
+
+
+class Retriever:
+    """Interface: same inputs and output shape as bedrock_agent.retrieve(...)['retrievalResults']"""
+
+    name = 'retriever'
+
+    def retrieve(self, query: str, retrieval_config: Dict) -> List[Dict]:
+        raise NotImplementedError
+
+
+class BedrockRetriever(Retriever):
+    name = 'bedrock'
+
+    def __init__(self, knowledge_base_id: str, client_fn: Callable[[], Any]):
+        # client_fn trả về client bedrock-agent-runtime tại thời điểm gọi (client có thể được tạo lười)
+        self.knowledge_base_id = knowledge_base_id
+        self.client_fn = client_fn
+
+    def retrieve(self, query: str, retrieval_config: Dict) -> List[Dict]:
+        return self.client_fn().retrieve(
+            knowledgeBaseId=self.knowledge_base_id,
+            retrievalQuery={'text': query},
+            retrievalConfiguration=retrieval_config
+        )['retrievalResults']
+
+
+class BreakerRetriever(Retriever):
+    """`inner` behind a circuit breaker: while it is open, calls fail fast with CircuitOpenError"""
+
+    def __init__(self, inner: Retriever, breaker: CircuitBreaker):
+        self.inner = inner
+        self.breaker = breaker
+        # Giữ tên của retriever bên trong: tên là một phần key cache truy xuất
+        self.name = inner.name
+
+    def retrieve(self, query: str, retrieval_config: Dict) -> List[Dict]:
+        return self.breaker.call(lambda: self.inner.retrieve(query, retrieval_config))
+
+
+class FallbackRetriever(Retriever):
+    """Try `primary`; on any error serve the query from `fallback`"""
+
+    def __init__(self, primary: Retriever, fallback: Retriever):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f'{primary.name}+{fallback.name}'
+        self.fallbacks = 0
+
+    def retrieve(self, query: str, retrieval_config: Dict) -> List[Dict]:
+        try:
+            return self.primary.retrieve(query, retrieval_config)
+        except CircuitOpenError:
+            # Mạch đang mở: chuyển thẳng sang nguồn dự phòng, không log từng request
+            self.fallbacks += 1
+            increment('retriever_fallback')
+            return self.fallback.retrieve(query, retrieval_config)
+        except Exception as e:
+            self.fallbacks += 1
+            increment('retriever_fallback')
+            logger.warning('primary retrieval failed, using fallback', primary=self.primary.name, fallback=self.fallback.name, error=str(e))
+            return self.fallback.retrieve(query, retrieval_config)
+
+
+def build_local_index(documents: Iterable[Dict], index_dir: str, dimensions: int = DEFAULT_DIMENSIONS,
+                      chunk_words_count: int = 200, overlap: int = 40,
+                      embed_fn: Optional[Callable[[str, int], Any]] = None) -> Dict[str, Any]:
+    """
+    Build an on-disk index from documents ({'document_id', 'text', 'title'?, 'uri'?, 'metadata'?}).
+    Writes vectors / BM25 postings as raw little-endian arrays plus index.json; returns the meta dict.
+    """
+    np = _numpy()
+    embed_fn = embed_fn or hashing_embedding
+    os.makedirs(index_dir, exist_ok=True)
+
+    chunks: List[Dict] = []
+    vectors = []
+    vocabulary: Dict[str, int] = {}
+    postings: List[Dict[int, int]] = []
+    lengths = []
+    for doc in documents:
+        metadata = {**(doc.get('metadata') or {}), 'document_id': str(doc['document_id'])}
+        if doc.get('title'):
+            metadata.setdefault('document_name', doc['title'])
+        for text in chunk_words(doc.get('text', ''), chunk_words_count, overlap):
+            chunk_index = len(chunks)
+            chunks.append({'text': text, 'uri': doc.get('uri', ''), 'metadata': metadata})
+            vectors.append(embed_fn(text, dimensions))
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            counts: Dict[int, int] = {}
+            for token in tokens:
+                term_id = vocabulary.setdefault(token, len(vocabulary))
+                counts[term_id] = counts.get(term_id, 0) + 1
+            for term_id, count in counts.items():
+                if term_id == len(postings):
+                    postings.append({})
+                postings[term_id][chunk_index] = count
+
+    # Postings dạng CSR: term t -> chunk ids / tf tại [offsets[t], offsets[t + 1])
+    offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    for term_id, plist in enumerate(postings):
+        offsets[term_id + 1] = offsets[term_id] + len(plist)
+    posting_chunks = np.empty(int(offsets[-1]), dtype=np.int32)
+    posting_tf = np.empty(int(offsets[-1]), dtype=np.float32)
+    for term_id, plist in enumerate(postings):
+        start = int(offsets[term_id])
+        posting_chunks[start:start + len(plist)] = list(plist.keys())
+        posting_tf[start:start + len(plist)] = list(plist.values())
+
+    matrix = np.vstack(vectors).astype(np.float32) if vectors else np.zeros((0, dimensions), dtype=np.float32)
+    arrays = {
+        'vectors.f32': matrix,
+        'lengths.i32': np.asarray(lengths, dtype=np.int32),
+        'offsets.i64': offsets,
+        'posting_chunks.i32': posting_chunks,
+        'posting_tf.f32': posting_tf,
+    }
+    for name, array in arrays.items():
+        array.astype(array.dtype.newbyteorder('<'), copy=False).tofile(os.path.join(index_dir, name))
+
+    meta = {
+        'version': 1,
+        'dimensions': dimensions,
+        'chunk_count': len(chunks),
+        'vocabulary': vocabulary,
+        'chunks': chunks,
+    }
+    with open(os.path.join(index_dir, INDEX_META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return meta
+
+
+class LocalIndexRetriever(Retriever):
+    """Hybrid BM25 + dense retrieval over an index written by build_local_index"""
+
+    name = 'local'
+
+    def __init__(self, index_dir: str, dense_weight: float = 0.5, k1: float = 1.2, b: float = 0.75,
+                 embed_fn: Optional[Callable[[str, int], Any]] = None):
+        np = _numpy()
+        with open(os.path.join(index_dir, INDEX_META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        self.index_dir = index_dir
+        self.dimensions = meta['dimensions']
+        self.vocabulary: Dict[str, int] = meta['vocabulary']
+        self.chunks: List[Dict] = meta['chunks']
+        self.dense_weight = dense_weight
+        self.k1 = k1
+        self.b = b
+        self.embed_fn = embed_fn or hashing_embedding
+        n = meta['chunk_count']
+
+        def open_array(name: str, dtype: str, shape: Optional[Tuple[int, ...]] = None):
+            path = os.path.join(index_dir, name)
+            if os.path.getsize(path) == 0:
+                return np.zeros(shape or (0,), dtype=dtype)
+            return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+        self.vectors = open_array('vectors.f32', '<f4', (n, self.dimensions))
+        self.lengths = open_array('lengths.i32', '<i4')
+        self.offsets = open_array('offsets.i64', '<i8')
+        self.posting_chunks = open_array('posting_chunks.i32', '<i4')
+        self.posting_tf = open_array('posting_tf.f32', '<f4')
+        self.avg_length = float(self.lengths.mean()) if n else 1.0
+        # Cột metadata -> mảng giá trị theo chunk, dựng lười khi bộ lọc cần tới
+        self._columns: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _column(self, key: str):
+        with self._lock:
+            column = self._columns.get(key)
+            if column is None:
+                np = _numpy()
+                column = self._columns[key] = np.array([str(c['metadata'].get(key, '')) for c in self.chunks], dtype=object)
+            return column
+
+    def filter_mask(self, filter_dict: Optional[Dict]):
+        """Boolean mask of chunks matching a Bedrock metadata filter (equals / orAll / andAll)"""
+        np = _numpy()
+        n = len(self.chunks)
+        if not filter_dict:
+            return np.ones(n, dtype=bool)
+        if 'equals' in filter_dict:
+            condition = filter_dict['equals']
+            return self._column(condition['key']) == str(condition['value'])
+        if 'orAll' in filter_dict:
+            mask = np.zeros(n, dtype=bool)
+            for sub_filter in filter_dict['orAll']:
+                mask |= self.filter_mask(sub_filter)
+            return mask
+        if 'andAll' in filter_dict:
+            mask = np.ones(n, dtype=bool)
+            for sub_filter in filter_dict['andAll']:
+                mask &= self.filter_mask(sub_filter)
+            return mask
+        raise ValueError(f'Unsupported filter operator: {list(filter_dict)}')
+
+    def bm25(self, query: str):
+        """(scores per chunk, upper bound of any chunk's score for this query)"""
+        np = _numpy()
+        n = len(self.chunks)
+        scores = np.zeros(n, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / self.avg_length) if n else scores
+        upper = 0.0
+        for token in set(tokenize(query)):
+            term_id = self.vocabulary.get(token)
+            df = 0 if term_id is None else int(self.offsets[term_id + 1]) - int(self.offsets[term_id])
+            idf = float(np.log(1 + (n - df + 0.5) / (df + 0.5)))
+            # tf * (k1 + 1) / (tf + norm) < k1 + 1: từ của query không có trong corpus vẫn tính vào cận trên
+            upper += idf * (self.k1 + 1)
+            if not df:
+                continue
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            docs = self.posting_chunks[start:end]
+            tf = self.posting_tf[start:end]
+            # Mỗi chunk xuất hiện tối đa một lần trong postings của một term => cộng trực tiếp
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + norm[docs])
+        return scores, upper
+
+    def retrieve(self, query: str, retrieval_config: Dict) -> List[Dict]:
+        np = _numpy()
+        search = (retrieval_config or {}).get('vectorSearchConfiguration', {})
+        top_k = int(search.get('numberOfResults', 5))
+        mask = self.filter_mask(search.get('filter'))
+        if not len(self.chunks) or not mask.any():
+            return []
+
+        lexical, lexical_upper = self.bm25(query)
+        dense = self.vectors @ self.embed_fn(query, self.dimensions)
+        # Score tuyệt đối trong [0, 1] (như score của Bedrock), KHÔNG chia cho kết quả tốt nhất của query:
+        # BM25 chia cho cận trên theo idf của chính query (tỉ lệ query được khớp), dense là cosine của
+        # vector đã chuẩn hóa L2 (cắt phần âm). Nhờ vậy query không liên quan cho score thấp và bị
+        # ngưỡng CONTEXT_MIN_SCORE loại, thay vì chunk tốt nhất của nó luôn đạt ~1.0.
+        lexical = lexical / lexical_upper if lexical_upper else lexical
+        dense = np.clip(dense, 0.0, 1.0)
+        scores = (1 - self.dense_weight) * lexical + self.dense_weight * dense
+        scores = np.where(mask, scores, -1.0)
+
+        k = min(top_k, int(mask.sum()))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return [{
+            'score': float(scores[i]),
+            'content': {'text': self.chunks[i]['text']},
+            'location': {'type': 'S3', 's3Location': {'uri': self.chunks[i]['uri']}},
+            'metadata': dict(self.chunks[i]['metadata'])
+        } for i in top]
+
+
+def create_retriever(knowledge_base_id: str, client_fn: Callable[[], Any]) -> Retriever:
+    """
+    RETRIEVER = bedrock (mặc định) | local | bedrock+local (Bedrock, lỗi thì dùng index cục bộ).
+    Index cục bộ đọc từ LOCAL_INDEX_DIR; nếu thư mục không tồn tại thì chỉ dùng Bedrock.
+    Bedrock luôn đi qua circuit breaker 'kb' (KB_BREAKER_*): khi mạch mở, bedrock+local dùng
+    ngay index cục bộ, còn bedrock đơn thuần trả lỗi ngay để caller dùng context dự phòng.
+    """
+    kind = os.environ.get('RETRIEVER', 'bedrock').lower()
+    index_dir = os.environ.get('LOCAL_INDEX_DIR', '')
+    bedrock = BreakerRetriever(BedrockRetriever(knowledge_base_id, client_fn), create_circuit_breaker('KB'))
+    if kind == 'bedrock' or not index_dir or not os.path.exists(os.path.join(index_dir, INDEX_META_FILE)):
+        if kind != 'bedrock':
+            logger.warning('local index not found, using Bedrock Knowledge Base only', index_dir=index_dir)
+        return bedrock
+    local = LocalIndexRetriever(index_dir, dense_weight=float(os.environ.get('LOCAL_INDEX_DENSE_WEIGHT', 0.5)))
+    if kind == 'local':
+        return local
+    return FallbackRetriever(bedrock, local)
+
+
+def _load_documents(source: str) -> Iterable[Dict]:
+    """A .jsonl file of documents, or a directory of .txt / .md files (document_id = file name)"""
+    if os.path.isfile(source):
+        with open(source, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    for name in sorted(os.listdir(source)):
+        if name.endswith(('.txt', '.md')):
+            with open(os.path.join(source, name), encoding='utf-8') as f:
+                yield {'document_id': os.path.splitext(name)[0], 'title': name, 'uri': os.path.abspath(os.path.join(source, name)),
+                       'text': f.read()}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build a local retrieval index')
+    parser.add_argument('source', help='.jsonl of {document_id, text, title?, uri?} or a directory of .txt/.md files')
+    parser.add_argument('index_dir')
+    parser.add_argument('--dimensions', type=int, default=DEFAULT_DIMENSIONS)
+    parser.add_argument('--chunk-words', type=int, default=200)
+    parser.add_argument('--overlap', type=int, default=40)
+    args = parser.parse_args()
+    built = build_local_index(_load_documents(args.source), args.index_dir, args.dimensions, args.chunk_words, args.overlap)
+    print(f"Indexed {built['chunk_count']} chunks, {len(built['vocabulary'])} terms -> {args.index_dir}")
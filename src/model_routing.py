@@ -0,0 +1,243 @@
+import copy
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from deadlines import DeadlineExceeded, record_skip, remaining_time
+from request_metrics import increment, set_property, set_value
+from result_cache import make_cache_key
+from structured_log import get_logger
+
+# --- ĐỊNH TUYẾN MODEL THEO ĐỘ PHỨC TẠP + NGÂN SÁCH TOKEN OUTPUT ---
+# Mỗi tác vụ ('analysis', 'generation') có một danh sách rule xét theo thứ tự; rule đầu tiên khớp
+# với đặc trưng của request (số node / edge / edge có điều kiện, độ dài input, độ phức tạp, có ảnh...)
+# quyết định tier model và max_tokens. Sơ đồ nhỏ, đơn giản => model nhanh, rẻ hơn với ngân sách nhỏ.
+# Output không đạt (JSON lỗi / sai cấu trúc / bị cắt vì hết max_tokens) => tự động nâng lên tier
+# kế tiếp trong `escalation`, với ngân sách tối đa của tác vụ.
+#
+# Bảng định tuyến đọc từ MODEL_ROUTING_CONFIG (JSON) hoặc MODEL_ROUTING_FILE (đường dẫn file JSON),
+# ghi đè từng khóa cấp 1 của DEFAULT_ROUTING. Điều kiện của rule:
+#   "max_<đặc trưng>" / "min_<đặc trưng>": ngưỡng số;  "<đặc trưng>": giá trị hoặc danh sách giá trị
+# Ngân sách: số cố định hoặc {"base", "per_node", "per_edge", "per_input_char"}, luôn kẹp trong
+# [MIN_MAX_TOKENS, max_tokens_cap của tác vụ].
+# MODEL_ROUTING_ENABLED=false => luôn dùng tier mặc định với ngân sách cũ (4000 / 2000 token).
+# Vòng gọi model -> kiểm tra output -> nâng tier dùng chung cho mọi handler: ModelRouter.run_with_escalation.
+
+logger = get_logger('routing')
+
+MIN_MAX_TOKENS = 256
+
+DEFAULT_ROUTING: Dict[str, Any] = {
+    'tiers': {
+        'fast': 'anthropic.claude-3-haiku-20240307-v1:0',
+        'standard': 'anthropic.claude-3-sonnet-20240229-v1:0'
+    },
+    'default_tier': 'standard',
+    'escalation': ['fast', 'standard'],
+    'max_escalations': 1,
+    'tasks': {
+        'analysis': {
+            'max_tokens_cap': 4000,
+            'legacy_max_tokens': 4000,
+            'rules': [
+                {'name': 'small', 'tier': 'fast', 'max_nodes': 6, 'max_conditional_edges': 2,
+                 'max_input_chars': 8000, 'max_tokens': {'base': 2000, 'per_node': 100}},
+                {'name': 'default', 'tier': 'standard', 'max_tokens': {'base': 2400, 'per_node': 60}}
+            ]
+        },
+        'generation': {
+            'max_tokens_cap': 4000,
+            'legacy_max_tokens': 2000,
+            'rules': [
+                {'name': 'short_text', 'tier': 'fast', 'image': False, 'max_input_chars': 400,
+                 'max_tokens': {'base': 800, 'per_input_char': 4}},
+                {'name': 'default', 'tier': 'standard', 'max_tokens': {'base': 1600, 'per_input_char': 2}}
+            ]
+        }
+    }
+}
+
+_BUDGET_FEATURES = {'per_node': 'nodes', 'per_edge': 'edges', 'per_input_char': 'input_chars'}
+
+
+class ModelRoute:
+    __slots__ = ('task', 'tier', 'model_id', 'max_tokens', 'rule', 'features', 'escalated_from', 'reason')
+
+    def __init__(self, task: str, tier: str, model_id: str, max_tokens: int, rule: str,
+                 features: Dict[str, Any], escalated_from: Optional['ModelRoute'] = None,
+                 reason: Optional[str] = None):
+        self.task = task
+        self.tier = tier
+        self.model_id = model_id
+        self.max_tokens = max_tokens
+        self.rule = rule
+        self.features = features
+        self.escalated_from = escalated_from
+        self.reason = reason
+
+    @property
+    def escalations(self) -> int:
+        return 0 if self.escalated_from is None else self.escalated_from.escalations + 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Response `metadata.route` block"""
+        first = self
+        attempts = []
+        while first is not None:
+            attempts.append({'tier': first.tier, 'max_tokens': first.max_tokens,
+                             **({'escalation_reason': first.reason} if first.reason else {})})
+            first = first.escalated_from
+        return {
+            'tier': self.tier,
+            'model_id': self.model_id,
+            'max_tokens': self.max_tokens,
+            'rule': self.rule,
+            'escalated': self.escalated_from is not None,
+            'attempts': attempts[::-1],
+            'features': self.features
+        }
+
+
+class ModelRouter:
+    def __init__(self, config: Dict[str, Any], enabled: bool = True):
+        self.config = config
+        self.enabled = enabled
+        self.tiers: Dict[str, str] = config['tiers']
+        self.default_tier: str = config.get('default_tier', 'standard')
+        self.escalation: List[str] = [tier for tier in config.get('escalation', []) if tier in self.tiers]
+        self.max_escalations = int(config.get('max_escalations', 1))
+        for task, spec in config['tasks'].items():
+            for rule in spec.get('rules', []):
+                if rule.get('tier') not in self.tiers:
+                    raise ValueError(f"routing rule {task}/{rule.get('name')} uses unknown tier {rule.get('tier')}")
+        # Thuộc vào key cache: đổi bảng định tuyến => kết quả cũ (sinh bởi model khác) không dùng lại
+        self.signature = make_cache_key('routing', config, enabled)[:16]
+
+    def model_id(self, tier: Optional[str] = None) -> str:
+        return self.tiers[tier or self.default_tier]
+
+    def _cap(self, task: str) -> int:
+        return int(self.config['tasks'][task].get('max_tokens_cap', 4000))
+
+    def _budget(self, task: str, budget: Any, features: Dict[str, Any]) -> int:
+        if isinstance(budget, dict):
+            tokens = budget.get('base', 0) + sum(
+                budget.get(key, 0) * (features.get(feature) or 0) for key, feature in _BUDGET_FEATURES.items())
+        else:
+            tokens = budget or self._cap(task)
+        return int(max(MIN_MAX_TOKENS, min(self._cap(task), tokens)))
+
+    @staticmethod
+    def _matches(rule: Dict[str, Any], features: Dict[str, Any]) -> bool:
+        for key, expected in rule.items():
+            if key in ('name', 'tier', 'max_tokens'):
+                continue
+            if key.startswith('max_'):
+                if (features.get(key[4:]) or 0) > expected:
+                    return False
+            elif key.startswith('min_'):
+                if (features.get(key[4:]) or 0) < expected:
+                    return False
+            elif isinstance(expected, list):
+                if features.get(key) not in expected:
+                    return False
+            elif features.get(key) != expected:
+                return False
+        return True
+
+    def route(self, task: str, features: Dict[str, Any]) -> ModelRoute:
+        """First matching rule of `task` for these request features"""
+        spec = self.config['tasks'][task]
+        if not self.enabled:
+            return ModelRoute(task, self.default_tier, self.model_id(), int(spec.get('legacy_max_tokens', self._cap(task))),
+                              'disabled', features)
+        for index, rule in enumerate(spec.get('rules', [])):
+            if self._matches(rule, features):
+                return ModelRoute(task, rule['tier'], self.tiers[rule['tier']],
+                                  self._budget(task, rule.get('max_tokens'), features),
+                                  rule.get('name', str(index)), features)
+        return ModelRoute(task, self.default_tier, self.model_id(), self._cap(task), 'fallthrough', features)
+
+    def escalate(self, route: ModelRoute, reason: str) -> Optional[ModelRoute]:
+        """Next tier up with the task's full budget, or None when there is nowhere to go"""
+        if not self.enabled or route.escalations >= self.max_escalations:
+            return None
+        position = self.escalation.index(route.tier) if route.tier in self.escalation else len(self.escalation)
+        cap = self._cap(route.task)
+        if position + 1 < len(self.escalation):
+            tier = self.escalation[position + 1]
+        elif reason == 'max_tokens' and route.max_tokens < cap:
+            # Đã ở tier cao nhất nhưng bị cắt do ngân sách: thử lại cùng tier với ngân sách tối đa
+            tier = route.tier
+        else:
+            return None
+        logger.info('model route escalated', task=route.task, from_tier=route.tier, to_tier=tier, reason=reason)
+        return ModelRoute(route.task, tier, self.tiers[tier], cap, route.rule, route.features, route, reason)
+
+    def run_with_escalation(self, route: ModelRoute, invoke_fn: Callable[[ModelRoute], Tuple[Any, Optional[str]]],
+                            failure_fn: Callable[[Any, Optional[str]], Optional[str]]) -> Tuple[Any, ModelRoute]:
+        """
+        `invoke_fn(route)` -> (parsed output, stop_reason); while `failure_fn(output, stop_reason)` names a
+        reason, retry on the escalated route if the request deadline leaves room for another call about
+        as long as the last one. Returns (output, route used); output is None when the deadline expired
+        during a call (the caller substitutes its fallback).
+        """
+        while True:
+            started = time.perf_counter()
+            try:
+                output, stop_reason = invoke_fn(route)
+            except DeadlineExceeded:
+                record_skip('model_invoke')
+                return None, route
+            failure = failure_fn(output, stop_reason)
+            escalated = self.escalate(route, failure) if failure else None
+            remaining = remaining_time()
+            if escalated is not None and remaining is not None and remaining <= time.perf_counter() - started:
+                # Không đủ thời gian cho một lần gọi nữa
+                record_skip('model_escalation')
+                escalated = None
+            if escalated is None:
+                return output, route
+            increment('model_escalations')
+            route = escalated
+            set_property('model_tier', route.tier)
+            set_value('max_tokens', route.max_tokens)
+
+
+def analysis_failure(analysis: Dict, stop_reason: Optional[str], sections: Tuple[str, ...]) -> Optional[str]:
+    """Why an analysis answer should be retried on a higher tier, or None when it is usable"""
+    if stop_reason == 'max_tokens':
+        return 'max_tokens'
+    if 'detailed_analysis' in analysis:
+        return 'invalid_json'
+    if not all(isinstance(analysis.get(section), dict) for section in sections):
+        return 'missing_sections'
+    return None
+
+
+def load_routing_config() -> Dict[str, Any]:
+    config = copy.deepcopy(DEFAULT_ROUTING)
+    raw = os.environ.get('MODEL_ROUTING_CONFIG', '')
+    path = os.environ.get('MODEL_ROUTING_FILE', '')
+    if not raw and path:
+        with open(path, encoding='utf-8') as f:
+            raw = f.read()
+    if raw:
+        override = json.loads(raw)
+        tasks = override.pop('tasks', {})
+        config.update(override)
+        # Ghi đè theo từng tác vụ để có thể chỉ đổi một tác vụ
+        for task, spec in tasks.items():
+            config['tasks'][task] = {**config['tasks'].get(task, {}), **spec}
+    return config
+
+
+def create_model_router() -> ModelRouter:
+    """Router from MODEL_ROUTING_* settings; falls back to the defaults when the override is invalid"""
+    enabled = os.environ.get('MODEL_ROUTING_ENABLED', 'true').lower() == 'true'
+    try:
+        return ModelRouter(load_routing_config(), enabled)
+    except Exception as e:
+        logger.warning('invalid model routing config, using defaults', error=str(e))
+        return ModelRouter(copy.deepcopy(DEFAULT_ROUTING), enabled)
@@ -0,0 +1,149 @@
+import hashlib
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from diagram_graph import DiagramGraph, as_graph
+from retrieval_cache import normalize_query
+from structured_log import copy_log_context, get_logger
+
+# --- TRUY XUẤT NHIỀU QUERY SONG SONG + RECIPROCAL-RANK FUSION ---
+# Thay vì một query khổng lồ (câu hỏi + mọi nhãn node + từ khóa cố định), tách thành vài
+# query tập trung: câu hỏi, từng cụm node liền kề theo luồng, và các trường trong luật điều kiện.
+# Các query chạy đồng thời trên thread pool dùng chung, kết quả được trộn bằng RRF
+# (score = tổng 1 / (k + hạng)) trước khi lọc ngưỡng / lắp ráp context.
+
+logger = get_logger('retrieval')
+RRF_K = 60
+
+
+def flow_order(graph: DiagramGraph) -> List[int]:
+    """Node indices in BFS order from the start nodes (in-degree 0); unreachable nodes last"""
+    order: List[int] = []
+    seen = bytearray(graph.node_count)
+    roots = [i for i in range(graph.node_count) if graph.in_degree[i] == 0]
+    for start in roots + list(range(graph.node_count)):
+        if seen[start]:
+            continue
+        seen[start] = 1
+        queue = [start]
+        head = 0
+        while head < len(queue):
+            current = queue[head]
+            head += 1
+            order.append(current)
+            for nxt in graph.successors(current):
+                if not seen[nxt]:
+                    seen[nxt] = 1
+                    queue.append(nxt)
+    return order
+
+
+def _rule_text(rule: Any) -> str:
+    if not isinstance(rule, dict):
+        return str(rule)
+    return ' '.join(str(rule.get(k, '')) for k in ('field', 'operator', 'value') if rule.get(k) not in (None, ''))
+
+
+def build_sub_queries(diagram: Union[Dict, DiagramGraph], question: str, max_queries: int = 4) -> List[str]:
+    """
+    Focused retrieval queries: the question, clusters of consecutive nodes along the flow,
+    and the edge-rule conditions. Returns at most `max_queries` distinct queries.
+    """
+    graph = as_graph(diagram)
+    queries: List[str] = []
+    if question and question.strip():
+        queries.append(question.strip())
+
+    rules = []
+    for edge in graph.edges:
+        for rule in edge.rules or []:
+            text = _rule_text(rule).strip()
+            if text and text not in rules:
+                rules.append(text)
+    rule_query = f"Điều kiện và quy tắc kiểm tra: {'; '.join(rules)}" if rules else None
+
+    labels = graph.labels(None)
+    ordered = [str(labels[i]) for i in flow_order(graph) if labels[i] not in (None, '')]
+    slots = max(1, max_queries - len(queries) - (1 if rule_query else 0))
+    if ordered:
+        size = math.ceil(len(ordered) / slots)
+        for start in range(0, len(ordered), size):
+            queries.append(f"Các bước quy trình: {', '.join(ordered[start:start + size])}")
+    if rule_query:
+        queries.append(rule_query)
+
+    distinct: List[str] = []
+    seen = set()
+    for query in queries:
+        key = normalize_query(query)
+        if key not in seen:
+            seen.add(key)
+            distinct.append(query)
+    return distinct[:max_queries]
+
+
+def _result_identity(result: Dict) -> str:
+    location = (result.get('location') or {}).get('s3Location', {}).get('uri', '')
+    text = (result.get('content') or {}).get('text') or ''
+    return location + '#' + hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Dict]], k: int = RRF_K) -> List[Dict]:
+    """
+    Fuse several ranked `retrievalResults` lists. Each fused result keeps the best vector
+    `score` seen (used by the threshold) and gains `fusedScore` / `matchedQueries`.
+    """
+    fused: Dict[str, Dict] = {}
+    for results in ranked_lists:
+        for rank, result in enumerate(results, start=1):
+            identity = _result_identity(result)
+            entry = fused.get(identity)
+            if entry is None:
+                entry = fused[identity] = {**result, 'fusedScore': 0.0, 'matchedQueries': 0}
+            elif result.get('score', 0) > entry.get('score', 0):
+                entry['score'] = result['score']
+            entry['fusedScore'] += 1.0 / (k + rank)
+            entry['matchedQueries'] += 1
+    return sorted(fused.values(), key=lambda r: (-r['fusedScore'], -r.get('score', 0)))
+
+
+class MultiQueryRetriever:
+    """Runs sub-queries concurrently on a lazily created, process-wide thread pool"""
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='kb-retrieve')
+        return self._executor
+
+    def warm(self) -> None:
+        """Start the pool ahead of the first multi-query request (warm-up events)"""
+        self._pool()
+
+    def retrieve(self, queries: List[str], retrieve_one: Callable[[str], List[Dict]]) -> Tuple[List[Dict], int]:
+        """
+        (fused results, number of failed sub-queries). `retrieve_one(query)` returns that query's
+        retrievalResults; a failing sub-query is skipped, so any failure means the result is partial
+        and must not be cached as if it were complete. Raises when every sub-query fails.
+        """
+        if len(queries) == 1:
+            return retrieve_one(queries[0]), 0
+        futures = [self._pool().submit(copy_log_context().run, retrieve_one, query) for query in queries]
+        ranked_lists = []
+        errors = []
+        for query, future in zip(queries, futures):
+            try:
+                ranked_lists.append(future.result())
+            except Exception as e:
+                errors.append(e)
+                logger.warning('sub-query retrieval error', query=query[:60], error=str(e))
+        if not ranked_lists and errors:
+            raise errors[0]
+        return reciprocal_rank_fusion(ranked_lists), len(errors)
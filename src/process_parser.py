@@ -0,0 +1,221 @@
+import re
+import unicodedata
+from typing import Dict, List, Optional, Tuple
+
+# --- PARSER QUY TẮC CHO MÔ TẢ QUY TRÌNH DẠNG CHUỖI MŨI TÊN ---
+# Dựng React Flow JSON trực tiếp (không gọi model) cho các input như:
+#   "A → B → Nếu X → C, Nếu Y → D"
+#   "A → Tách nhánh → Nếu Path A → B, Nếu Path B → C"
+#   "Nộp hồ sơ -> Nếu điểm > 700 và thu nhập > 10tr -> Duyệt, Nếu điểm < 700 -> Từ chối"
+# Quy ước (giống prompt sinh sơ đồ): điều kiện nằm trên EDGE, không tạo node cho điều kiện hay
+# "Tách nhánh"; mệnh đề sau dấu phẩy / chấm phẩy / xuống dòng bắt đầu bằng từ khóa điều kiện là
+# một nhánh khác đi ra từ node nguồn của điều kiện gần nhất; dòng mới không có điều kiện là một
+# chuỗi mới (node trùng nhãn được nối vào node đã có).
+# Input nào không chắc chắn (văn xuôi, điều kiện lẫn "và"/"hoặc", nhánh "ngược lại" / điều kiện phủ định,
+# mũi tên cụt...) => None, caller gọi model như cũ. Mọi pattern được compile một lần khi import.
+
+ARROW_RE = re.compile(r'\s*(?:-{1,2}>|={1,2}>|[→⇒⟶⟹➔➜➝➞])\s*')
+# Mệnh đề mới: dấu phân tách, theo sau là một từ khóa điều kiện
+_CLAUSE_SPLIT_RE = re.compile(
+    r'\s*[,;]\s*(?=(?:nếu|khi|chỉ khi|trường hợp|if|when|path|nhánh)\b)|\s*\n\s*', re.IGNORECASE)
+_CONDITION_LEAD_RE = re.compile(r'^(?:chỉ khi|nếu|khi|trường hợp|if|when)\s+(.+)$', re.IGNORECASE | re.S)
+_BRANCH_LABEL_RE = re.compile(r'^(path|nhánh)\s+([\w-]+)(?:\s+(?:là\s+)?(?:đúng|true))?$', re.IGNORECASE)
+# Bước chỉ đánh dấu điểm rẽ nhánh, không phải bước thực tế
+_SPLIT_STEP_RE = re.compile(r'^(?:tách nhánh|rẽ nhánh|phân nhánh|chia nhánh|điều kiện|split|branch)$', re.IGNORECASE)
+_AND_RE = re.compile(r'\s+(?:và|and)\s+', re.IGNORECASE)
+_OR_RE = re.compile(r'\s+(?:hoặc|or)\s+', re.IGNORECASE)
+# Dấu hiệu văn xuôi: câu kết thúc rồi câu khác bắt đầu, câu hỏi, dấu phẩy / chấm phẩy còn sót trong một
+# bước ("Khách hàng mua hàng, sau đó") — dấu phẩy giữa hai chữ số (10,000) không tính
+_PROSE_RE = re.compile(r'[.!?]\s+\S|[?]$|[,;](?!\d)')
+# Nhánh "còn lại" / điều kiện phủ định ("If not", "Nếu không", "ngược lại", "otherwise"): suy ra đúng điều
+# kiện cần phủ định điều kiện của nhánh anh em => để model xử lý
+_ELSE_STEP_RE = re.compile(
+    r'^(?:ngược lại|còn lại|trường hợp (?:còn lại|khác)|nếu không thì|otherwise|else|if else|or else)\b', re.IGNORECASE)
+_NEGATED_CONDITION_RE = re.compile(r'^(?:not|no|không|chưa|nothing)\b', re.IGNORECASE)
+
+# (pattern, operator, có value hay không) — thứ tự quan trọng: "không chứa" trước "chứa"...
+_RULE_PATTERNS: List[Tuple[re.Pattern, str, bool]] = [
+    (re.compile(r'^(.+?)\s+(?:không chứa|not contains)\s+(.+)$', re.IGNORECASE), 'Không chứa', True),
+    (re.compile(r'^(.+?)\s+(?:chứa|contains)\s+(.+)$', re.IGNORECASE), 'Chứa', True),
+    (re.compile(r'^(.+?)\s+không nằm trong\s+(.+)$', re.IGNORECASE), 'Không nằm trong', True),
+    (re.compile(r'^(.+?)\s+nằm trong\s+(.+)$', re.IGNORECASE), 'Nằm trong', True),
+    (re.compile(r'^(.+?)\s*(?:>|\s+lớn hơn\s+)\s*(.+)$', re.IGNORECASE), 'Lớn hơn', True),
+    (re.compile(r'^(.+?)\s*(?:<|\s+(?:nhỏ|bé) hơn\s+)\s*(.+)$', re.IGNORECASE), 'Nhỏ hơn', True),
+    (re.compile(r'^(.+?)\s+không tồn tại$', re.IGNORECASE), 'Không tồn tại', False),
+    (re.compile(r'^(.+?)\s+tồn tại$', re.IGNORECASE), 'Tồn tại', False),
+    (re.compile(r'^(.+?)\s+(?:là\s+)?(?:sai|false)$', re.IGNORECASE), 'Là false', False),
+    (re.compile(r'^(.+?)\s+(?:là\s+)?(?:đúng|true)$', re.IGNORECASE), 'Là true', False),
+    (re.compile(r'^(.+?)\s*(?:==?|\s+bằng\s+|\s+là\s+)\s*(.+)$', re.IGNORECASE), 'Bằng', True),
+]
+# So sánh không có trong bộ operator của edge (>=, <=, !=...) => để model xử lý
+_UNSUPPORTED_OPERATOR_RE = re.compile(r'>=|<=|≥|≤|!=|≠')
+
+MAX_LABEL_CHARS = 80
+MAX_STEPS = 200
+
+
+class _Unparseable(Exception):
+    pass
+
+
+def _normalize_label(label: str) -> str:
+    return ' '.join(label.split()).casefold()
+
+
+def parse_condition(text: str) -> Optional[Dict]:
+    """
+    Condition text ("điểm > 700 và thu nhập > 10tr", "Path A đúng") -> {'logic', 'rules'},
+    or None when it mixes VÀ and HOẶC or uses an operator edges cannot express.
+    """
+    text = ' '.join(text.split())
+    if not text or _UNSUPPORTED_OPERATOR_RE.search(text):
+        return None
+    has_and, has_or = bool(_AND_RE.search(text)), bool(_OR_RE.search(text))
+    if has_and and has_or:
+        return None
+    logic = 'HOẶC' if has_or else 'VÀ'
+    rules = []
+    for atom in (_OR_RE if has_or else _AND_RE).split(text):
+        rule = _parse_rule(atom.strip())
+        if rule is None:
+            return None
+        rules.append({'id': f'r{len(rules) + 1}', **rule})
+    return {'logic': logic, 'rules': rules}
+
+
+def _parse_rule(atom: str) -> Optional[Dict[str, str]]:
+    if not atom:
+        return None
+    branch = _BRANCH_LABEL_RE.match(atom)
+    if branch:
+        return {'field': branch.group(1).capitalize(), 'operator': 'Bằng', 'value': branch.group(2)}
+    for pattern, operator, has_value in _RULE_PATTERNS:
+        match = pattern.match(atom)
+        if match:
+            field = match.group(1).strip()
+            value = match.group(2).strip() if has_value else ''
+            if not field or (has_value and not value):
+                return None
+            return {'field': field, 'operator': operator, 'value': value}
+    # Không có phép so sánh: bản thân mệnh đề là điều kiện đúng/sai
+    return {'field': atom, 'operator': 'Là true', 'value': ''}
+
+
+def _condition_of(segment: str) -> Optional[str]:
+    """
+    Condition text when `segment` is a condition ("Nếu X", "Path A đúng"), else None.
+    Raises _Unparseable for else-branches and negated conditions.
+    """
+    if _ELSE_STEP_RE.match(segment):
+        raise _Unparseable(f'else branch: {segment[:40]}')
+    lead = _CONDITION_LEAD_RE.match(segment)
+    if lead:
+        if _NEGATED_CONDITION_RE.match(lead.group(1)):
+            raise _Unparseable(f'negated condition: {segment[:40]}')
+        return lead.group(1).strip()
+    if _BRANCH_LABEL_RE.match(segment):
+        return segment
+    return None
+
+
+class _DiagramBuilder:
+    def __init__(self):
+        self.nodes: List[Dict] = []
+        self.edges: List[Dict] = []
+        self._by_label: Dict[str, str] = {}
+        self._edge_keys: set = set()
+
+    def node(self, label: str) -> str:
+        label = label.rstrip(' .')
+        if not label or len(label) > MAX_LABEL_CHARS or _PROSE_RE.search(label):
+            raise _Unparseable(f'step looks like prose: {label[:40]}')
+        key = _normalize_label(label)
+        node_id = self._by_label.get(key)
+        if node_id is None:
+            if len(self.nodes) >= MAX_STEPS:
+                raise _Unparseable('too many steps')
+            node_id = self._by_label[key] = str(len(self.nodes) + 1)
+            self.nodes.append({'id': node_id, 'data': {'label': label}})
+        return node_id
+
+    def edge(self, source: str, target: str, condition: Optional[Dict]) -> None:
+        key = (source, target, repr(condition))
+        if key in self._edge_keys:
+            return
+        self._edge_keys.add(key)
+        edge_id = f'e{source}-{target}'
+        if any(edge['id'] == edge_id for edge in self.edges):
+            edge_id = f'{edge_id}-{len(self.edges) + 1}'
+        edge: Dict = {'id': edge_id, 'source': source, 'target': target}
+        if condition is not None:
+            edge['data'] = condition
+        self.edges.append(edge)
+
+    def diagram(self) -> Dict:
+        has_in = {edge['target'] for edge in self.edges}
+        has_out = {edge['source'] for edge in self.edges}
+        for node in self.nodes:
+            if node['id'] not in has_in:
+                node['type'] = 'input'
+            elif node['id'] not in has_out:
+                node['type'] = 'output'
+            else:
+                node['type'] = 'default'
+        return {'nodes': self.nodes, 'edges': self.edges}
+
+
+def parse_process_text(text: str) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    Build a React Flow diagram from an arrow-chain description.
+    Returns (diagram, None), or (None, reason) when the text should go to the model instead.
+    """
+    text = unicodedata.normalize('NFC', text or '').strip()
+    if not ARROW_RE.search(text):
+        return None, 'no arrows'
+    builder = _DiagramBuilder()
+    # Node nguồn của điều kiện gần nhất: mệnh đề nhánh tiếp theo đi ra từ đây
+    branch_source: Optional[str] = None
+    try:
+        for clause in _CLAUSE_SPLIT_RE.split(text):
+            clause = clause.strip()
+            if not clause:
+                continue
+            segments = [segment.strip() for segment in ARROW_RE.split(clause)]
+            if any(not segment for segment in segments):
+                raise _Unparseable('empty step between arrows')
+            if any(_PROSE_RE.search(segment.rstrip(' .')) for segment in segments):
+                raise _Unparseable('step looks like prose')
+            is_branch = _condition_of(segments[0]) is not None
+            previous: Optional[str] = None
+            if is_branch:
+                if branch_source is None:
+                    raise _Unparseable('branch without a preceding step')
+                previous = branch_source
+            pending: Optional[Dict] = None
+            for segment in segments:
+                if _SPLIT_STEP_RE.match(segment):
+                    continue
+                condition_text = _condition_of(segment)
+                if condition_text is not None:
+                    if previous is None or pending is not None:
+                        raise _Unparseable(f'condition without a source step: {segment[:40]}')
+                    pending = parse_condition(condition_text)
+                    if pending is None:
+                        raise _Unparseable(f'unsupported condition: {condition_text[:40]}')
+                    branch_source = previous
+                    continue
+                current = builder.node(segment)
+                if previous is not None and previous != current:
+                    builder.edge(previous, current, pending)
+                pending = None
+                previous = current
+            if pending is not None:
+                raise _Unparseable('condition without a target step')
+            if branch_source is None:
+                # Chưa có điều kiện nào: nhánh kế tiếp (nếu có) đi ra từ bước cuối của chuỗi này
+                branch_source = previous
+    except _Unparseable as e:
+        return None, str(e)
+    if not builder.edges:
+        return None, 'no edges'
+    return builder.diagram(), None
@@ -0,0 +1,153 @@
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+# --- ĐO THỜI GIAN TỪNG CHẶNG VÀ BỘ ĐẾM, XUẤT DẠNG CLOUDWATCH EMF ---
+# Mỗi invocation có một RequestMetrics (gắn qua contextvars, nên helper ở sâu bên trong không cần
+# truyền tham số). Cuối request ghi ra MỘT dòng JSON theo CloudWatch Embedded Metric Format:
+# CloudWatch tự tạo metric từ dòng log này, không cần gọi PutMetricData.
+#   span('retrieval.kb')          -> thời gian (ms) cộng dồn theo tên chặng
+#   increment('retrieval_cache_hit') -> bộ đếm
+#   set_value('prompt_chars', n)  -> giá trị đo (ghi đè)
+#   set_property('json_extraction_method', 'direct') -> thuộc tính tra cứu (không phải metric)
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'FlowLens')
+
+_current: contextvars.ContextVar[Optional['RequestMetrics']] = contextvars.ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self, function: str, namespace: str = METRICS_NAMESPACE):
+        self.function = function
+        self.namespace = namespace
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+        self.values: Dict[str, float] = {}
+        self.properties: Dict[str, Any] = {}
+        # Batch / sub-query chạy trên nhiều thread nhưng dùng chung object này
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, milliseconds: float) -> None:
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + milliseconds
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_value(self, name: str, value: float) -> None:
+        with self._lock:
+            self.values[name] = value
+
+    def set_property(self, name: str, value: Any) -> None:
+        with self._lock:
+            self.properties[name] = value
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def timings(self) -> Dict[str, Any]:
+        """Response `metadata.timings` block: stage durations so far plus counters"""
+        with self._lock:
+            return {
+                'total_ms': round(self.elapsed_ms(), 2),
+                'stages_ms': {name: round(ms, 2) for name, ms in self.spans.items()},
+                'counters': {**self.counters, **self.values},
+                **({'properties': dict(self.properties)} if self.properties else {})
+            }
+
+    def to_emf(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = [{'Name': 'total_ms', 'Unit': 'Milliseconds'}]
+            record: Dict[str, Any] = {'Function': self.function, 'total_ms': round(self.elapsed_ms(), 3)}
+            for name, ms in self.spans.items():
+                key = f'{name}_ms'
+                metrics.append({'Name': key, 'Unit': 'Milliseconds'})
+                record[key] = round(ms, 3)
+            for name, value in {**self.counters, **self.values}.items():
+                metrics.append({'Name': name, 'Unit': 'Milliseconds' if name.endswith('_ms') else 'Count'})
+                record[name] = value
+            record.update(self.properties)
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['Function']],
+                    'Metrics': metrics
+                }]
+            },
+            **record
+        }
+
+
+def current_metrics() -> Optional[RequestMetrics]:
+    return _current.get()
+
+
+@contextlib.contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time a stage of the current request (no-op outside an instrumented handler)"""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_span(name, (time.perf_counter() - started) * 1000)
+
+
+def increment(name: str, value: float = 1) -> None:
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.increment(name, value)
+
+
+def set_value(name: str, value: float) -> None:
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.set_value(name, value)
+
+
+def set_property(name: str, value: Any) -> None:
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.set_property(name, value)
+
+
+def timings() -> Optional[Dict[str, Any]]:
+    metrics = _current.get()
+    return metrics.timings() if metrics is not None else None
+
+
+def instrumented_handler(function: str) -> Callable:
+    """Decorator: one RequestMetrics per invocation, emitted as an EMF record when the handler returns"""
+    def decorate(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event: Any, context: Any = None) -> Any:
+            metrics = RequestMetrics(function)
+            token = _current.set(metrics)
+            try:
+                response = handler(event, context)
+                if isinstance(response, dict) and 'statusCode' in response:
+                    metrics.set_property('status', response['statusCode'])
+                return response
+            except Exception:
+                metrics.increment('unhandled_error')
+                raise
+            finally:
+                _current.reset(token)
+                if METRICS_ENABLED:
+                    sys.stdout.write(json.dumps(metrics.to_emf(), ensure_ascii=False, default=str) + '\n')
+        return wrapper
+    return decorate
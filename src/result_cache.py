@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from structured_log import get_logger
+
+# --- CACHE KẾT QUẢ DÙNG CHUNG CHO CÁC LAMBDA ---
+# Tầng 1: LRU trong bộ nhớ process (sống qua các lần gọi "warm" của Lambda).
+# Tầng 2: store bền vững có thể thay thế (mặc định SQLite trong /tmp).
+
+logger = get_logger('cache')
+
+# Các field chỉ phục vụ hiển thị trên React Flow, không ảnh hưởng tới ý nghĩa sơ đồ
+NODE_PRESENTATION_KEYS = {
+    'position', 'positionAbsolute', 'width', 'height', 'selected', 'dragging',
+    'style', 'className', 'sourcePosition', 'targetPosition', 'measured'
+}
+EDGE_PRESENTATION_KEYS = {
+    'markerEnd', 'markerStart', 'style', 'type', 'animated', 'selected',
+    'labelStyle', 'labelBgStyle', 'className', 'sourceHandle', 'targetHandle'
+}
+
+
+def canonical_diagram(diagram_json: Dict) -> Dict:
+    """Strip layout/styling fields and order nodes/edges so equal diagrams compare equal"""
+    nodes = [
+        {k: v for k, v in node.items() if k not in NODE_PRESENTATION_KEYS}
+        for node in diagram_json.get('nodes', []) if isinstance(node, dict)
+    ]
+    edges = [
+        {k: v for k, v in edge.items() if k not in EDGE_PRESENTATION_KEYS}
+        for edge in diagram_json.get('edges', []) if isinstance(edge, dict)
+    ]
+    nodes.sort(key=lambda n: str(n.get('id', '')))
+    edges.sort(key=lambda e: (str(e.get('source', '')), str(e.get('target', '')), str(e.get('id', ''))))
+    return {'nodes': nodes, 'edges': edges}
+
+
+def make_cache_key(*parts: Any) -> str:
+    """Stable SHA-256 key over JSON-serializable parts"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-process LRU with optional per-entry TTL"""
+
+    def __init__(self, max_entries: int = 128, ttl_seconds: Optional[float] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        ttl = ttl_seconds if ttl_seconds is not None else self.ttl_seconds
+        expires_at = time.time() + ttl if ttl else 0.0
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class CacheStore:
+    """Interface for the persistent cache tier. Values must be JSON-serializable."""
+
+    def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+
+class SQLiteCacheStore(CacheStore):
+    """SQLite-backed store with TTL and size-based (entries + bytes) LRU eviction"""
+
+    def __init__(self, path: str, max_entries: int = 1000, max_bytes: int = 50 * 1024 * 1024,
+                 ttl_seconds: Optional[float] = 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+            'expires_at REAL NOT NULL, last_access REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache(last_access)')
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at and expires_at < now:
+                self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE cache SET last_access = ? WHERE key = ?', (now, key))
+        return json.loads(value)
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        ttl = ttl_seconds if ttl_seconds is not None else self.ttl_seconds
+        now = time.time()
+        payload = json.dumps(value, ensure_ascii=False)
+        size = len(payload.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)',
+                (key, payload, size, now + ttl if ttl else 0.0, now)
+            )
+            self._evict(now)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute('DELETE FROM cache WHERE expires_at > 0 AND expires_at < ?', (now,))
+        count, total = self._conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache').fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        # Xóa các entry ít được truy cập nhất cho tới khi về dưới ngưỡng
+        victims: List[str] = []
+        for key, size in self._conn.execute('SELECT key, size FROM cache ORDER BY last_access ASC'):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            victims.append(key)
+            count -= 1
+            total -= size
+        self._conn.executemany('DELETE FROM cache WHERE key = ?', [(k,) for k in victims])
+
+
+class TieredCache:
+    """Memory LRU in front of an optional persistent store, with hit/miss counters"""
+
+    def __init__(self, memory: LRUCache, store: Optional[CacheStore] = None):
+        self.memory = memory
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[Optional[Any], Optional[str]]:
+        """Return (value, tier) where tier is 'memory', 'store' or None on a miss"""
+        value = self.memory.get(key)
+        tier = 'memory' if value is not None else None
+        if value is None and self.store is not None:
+            try:
+                value = self.store.get(key)
+            except Exception as e:
+                logger.warning('cache store read error', error=str(e))
+                value = None
+            if value is not None:
+                tier = 'store'
+                self.memory.set(key, value)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value, tier
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        self.memory.set(key, value, ttl_seconds)
+        if self.store is not None:
+            try:
+                self.store.set(key, value, ttl_seconds)
+            except Exception as e:
+                logger.warning('cache store write error', error=str(e))
+
+    def delete(self, key: str) -> None:
+        self.memory.delete(key)
+        if self.store is not None:
+            try:
+                self.store.delete(key)
+            except Exception as e:
+                logger.warning('cache store delete error', error=str(e))
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'memory_entries': len(self.memory)}
+
+
+def create_tiered_cache(prefix: str, default_max_entries: int = 128, default_ttl: float = 3600) -> TieredCache:
+    """
+    Build a TieredCache configured from environment variables:
+    <PREFIX>_CACHE_MAX_ENTRIES, <PREFIX>_CACHE_TTL_SECONDS, <PREFIX>_CACHE_DB (empty = memory only),
+    <PREFIX>_CACHE_DB_MAX_ENTRIES, <PREFIX>_CACHE_DB_MAX_BYTES.
+    """
+    max_entries = int(os.environ.get(f'{prefix}_CACHE_MAX_ENTRIES', default_max_entries))
+    ttl = float(os.environ.get(f'{prefix}_CACHE_TTL_SECONDS', default_ttl))
+    memory = LRUCache(max_entries=max_entries, ttl_seconds=ttl)
+
+    store = None
+    db_path = os.environ.get(f'{prefix}_CACHE_DB', f'/tmp/flowlens_{prefix.lower()}_cache.sqlite3')
+    if db_path:
+        try:
+            store = SQLiteCacheStore(
+                db_path,
+                max_entries=int(os.environ.get(f'{prefix}_CACHE_DB_MAX_ENTRIES', 1000)),
+                max_bytes=int(os.environ.get(f'{prefix}_CACHE_DB_MAX_BYTES', 50 * 1024 * 1024)),
+                ttl_seconds=ttl
+            )
+        except Exception as e:
+            logger.warning('cache store init error', path=db_path, error=str(e))
+            store = None
+    return TieredCache(memory, store)
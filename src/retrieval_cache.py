@@ -0,0 +1,218 @@
+import hmac
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from result_cache import CacheStore, TieredCache, create_tiered_cache, make_cache_key
+from structured_log import get_logger
+
+# --- CACHE KẾT QUẢ TRUY XUẤT KNOWLEDGE BASE ---
+# Lưu context/sources SAU khi đã lọc theo ngưỡng score, key theo (query chuẩn hóa, filter, KB ID).
+# Vô hiệu hóa khi tài liệu được ingest lại bằng "generation": mỗi tài liệu có một bộ đếm,
+# cộng thêm một bộ đếm toàn cục cho các truy vấn không lọc. Entry nào được tạo với
+# generation cũ hơn sẽ bị coi là miss.
+# Bộ đếm phải nằm ở store dùng chung (RETRIEVAL_GENERATION_STORE=dynamodb) thì mới vô hiệu hóa được
+# mọi container Lambda / pod; store 'local' (mặc định) chỉ có tác dụng trong process nhận lệnh.
+# Lệnh vô hiệu hóa không đi qua route công khai: chỉ nhận khi Lambda được gọi trực tiếp (IAM),
+# hoặc qua HTTP kèm header X-Invalidation-Token khớp RETRIEVAL_INVALIDATION_TOKEN.
+
+logger = get_logger('retrieval_cache')
+_WHITESPACE_RE = re.compile(r'\s+')
+GLOBAL_GENERATION_KEY = 'retrieval-gen:__all__'
+INVALIDATE_ACTION = 'invalidateRetrievalCache'
+RETRIEVAL_INVALIDATION_TOKEN = os.environ.get('RETRIEVAL_INVALIDATION_TOKEN', '')
+
+
+def normalize_query(query: str) -> str:
+    """Collapse whitespace and case so cosmetic prompt changes share a cache entry"""
+    return _WHITESPACE_RE.sub(' ', (query or '')).strip().lower()
+
+
+def _generation_key(document_id: str) -> str:
+    return f'retrieval-gen:{document_id}'
+
+
+def invalidation_allowed(event: Dict[str, Any]) -> bool:
+    """
+    Direct (IAM-authorized) invocations may invalidate; HTTP requests (API Gateway proxy events)
+    only with a matching X-Invalidation-Token when RETRIEVAL_INVALIDATION_TOKEN is configured.
+    """
+    if 'httpMethod' not in event and 'requestContext' not in event:
+        return True
+    if not RETRIEVAL_INVALIDATION_TOKEN:
+        return False
+    headers = {str(k).lower(): str(v) for k, v in (event.get('headers') or {}).items()}
+    return hmac.compare_digest(headers.get('x-invalidation-token', ''), RETRIEVAL_INVALIDATION_TOKEN)
+
+
+class GenerationStore:
+    """Ingest generation counters (key -> int, missing = 0)"""
+    # True khi mọi container / pod thấy cùng bộ đếm
+    shared = False
+
+    def read(self, keys: List[str]) -> Dict[str, int]:
+        raise NotImplementedError
+
+    def bump(self, keys: List[str]) -> None:
+        raise NotImplementedError
+
+
+class LocalGenerationStore(GenerationStore):
+    """Counters in this process, mirrored to the cache's persistent tier (SQLite in /tmp) when present"""
+
+    def __init__(self, store: Optional[CacheStore] = None):
+        self.store = store
+        # Generation cục bộ không đi qua LRU để không bao giờ bị evict (evict = quay về 0 = hit dữ liệu cũ)
+        self._local: Dict[str, int] = {}
+
+    def _read_one(self, key: str) -> int:
+        if self.store is not None:
+            try:
+                value = self.store.get(key)
+                if value is not None:
+                    return max(int(value), self._local.get(key, 0))
+            except Exception as e:
+                logger.warning('generation read error', error=str(e))
+        return self._local.get(key, 0)
+
+    def read(self, keys: List[str]) -> Dict[str, int]:
+        return {key: self._read_one(key) for key in keys}
+
+    def bump(self, keys: List[str]) -> None:
+        for key in keys:
+            value = self._local[key] = self._read_one(key) + 1
+            # Trên store, TTL = 0 nghĩa là giữ vĩnh viễn
+            if self.store is not None:
+                try:
+                    self.store.set(key, value, ttl_seconds=0)
+                except Exception as e:
+                    logger.warning('generation write error', error=str(e))
+
+
+class DynamoDBGenerationStore(GenerationStore):
+    """
+    Table with partition key `key` (S) and a numeric `generation` attribute, shared by every
+    container. Reads are cached for `ttl_seconds`, which bounds how long a container may keep
+    serving entries after another one invalidated them.
+    """
+    shared = True
+
+    def __init__(self, table_name: str, ttl_seconds: float = 5.0, client=None):
+        from aws_clients import get_client
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self.client = client or get_client('dynamodb')
+        # key -> (thời điểm đọc, generation)
+        self._cache: Dict[str, Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def read(self, keys: List[str]) -> Dict[str, int]:
+        now = time.monotonic()
+        with self._lock:
+            known = dict(self._cache)
+        missing = [key for key in keys if key not in known or now - known[key][0] >= self.ttl_seconds]
+        fetched: Dict[str, int] = {}
+        try:
+            # batch_get_item nhận tối đa 100 key mỗi lần
+            for start in range(0, len(missing), 100):
+                request = {self.table_name: {'Keys': [{'key': {'S': key}} for key in missing[start:start + 100]],
+                                             'ConsistentRead': True}}
+                for _ in range(3):
+                    response = self.client.batch_get_item(RequestItems=request)
+                    for item in response.get('Responses', {}).get(self.table_name, []):
+                        fetched[item['key']['S']] = int(item['generation']['N'])
+                    request = response.get('UnprocessedKeys') or {}
+                    if not request:
+                        break
+                else:
+                    raise RuntimeError('unprocessed generation keys after retries')
+            fetched.update({key: 0 for key in missing if key not in fetched})
+        except Exception as e:
+            # Dùng giá trị đọc lần trước; không ghi vào cache để lần sau đọc lại
+            logger.warning('generation read error', error=str(e))
+            fetched = {}
+        with self._lock:
+            for key, value in fetched.items():
+                self._cache[key] = (now, value)
+        return {key: fetched[key] if key in fetched else known.get(key, (0, 0))[1] for key in keys}
+
+    def bump(self, keys: List[str]) -> None:
+        for key in keys:
+            response = self.client.update_item(
+                TableName=self.table_name,
+                Key={'key': {'S': key}},
+                UpdateExpression='ADD generation :one',
+                ExpressionAttributeValues={':one': {'N': '1'}},
+                ReturnValues='UPDATED_NEW'
+            )
+            with self._lock:
+                self._cache[key] = (time.monotonic(), int(response['Attributes']['generation']['N']))
+
+
+class RetrievalCache:
+    """TTL cache for post-threshold Knowledge Base retrieval results"""
+
+    def __init__(self, cache: TieredCache, generation_store: Optional[GenerationStore] = None):
+        self.cache = cache
+        self.generation_store = generation_store or LocalGenerationStore(cache.store)
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def generations(self, document_ids: List[str]) -> Dict[str, int]:
+        """Current ingest generations relevant to a (possibly unfiltered) document selection"""
+        if not document_ids:
+            return self.generation_store.read([GLOBAL_GENERATION_KEY])
+        return self.generation_store.read([_generation_key(doc_id) for doc_id in document_ids])
+
+    @staticmethod
+    def build_key(query: str, filter_dict: Optional[Dict], kb_id: str, variant: Any = None) -> str:
+        # `variant`: cấu hình xử lý sau truy xuất (ví dụ ContextAssembler.signature) làm thay đổi kết quả
+        return make_cache_key('retrieval', normalize_query(query), filter_dict or {}, kb_id, variant)
+
+    def get(self, query: str, filter_dict: Optional[Dict], kb_id: str,
+            document_ids: List[str], variant: Any = None) -> Optional[Tuple[str, List[Dict]]]:
+        entry, _ = self.cache.get(self.build_key(query, filter_dict, kb_id, variant))
+        if entry is not None and entry.get('generations') != self.generations(sorted(document_ids or [])):
+            self.stale += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry['context'], entry['sources']
+
+    def set(self, query: str, filter_dict: Optional[Dict], kb_id: str, document_ids: List[str],
+            context: str, sources: List[Dict], variant: Any = None) -> None:
+        self.cache.set(self.build_key(query, filter_dict, kb_id, variant), {
+            'context': context,
+            'sources': sources,
+            'generations': self.generations(sorted(document_ids or []))
+        })
+
+    def invalidate_documents(self, document_ids: List[str]) -> None:
+        """Mark documents as re-ingested; entries filtered on them (and all unfiltered ones) become stale"""
+        self.generation_store.bump([_generation_key(doc_id) for doc_id in document_ids] + [GLOBAL_GENERATION_KEY])
+
+    def stats(self) -> Dict[str, Any]:
+        return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale, 'memory_entries': len(self.cache.memory)}
+
+
+def create_generation_store(cache: TieredCache) -> GenerationStore:
+    """RETRIEVAL_GENERATION_STORE = local | dynamodb (RETRIEVAL_GENERATION_TABLE, RETRIEVAL_GENERATION_TTL_SECONDS)"""
+    kind = os.environ.get('RETRIEVAL_GENERATION_STORE', 'local').lower()
+    if kind == 'dynamodb':
+        return DynamoDBGenerationStore(os.environ['RETRIEVAL_GENERATION_TABLE'],
+                                       ttl_seconds=float(os.environ.get('RETRIEVAL_GENERATION_TTL_SECONDS', 5)))
+    if os.environ.get('AWS_LAMBDA_FUNCTION_NAME'):
+        logger.warning('retrieval cache invalidation only reaches the container that receives it; '
+                       'set RETRIEVAL_GENERATION_STORE=dynamodb to share it')
+    return LocalGenerationStore(cache.store)
+
+
+def create_retrieval_cache() -> RetrievalCache:
+    """Configured via RETRIEVAL_CACHE_* and RETRIEVAL_GENERATION_* environment variables (see create_tiered_cache)"""
+    cache = create_tiered_cache('RETRIEVAL', default_max_entries=256, default_ttl=15 * 60)
+    return RetrievalCache(cache, create_generation_store(cache))
@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from request_metrics import increment
+
+# --- GỘP CÁC REQUEST GIỐNG HỆT ĐANG CHẠY (SINGLE-FLIGHT) ---
+# Nhiều người cùng mở một sơ đồ được chia sẻ, hoặc một người bấm gửi hai lần => các request giống hệt
+# chạy song song, mỗi request tự truy xuất KB và tự gọi model. Với single-flight, request đầu tiên
+# với một key thực thi; các request trùng key đến khi nó còn đang chạy chỉ chờ cùng một Future
+# và nhận cùng kết quả (hoặc cùng exception). Xong việc key được gỡ khỏi bảng: request đến sau
+# đó đi qua cache kết quả như bình thường.
+# Phạm vi là một process (mọi thread, kể cả server chạy lâu); giữa các container Lambda khác nhau
+# thì không gộp được (dùng mode=async: job ID suy ra từ hash nội dung).
+# Request chờ chỉ chờ trong thời gian còn lại của CHÍNH nó (`timeout`), không phụ thuộc deadline của
+# request dẫn đầu; kết quả dẫn đầu bị cắt ngắn thì entry phải tự ghi điều đó để request chờ báo lại.
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution of fn"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any], timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        (fn's result, whether it came from another caller's in-flight execution).
+        A joining caller waits at most `timeout` seconds, then raises TimeoutError.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            increment(f'{self.name}_coalesced')
+            try:
+                return future.result(timeout=timeout), True
+            except FutureTimeoutError:
+                # Exception của chính fn (kể cả TimeoutError) được ném lại nguyên vẹn
+                if future.done():
+                    raise
+                increment(f'{self.name}_wait_timeout')
+                raise TimeoutError(f'{self.name}: in-flight call did not finish within {timeout:.1f}s') from None
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> Dict[str, int]:
+        return {'executions': self.executions, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
@@ -0,0 +1,172 @@
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from typing import Any, Callable, Dict, Optional
+
+# --- LOG CÓ CẤU TRÚC DÙNG CHUNG CHO CÁC LAMBDA ---
+# Mỗi bản ghi là một dòng JSON (CloudWatch Logs Insights truy vấn được theo field).
+# - Lọc theo level (LOG_LEVEL, mặc định INFO) TRƯỚC khi format: field là callable hoặc Payload
+#   chỉ được tính / serialize khi bản ghi thực sự được ghi ra.
+# - Payload lớn (event, prompt, text model, context...) bị cắt còn LOG_MAX_FIELD_CHARS ký tự,
+#   kèm độ dài gốc và sha256 để vẫn đối chiếu được giữa các lần gọi.
+# - Bật DEBUG cho riêng một invocation: header `X-Debug-Log: 1` hoặc `"debugLog": true` trong event;
+#   hoặc lấy mẫu ngẫu nhiên LOG_DEBUG_SAMPLE_RATE (0..1) số request.
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+_LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+_LEVELS_BY_NAME = {name: level for level, name in _LEVEL_NAMES.items()}
+
+
+def _env_level() -> int:
+    return _LEVELS_BY_NAME.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), INFO)
+
+
+LOG_MAX_FIELD_CHARS = int(os.environ.get('LOG_MAX_FIELD_CHARS', 2000))
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0))
+
+# Trạng thái theo request (contextvars => đúng cả khi nhiều request chạy đồng thời trên asyncio)
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('log_request_id', default=None)
+_request_level: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar('log_request_level', default=None)
+
+
+class Payload:
+    """Large value logged as a truncated preview plus length and hash; serialized only on emit"""
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value: Any, limit: Optional[int] = None):
+        self.value = value
+        self.limit = limit
+
+    def render(self) -> Any:
+        value = self.value() if callable(self.value) else self.value
+        text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+        limit = self.limit or LOG_MAX_FIELD_CHARS
+        if len(text) <= limit:
+            return text
+        return {
+            'preview': text[:limit],
+            'chars': len(text),
+            'sha256': hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+        }
+
+
+def _render_field(value: Any) -> Any:
+    if isinstance(value, Payload):
+        return value.render()
+    if callable(value):
+        value = value()
+    if isinstance(value, str) and len(value) > LOG_MAX_FIELD_CHARS:
+        return Payload(value).render()
+    return value
+
+
+class StructuredLogger:
+    def __init__(self, name: str):
+        self.name = name
+
+    def is_enabled(self, level: int) -> bool:
+        request_level = _request_level.get()
+        return level >= (request_level if request_level is not None else _env_level())
+
+    def log(self, level: int, message: str, **fields: Any) -> None:
+        if not self.is_enabled(level):
+            return
+        record: Dict[str, Any] = {
+            'ts': round(time.time(), 3),
+            'level': _LEVEL_NAMES.get(level, str(level)),
+            'logger': self.name,
+            'msg': message
+        }
+        request_id = _request_id.get()
+        if request_id:
+            record['request_id'] = request_id
+        for key, value in fields.items():
+            try:
+                record[key] = _render_field(value)
+            except Exception as e:
+                record[key] = f'<unrenderable: {e}>'
+        sys.stdout.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+    def debug(self, message: str, **fields: Any) -> None:
+        self.log(DEBUG, message, **fields)
+
+    def info(self, message: str, **fields: Any) -> None:
+        self.log(INFO, message, **fields)
+
+    def warning(self, message: str, **fields: Any) -> None:
+        self.log(WARNING, message, **fields)
+
+    def error(self, message: str, **fields: Any) -> None:
+        self.log(ERROR, message, **fields)
+
+
+_loggers: Dict[str, StructuredLogger] = {}
+
+
+def get_logger(name: str) -> StructuredLogger:
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers[name] = StructuredLogger(name)
+    return logger
+
+
+def debug_requested(event: Any) -> bool:
+    """Per-invocation debug toggle: `X-Debug-Log` header or top-level `debugLog` flag"""
+    if not isinstance(event, dict):
+        return False
+    if event.get('debugLog') is True:
+        return True
+    headers = event.get('headers') or {}
+    for key, value in headers.items():
+        if key.lower() == 'x-debug-log':
+            return str(value).lower() in ('1', 'true', 'yes')
+    return False
+
+
+def begin_request(event: Any, context: Any = None) -> Dict[str, contextvars.Token]:
+    """Bind request ID and effective level for this invocation; pass the result to end_request"""
+    request_id = getattr(context, 'aws_request_id', None)
+    level = DEBUG if debug_requested(event) or (LOG_DEBUG_SAMPLE_RATE and random.random() < LOG_DEBUG_SAMPLE_RATE) else None
+    return {'id': _request_id.set(request_id), 'level': _request_level.set(level)}
+
+
+def end_request(tokens: Dict[str, contextvars.Token]) -> None:
+    _request_id.reset(tokens['id'])
+    _request_level.reset(tokens['level'])
+
+
+def logged_handler(logger: StructuredLogger) -> Callable:
+    """Decorator for Lambda handlers: binds per-request log state and logs duration / status"""
+    def decorate(handler: Callable) -> Callable:
+        @functools.wraps(handler)
+        def wrapper(event: Any, context: Any = None) -> Any:
+            tokens = begin_request(event, context)
+            started = time.perf_counter()
+            try:
+                logger.debug('raw event', event=Payload(event))
+                response = handler(event, context)
+                logger.info('request completed',
+                            status=response.get('statusCode') if isinstance(response, dict) else None,
+                            duration_ms=round((time.perf_counter() - started) * 1000, 1))
+                return response
+            except Exception as e:
+                logger.error('request failed', error=str(e), duration_ms=round((time.perf_counter() - started) * 1000, 1))
+                raise
+            finally:
+                end_request(tokens)
+        return wrapper
+    return decorate
+
+
+def copy_log_context() -> contextvars.Context:
+    """Snapshot to run worker-thread code with the caller's request ID / level (ctx.run(fn, ...))"""
+    return contextvars.copy_context()
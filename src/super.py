@@ -1,24 +1,85 @@
 import json
-import boto3
-from typing import Dict, Any, List, Tuple
+from typing import Dict, Any, List, Optional, Tuple, Union
 import os
+from retrieval_cache import INVALIDATE_ACTION, create_retrieval_cache, invalidation_allowed
+from context_assembly import create_context_assembler
+from multi_query import MultiQueryRetriever, build_sub_queries
+from local_retrieval import create_retriever
+from circuit_breaker import CircuitOpenError, create_circuit_breaker
+from structured_log import Payload, get_logger, logged_handler
+from aws_clients import LazyClient, is_warmup_event, warm_up
+from request_metrics import increment, instrumented_handler, set_property, set_value, span, timings
+from diagram_graph import DiagramGraph, as_graph
+from diagram_encoding import DIAGRAM_FORMATS, encoding_details, render_diagram_for_prompt
+from json_stream import extract_json_object
+from model_routing import ModelRoute, analysis_failure, create_model_router
+from deadlines import (
+    DEADLINE_RETRIEVAL_SHARE, DeadlineExceeded, call_with_deadline, deadline_handler, deadline_summary,
+    hedged_call, record_skip, remaining_time
+)
 
 # --- KHỞI TẠO CLIENTS BÊN NGOÀI HANDLER ĐỂ TÁI SỬ DỤNG (BEST PRACTICE) ---
-bedrock_runtime = boto3.client('bedrock-runtime', region_name='us-east-1')
-bedrock_agent = boto3.client('bedrock-agent-runtime', region_name='us-east-1')
+# Client dùng chung, tạo lười ở lần gọi đầu tiên (pool / timeout / retry: xem aws_clients.py)
+bedrock_runtime = LazyClient('bedrock-runtime')
+bedrock_agent = LazyClient('bedrock-agent-runtime')
 kb_id = os.environ.get('KNOWLEDGE_BASE_ID', 'YOUR-KB-ID')
+logger = get_logger('super')
 
+# Cache kết quả truy xuất KB (cấu hình qua RETRIEVAL_CACHE_*), dùng lại giữa các lần gọi warm
+retrieval_cache = create_retrieval_cache()
+context_assembler = create_context_assembler()
+# 'single': một query gộp (như cũ). 'multi': vài query tập trung chạy song song, trộn bằng RRF
+RETRIEVAL_MODE = os.environ.get('RETRIEVAL_MODE', 'single')
+RETRIEVAL_MAX_SUBQUERIES = int(os.environ.get('RETRIEVAL_MAX_SUBQUERIES', 4))
+multi_query_retriever = MultiQueryRetriever(max_workers=int(os.environ.get('RETRIEVAL_MAX_WORKERS', 8)))
+# Nguồn truy xuất (RETRIEVER=bedrock | local | bedrock+local, xem local_retrieval.py)
+knowledge_retriever = create_retriever(kb_id, lambda: bedrock_agent)
+# Circuit breaker của Knowledge Base (dùng chung trong process với retriever, cấu hình qua KB_BREAKER_*)
+kb_breaker = create_circuit_breaker('KB')
+# Context dự phòng khi truy xuất lỗi / mạch đang mở; phân tích dựa trên nó không được cache
+RETRIEVAL_ERROR_CONTEXT = "Lỗi truy xuất Knowledge Base. Sử dụng kiến thức cơ bản để phân tích."
+RETRIEVAL_CACHE_VARIANT = {**context_assembler.signature, 'mode': RETRIEVAL_MODE, 'retriever': knowledge_retriever.name}
+# Chọn tier model + max_tokens theo độ phức tạp của sơ đồ (cấu hình qua MODEL_ROUTING_*, xem model_routing.py)
+model_router = create_model_router()
+ANALYSIS_SECTIONS = ('overview', 'components', 'execution', 'evaluation', 'improvement', 'summary')
+# Hết thời gian của request trước khi truy xuất / model trả về (xem deadlines.py)
+RETRIEVAL_SKIPPED_CONTEXT = "Bỏ qua truy xuất Knowledge Base do hết thời gian xử lý. Sử dụng kiến thức cơ bản để phân tích."
+DEADLINE_ANALYSIS_TEXT = "Hết thời gian xử lý trước khi mô hình trả về kết quả. Vui lòng thử lại."
 
+
+@logged_handler(logger)
+@instrumented_handler('super')
+@deadline_handler
 def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     """
     Analyze diagram using RAG with Knowledge Base, now with document filtering.
     """
+    # Ping giữ ấm: khởi tạo sẵn client, cache và thread pool rồi trả về, không gọi model
+    if is_warmup_event(event):
+        return {'statusCode': 200, 'body': json.dumps(warm_up(
+            ['bedrock-runtime', 'bedrock-agent-runtime'],
+            {'retrieval_cache': retrieval_cache.stats, 'retrieval_pool': multi_query_retriever.warm}
+        ))}
+
     try:
         # Nhất quán hóa việc xử lý body để hoạt động với cả API Gateway và Test Console
-        if isinstance(event.get('body'), str):
-            body = json.loads(event['body'])
-        else:
-            body = event.get('body', event)
+        with span('parse'):
+            if isinstance(event.get('body'), str):
+                body = json.loads(event['body'])
+            else:
+                body = event.get('body', event)
+
+        # Pipeline ingest gọi action này sau khi tài liệu được nạp lại vào Knowledge Base
+        # (gọi trực tiếp Lambda bằng IAM; qua HTTP phải kèm X-Invalidation-Token)
+        if body.get('action') == INVALIDATE_ACTION:
+            if not invalidation_allowed(event):
+                return create_error_response(403, 'Retrieval cache invalidation is not allowed on this route')
+            retrieval_cache.invalidate_documents(body.get('documentIds', []))
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True, 'invalidated': body.get('documentIds', [])}, ensure_ascii=False)
+            }
 
         diagram_json = body.get('diagram', {})
         user_question = body.get('question', 'Hãy phân tích sơ đồ này')
@@ -26,28 +87,45 @@ def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
         # === THAY ĐỔI 1: NHẬN THÊM MẢNG `selectedDocumentIds` TỪ INPUT ===
         # Nếu không có key này, nó sẽ mặc định là một mảng rỗng, đảm bảo tính tương thích ngược.
         selected_document_ids = body.get('selectedDocumentIds', [])
+        # 'json' (mặc định) hoặc 'compact' (DSL gọn, ít token hơn)
+        diagram_format = body.get('diagramFormat', 'json')
         
         if not diagram_json:
             return create_error_response(400, 'Diagram data is required')
+        if diagram_format not in DIAGRAM_FORMATS:
+            return create_error_response(400, f"diagramFormat must be one of {list(DIAGRAM_FORMATS)}")
 
     except Exception as e:
         return create_error_response(400, f'Invalid input format: {str(e)}')
 
     try:
+        # Dựng đồ thị một lần, dùng chung cho tóm tắt sơ đồ và metadata
+        graph = DiagramGraph.from_dict(diagram_json)
+
         # Step 1: Truy xuất context, truyền thêm `selected_document_ids` để lọc
-        context, sources = retrieve_from_knowledge_base_with_sources(
-            diagram_json,
-            user_question,
-            selected_document_ids
-        )
+        # Chỉ được một phần thời gian còn lại của request; quá hạn => phân tích không có context
+        try:
+            with span('retrieval'):
+                context, sources = call_with_deadline(
+                    lambda: retrieve_from_knowledge_base_with_sources(graph, user_question, selected_document_ids),
+                    'retrieval',
+                    remaining_time(DEADLINE_RETRIEVAL_SHARE)
+                )
+        except DeadlineExceeded:
+            record_skip('retrieval')
+            context, sources = RETRIEVAL_SKIPPED_CONTEXT, []
+
+        diagram_text, encoding_info = render_diagram_for_prompt(graph, diagram_format)
 
         # Step 2: Phân tích với Claude, sử dụng context đã được lọc và sources đã được làm giàu
-        analysis = analyze_with_claude_structured(
+        analysis, route = analyze_with_claude_structured(
             bedrock_runtime,
             diagram_json,
             user_question,
             context,
-            sources
+            sources,
+            diagram_text=diagram_text,
+            route=route_analysis(graph, user_question, context)
         )
 
         return {
@@ -62,9 +140,19 @@ def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
                 'sources': sources, # `sources` giờ đã chứa thông tin chi tiết hơn
                 'metadata': {
                     'context_sources': len(sources), # Giờ đếm theo số source thật
-                    'diagram_complexity': calculate_complexity(diagram_json),
+                    'diagram_complexity': calculate_complexity(graph),
                     'question': user_question,
-                    'is_filtered': bool(selected_document_ids) # Thêm metadata cho biết có lọc hay không
+                    'is_filtered': bool(selected_document_ids), # Thêm metadata cho biết có lọc hay không
+                    'diagram_encoding': encoding_details(graph, encoding_info) if body.get('includeTimings') else encoding_info,
+                    # Tier model / max_tokens đã dùng (kể cả các lần nâng tier khi output không đạt)
+                    'route': route.as_dict(),
+                    'retrieval_cache': retrieval_cache.stats(),
+                    # Trạng thái circuit breaker của Knowledge Base (closed / open / half_open)
+                    'kb_breaker': kb_breaker.snapshot(),
+                    # Ngân sách thời gian của request; `partial` = có chặng bị bỏ qua / cắt ngắn vì hết giờ
+                    'deadline': deadline_summary(),
+                    # Thời gian từng chặng + bộ đếm khi request gửi `"includeTimings": true`
+                    **({'timings': timings()} if body.get('includeTimings') else {})
                 }
             }, ensure_ascii=False)
         }
@@ -72,7 +160,7 @@ def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     except Exception as e:
         return create_error_response(500, f'Analysis error: {str(e)}')
 
-def retrieve_from_knowledge_base_with_sources(diagram_json: Dict, question: str, selected_document_ids: List[str]) -> Tuple[str, List[Dict]]:
+def retrieve_from_knowledge_base_with_sources(diagram_json: Union[Dict, DiagramGraph], question: str, selected_document_ids: List[str]) -> Tuple[str, List[Dict]]:
     """
     Retrieve relevant context from Knowledge Base with source tracking and optional filtering.
     """
@@ -87,11 +175,14 @@ def retrieve_from_knowledge_base_with_sources(diagram_json: Dict, question: str,
     - Các tiêu chí đánh giá chất lượng
     - Đề xuất cải tiến
     """
+    queries = build_sub_queries(diagram_json, question, RETRIEVAL_MAX_SUBQUERIES) if RETRIEVAL_MODE == 'multi' else [query]
+    query = '\n'.join(queries)
     
     # === THAY ĐỔI 2: XÂY DỰNG CẤU HÌNH TRUY XUẤT ĐỘNG VỚI BỘ LỌC ===
     retrieval_config = {
         'vectorSearchConfiguration': {
-            'numberOfResults': 4,
+            # Lấy dư để ContextAssembler có chỗ xếp hạng lại / bỏ trùng
+            'numberOfResults': context_assembler.fetch_k,
             'overrideSearchType': 'HYBRID'
         }
     }
@@ -120,54 +211,77 @@ def retrieve_from_knowledge_base_with_sources(diagram_json: Dict, question: str,
         # Gán bộ lọc đã được xây dựng đúng cách vào cấu hình
         retrieval_config['vectorSearchConfiguration']['filter'] = filter_dict
 
-    print("--- Retrieval Config ---")
-    print(json.dumps(retrieval_config, indent=2))
+    logger.debug('retrieval query', query=Payload(query), config=Payload(retrieval_config))
     
+    filter_dict = retrieval_config['vectorSearchConfiguration'].get('filter')
+    increment('retrieval_filtered' if filter_dict else 'retrieval_unfiltered')
+    cached = retrieval_cache.get(query, filter_dict, kb_id, selected_document_ids, variant=RETRIEVAL_CACHE_VARIANT)
+    if cached is not None:
+        increment('retrieval_cache_hit')
+        logger.info('retrieval cache hit', sources=len(cached[1]))
+        return cached
+    increment('retrieval_cache_miss')
+
     try:
-        response = bedrock_agent.retrieve(
-            knowledgeBaseId=kb_id,
-            retrievalQuery={'text': query},
-            retrievalConfiguration=retrieval_config # Sử dụng cấu hình động
-        )
+        # Nhiều sub-query: chạy đồng thời rồi trộn bằng reciprocal-rank fusion
+        with span('retrieval.kb'):
+            retrieval_results, failed_queries = multi_query_retriever.retrieve(
+                queries,
+                lambda query_text: knowledge_retriever.retrieve(query_text, retrieval_config) # Sử dụng cấu hình động
+            )
+        increment('retrieval_hits', len(retrieval_results))
         
-        print("--- Bedrock Raw Response ---")
-        print(json.dumps(response, indent=2))
+        logger.debug('retrieval results', results=Payload(retrieval_results))
         
-        context_parts = []
-        sources = []
-        
-        for i, result in enumerate(response['retrievalResults']):
-            score = result.get('score', 0)
-            if score > 0.2:
-                print(f"--- Processing Result {i+1} (Score: {score}) ---")
-                # Thêm vào context để AI đọc
-                full_retrieved_text = result['content']['text']
-                context_parts.append(f"Nguồn [{i+1}]:\n{result['content']['text']}")
-                
-                # === THAY ĐỔI 3: LÀM GIÀU THÔNG TIN NGUỒN TRẢ VỀ ===
-                metadata = result.get('metadata', {})
-                s3_location = result.get('location', {}).get('s3Location', {})
-                
-                source_info = {
-                    'citationId': i + 1,  # ID tạm thời để trích dẫn trong văn bản, ví dụ: (Nguồn [1])
-                    'documentId': metadata.get('document_id', 'N/A'), # Lấy ID thật từ metadata
-                    'title': metadata.get('document_name', s3_location.get('uri', '').split('/')[-1]), # Ưu tiên lấy title từ metadata
-                    's3_uri': s3_location.get('uri', ''),
-                    'score': score,
-                    'content_preview': full_retrieved_text[:150] + "..." if len(full_retrieved_text) > 150 else full_retrieved_text,
-                    'full_retrieved_text': full_retrieved_text
-                }
-                sources.append(source_info)
-        
-        context = "\n\n".join(context_parts) if context_parts else "Không tìm thấy thông tin liên quan trong các tài liệu đã chọn."
+        # Lấy dư K chunk, xếp hạng lại theo nhãn sơ đồ + câu hỏi, bỏ trùng và cắt theo ngân sách token
+        with span('retrieval.assembly'):
+            rerank_text = ' '.join([question or ''] + [str(label) for label in as_graph(diagram_json).labels('')])
+            context, sources, assembly_stats = context_assembler.assemble(retrieval_results, rerank_text)
+        logger.info('context assembled', queries=len(queries), failed_queries=failed_queries, **assembly_stats)
+
+        # Có sub-query lỗi => kết quả chỉ là một phần, không cache để lần sau truy xuất lại đầy đủ
+        if failed_queries:
+            increment('retrieval_partial')
+        else:
+            retrieval_cache.set(query, filter_dict, kb_id, selected_document_ids, context, sources,
+                                variant=RETRIEVAL_CACHE_VARIANT)
         return context, sources
         
+    except CircuitOpenError as e:
+        # KB đang lỗi / chậm: trả context dự phòng ngay, không chờ lời gọi thất bại
+        increment('retrieval_short_circuit')
+        logger.info('knowledge base circuit open, using fallback context', retry_in_s=round(e.retry_in, 1))
+        return RETRIEVAL_ERROR_CONTEXT, []
     except Exception as e:
-        print(f"Knowledge Base retrieval error: {e}")
-        return "Lỗi truy xuất Knowledge Base. Sử dụng kiến thức cơ bản để phân tích.", []
+        increment('retrieval_error')
+        logger.error('knowledge base retrieval error', error=str(e))
+        return RETRIEVAL_ERROR_CONTEXT, []
+    finally:
+        set_property('kb_breaker_state', kb_breaker.state)
+
+def route_analysis(graph: DiagramGraph, question: str, context: str) -> ModelRoute:
+    """Model tier and output budget for one analysis"""
+    route = model_router.route('analysis', {
+        'nodes': graph.node_count,
+        'edges': graph.edge_count,
+        'conditional_edges': graph.conditional_edge_count,
+        'input_chars': len(question or '') + len(context or ''),
+        'complexity': calculate_complexity(graph)
+    })
+    set_property('model_tier', route.tier)
+    set_value('max_tokens', route.max_tokens)
+    return route
 
-def analyze_with_claude_structured(bedrock_runtime, diagram_json: Dict, question: str, context: str, sources: List[Dict]) -> Dict:
-    """Analyze diagram with Claude using RAG context and return structured JSON"""
+def analyze_with_claude_structured(bedrock_runtime, diagram_json: Dict, question: str, context: str, sources: List[Dict],
+                                   diagram_text: Optional[str] = None,
+                                   route: Optional[ModelRoute] = None) -> Tuple[Dict, ModelRoute]:
+    """
+    Analyze diagram with Claude using RAG context and return (structured JSON, route used).
+    An answer that is truncated or not valid JSON is retried once on the next model tier.
+    """
+    route = route or route_analysis(as_graph(diagram_json), question, context)
+    if diagram_text is None:
+        diagram_text = json.dumps(diagram_json, ensure_ascii=False, indent=2)
     
     source_refs = ""
     if sources:
@@ -182,7 +296,7 @@ def analyze_with_claude_structured(bedrock_runtime, diagram_json: Dict, question
     Bạn là chuyên gia phân tích quy trình và sơ đồ hệ thống. Hãy phân tích chi tiết sơ đồ sau và trả về kết quả dưới dạng JSON theo schema đã định.
     
     SƠ ĐỒ CẦN PHÂN TÍCH:
-    {json.dumps(diagram_json, ensure_ascii=False, indent=2)}
+    {diagram_text}
     
     CÂU HỎI CỦA NGƯỜI DÙNG:
     {question}
@@ -237,12 +351,12 @@ def analyze_with_claude_structured(bedrock_runtime, diagram_json: Dict, question
     
     Hãy phân tích chi tiết và trả về JSON hoàn chỉnh. Nhớ trích dẫn nguồn khi sử dụng thông tin từ tài liệu tham khảo.
     """
-    
-    response = bedrock_runtime.invoke_model(
-        modelId='anthropic.claude-3-sonnet-20240229-v1:0',
-        body=json.dumps({
+    increment('prompt_chars', len(prompt))
+
+    def invoke(route: ModelRoute) -> Tuple[Dict, Optional[str]]:
+        request_body = json.dumps({
             "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 4000,
+            "max_tokens": route.max_tokens,
             "temperature": 0.2,
             "messages": [
                 {
@@ -251,30 +365,45 @@ def analyze_with_claude_structured(bedrock_runtime, diagram_json: Dict, question
                 }
             ]
         })
-    )
-    
-    response_body = json.loads(response['body'].read())
-    analysis_text = response_body['content'][0]['text']
-    
-    try:
-        start_idx = analysis_text.find('{')
-        end_idx = analysis_text.rfind('}') + 1
-        if start_idx != -1 and end_idx != -1:
-            json_str = analysis_text[start_idx:end_idx]
-            return json.loads(json_str)
-        else:
-            return create_fallback_structure(analysis_text)
-    except json.JSONDecodeError:
+
+        def call() -> Dict:
+            response = bedrock_runtime.invoke_model(modelId=route.model_id, body=request_body)
+            return json.loads(response['body'].read())
+
+        # Trong ngân sách thời gian còn lại của request (gửi request dự phòng khi bật hedging)
+        with span('model_invoke'):
+            response_body = hedged_call(call, route.model_id)
+        analysis_text = response_body['content'][0]['text']
+        increment('response_chars', len(analysis_text))
+        return parse_analysis_text(analysis_text), response_body.get('stop_reason')
+
+    # Output không đạt => thử lại ở tier cao hơn (model_routing.run_with_escalation)
+    analysis, route = model_router.run_with_escalation(
+        route, invoke, lambda analysis, stop_reason: analysis_failure(analysis, stop_reason, ANALYSIS_SECTIONS))
+    if analysis is None:
+        return create_fallback_structure(DEADLINE_ANALYSIS_TEXT), route
+    return analysis, route
+
+def parse_analysis_text(analysis_text: str) -> Dict:
+    """Extract the analysis JSON object from the model text, falling back to a fixed structure"""
+    # Bộ trích xuất dùng chung (json_stream.py): bỏ qua ngoặc nằm trong chuỗi / lời dẫn của model
+    with span('json_extract'):
+        result = extract_json_object(analysis_text)
+    set_property('json_extraction_method', result.method)
+    if not result:
+        increment('analysis_fallback_structure')
+        logger.warning('analysis JSON extraction failed', error=result.error, position=result.error_pos)
         return create_fallback_structure(analysis_text)
+    return result.value
 
 # --- CÁC HÀM HELPER KHÁC GIỮ NGUYÊN KHÔNG THAY ĐỔI ---
 
-def create_diagram_summary(diagram_json: Dict) -> str:
+def create_diagram_summary(diagram_json: Union[Dict, DiagramGraph]) -> str:
     """Create concise diagram summary for KB query"""
     try:
-        nodes = diagram_json.get('nodes', [])
-        node_labels = [node.get('data', {}).get('label', 'Unknown') for node in nodes]
-        return f"Sơ đồ có {len(nodes)} bước: {' -> '.join(node_labels[:5])}{'...' if len(node_labels) > 5 else ''}"
+        graph = as_graph(diagram_json)
+        node_labels = graph.labels('Unknown')
+        return f"Sơ đồ có {graph.node_count} bước: {' -> '.join(node_labels[:5])}{'...' if len(node_labels) > 5 else ''}"
     except:
         return "Sơ đồ quy trình"
 
@@ -291,12 +420,12 @@ def create_fallback_structure(analysis_text: str) -> Dict:
         "detailed_analysis": analysis_text
     }
 
-def calculate_complexity(diagram_json: Dict) -> str:
+def calculate_complexity(diagram_json: Union[Dict, DiagramGraph]) -> str:
     """Calculate diagram complexity"""
-    # This function remains unchanged.
     try:
-        nodes_count = len(diagram_json.get('nodes', []))
-        edges_count = len(diagram_json.get('edges', []))
+        graph = as_graph(diagram_json)
+        nodes_count = graph.node_count
+        edges_count = graph.edge_count
         branching_score = edges_count / max(nodes_count, 1)
         if nodes_count <= 3: return "Đơn giản"
         elif nodes_count <= 6 and branching_score < 1.5: return "Trung bình"
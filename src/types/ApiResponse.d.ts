@@ -34,12 +34,68 @@ export interface DiagramEdge {
 
 // --- METADATA FOR DIAGRAM RESPONSE ---
 
+// Tier model + max_tokens được chọn theo độ phức tạp (attempts > 1 khi đã nâng tier)
+export interface ModelRoute {
+  tier: string;
+  model_id: string;
+  max_tokens: number;
+  rule: string;
+  escalated: boolean;
+  attempts: { tier: string; max_tokens: number; escalation_reason?: string }[];
+  features: Record<string, number | string | boolean>;
+}
+
+// Ngân sách thời gian của request; partial = có chặng bị bỏ qua / cắt ngắn vì hết giờ
+export interface RequestDeadline {
+  budget_ms: number;
+  remaining_ms: number;
+  skipped: string[];
+  partial: boolean;
+}
+
 export interface DiagramMetadata {
   nodes_count: number;
   edges_count: number;
   input_text: string;
   has_image: boolean;
   language: string;
+  // "rules" = dựng trực tiếp bằng parser quy tắc, "model" = sinh bằng model
+  generator?: "rules" | "model";
+  // Ảnh thực sự gửi cho model (sau khi thu nhỏ nếu quá lớn)
+  image?: {
+    media_type: string;
+    width: number | null;
+    height: number | null;
+    input_bytes: number;
+    sent_bytes: number;
+    resized: boolean;
+    source: "inline" | "raw" | "s3";
+  };
+  // Có khi server dàn lại bố cục (layout "auto" thiếu position hoặc "layered")
+  layout?: {
+    mode: "auto" | "layered";
+    direction: "TB" | "LR";
+    layers: number;
+    max_layer_width?: number;
+    crossings: number;
+    reversed_edges: number;
+    virtual_nodes: number;
+    unordered_long_edges?: number;
+    duration_ms?: number;
+  };
+  // Không có khi sơ đồ dựng bằng parser quy tắc
+  route?: ModelRoute;
+  // Kết quả của một request giống hệt đang chạy cùng lúc (không gọi lại model)
+  coalesced?: boolean;
+  deadline?: RequestDeadline | null;
+  // Sơ đồ lấy từ cache (cùng mô tả / ảnh / ngôn ngữ / bố cục đã sinh trước đó)
+  cache?: {
+    hit: boolean;
+    tier: "memory" | "store" | null;
+    hits: number;
+    misses: number;
+    memory_entries: number;
+  };
 }
 
 export interface DiagramResponse {
@@ -116,6 +172,7 @@ export interface SourceDocument {
   title: string;            // Tên tài liệu
   s3_uri: string;
   score: number;
+  relevance?: number;       // Điểm sau khi xếp hạng lại (vector + từ khóa)
   content_preview: string;
   full_retrieved_text: string;
 }
@@ -124,6 +181,33 @@ export interface AnalysisMetadata {
   context_sources: number;
   diagram_complexity: string;
   question: string;
+  analysis_id?: string;     // Gửi lại trong previousAnalysisId để chỉ phân tích lại phần bị ảnh hưởng
+  incremental?: {
+    previous_analysis_id: string;
+    applied: boolean;
+    reason?: string;
+    revised_sections?: string[];
+    reused_sections?: string[];
+  } | null;
+  route?: ModelRoute | null;
+  coalesced?: boolean;      // Dùng chung kết quả của một request giống hệt đang chạy cùng lúc
+  deadline?: RequestDeadline | null;
+  kb_breaker?: {            // Circuit breaker của Knowledge Base
+    state: "closed" | "open" | "half_open" | "disabled";
+    calls: number;
+    failure_rate: number;
+    slow_call_rate: number;
+    retry_in_ms: number;
+    trips: number;
+    short_circuited: number;
+    last_trip_reason?: string;
+  };
+  timings?: {               // Chỉ có khi request gửi includeTimings: true
+    total_ms: number;
+    stages_ms: Record<string, number>;
+    counters: Record<string, number>;
+    properties?: Record<string, string | number>;
+  };
 }
 
 export interface AnalysisResponse {
@@ -196,6 +280,7 @@ export interface CitationSource {
   title: string;            // Tên tài liệu
   s3_uri: string;
   score: number;
+  relevance?: number;       // Điểm sau khi xếp hạng lại (vector + từ khóa)
   content_preview: string;
   full_retrieved_text: string;
 }
@@ -209,12 +294,14 @@ export interface FullAnalysisResponse {
 
 export interface SubmitResponse {
   jobId: string;
-  status: 'PROCESSING';
+  status: 'PROCESSING' | 'COMPLETED' | 'FAILED';
+  deduplicated?: boolean;   // true nếu request trùng với một job đang chạy/đã xong
 }
 
 export interface StatusResponse {
   jobId: string;
   status: 'PROCESSING' | 'COMPLETED' | 'FAILED';
   result?: FullAnalysisResponse; // Kết quả cuối cùng sẽ có cấu trúc này
+  partial?: Partial<StructuredAnalysis>; // Các section đã phân tích xong trong lúc PROCESSING
   error?: string;
 }
\ No newline at end of file
@@ -1,114 +1,361 @@
 import json
-import boto3
-from typing import Dict, Any, List
+import os
+import sys
+import unicodedata
+from typing import Dict, Any, List, Optional, Tuple, Union
 import re
 
+# Cho phép import các module dùng chung trong src/ khi chạy từ gốc repo
+# (khi đóng gói Lambda, các module này nằm cạnh file handler)
+_SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+if os.path.isdir(_SRC_DIR) and _SRC_DIR not in sys.path:
+    sys.path.insert(0, _SRC_DIR)
 
+from json_stream import extract_json_object
+from diagram_graph import DiagramGraph, as_graph
+from diagram_layout import LAYOUT_DIRECTIONS, layered_layout
+from structured_log import Payload, get_logger, logged_handler
+from aws_clients import LazyClient, is_warmup_event, warm_up
+from model_routing import ModelRoute, create_model_router
+from deadlines import (
+    current_deadline, deadline_handler, deadline_summary, hedged_call, record_skip, remaining_time
+)
+from image_input import PreparedImage, image_fingerprint, is_raw_image_event, prepare_image, read_request_image
+from process_parser import ARROW_RE, parse_process_text
+from result_cache import create_tiered_cache, make_cache_key
+from single_flight import SingleFlight
+from request_metrics import increment, instrumented_handler, set_property, set_value, span, timings
+
+logger = get_logger('create')
+# Một client cho cả process (trước đây tạo mới ở mỗi lần gọi handler => handshake TLS mỗi request)
+bedrock_runtime = LazyClient('bedrock-runtime')
+
+# Chọn tier model + max_tokens theo độ dài mô tả / có ảnh hay không (cấu hình qua MODEL_ROUTING_*)
+model_router = create_model_router()
+# Tăng khi đổi prompt / tham số sinh => các entry cache cũ không còn được dùng
+GENERATION_PROMPT_VERSION = 'create-v2'
+# Cache sơ đồ đã sinh (đã validate + post-process): LRU trong process + SQLite trong /tmp
+# (cấu hình qua GENERATION_CACHE_*; GENERATION_CACHE_DB rỗng = chỉ dùng bộ nhớ)
+generation_cache = create_tiered_cache('GENERATION', default_max_entries=128, default_ttl=24 * 3600)
+# Request giống hệt (cùng key cache) đến khi một request khác đang sinh => chờ và dùng chung kết quả
+CREATE_COALESCE = os.environ.get('CREATE_COALESCE', 'true').lower() == 'true'
+generation_flight = SingleFlight('generation')
+_WHITESPACE_RE = re.compile(r'\s+')
+# Chuỗi mũi tên đơn giản (tiếng Việt) được dựng bằng parser quy tắc, không gọi model;
+# tắt bằng CREATE_RULE_PARSER=false hoặc "ruleParser": false trong request
+CREATE_RULE_PARSER = os.environ.get('CREATE_RULE_PARSER', 'true').lower() == 'true'
+
+# Bố cục sơ đồ trả về: 'auto' = dàn phân tầng khi model bỏ sót position của node nào đó,
+# 'layered' = luôn dàn lại, 'keep' = giữ position model trả về (node thiếu thì xếp thành hàng ngang như cũ)
+LAYOUT_MODES = ('auto', 'layered', 'keep')
+CREATE_LAYOUT = os.environ.get('CREATE_LAYOUT', 'auto')
+CREATE_LAYOUT_DIRECTION = os.environ.get('CREATE_LAYOUT_DIRECTION', 'TB')
+
+
+@logged_handler(logger)
+@instrumented_handler('create')
+@deadline_handler
 def lambda_handler(event: Dict[str, Any], context) -> Dict[str, Any]:
     """
     Convert text/image to React Flow JSON diagram with enhanced edge logic support
     """
-    
-    # Initialize Bedrock client
-    bedrock_runtime = boto3.client('bedrock-runtime', region_name='us-east-1')
+    # Ping giữ ấm: khởi tạo sẵn client rồi trả về, không gọi model
+    if is_warmup_event(event):
+        return {'statusCode': 200, 'body': json.dumps(warm_up(['bedrock-runtime'], {'generation_cache': generation_cache.stats}))}
     
     # Extract input from event
     try:
-        if isinstance(event.get('body'), str):
-            body = json.loads(event['body'])
-        else:
-            body = event
+        with span('parse'):
+            if is_raw_image_event(event):
+                # Body là ảnh nhị phân; text / language / layout đi qua query string
+                body = dict(event.get('queryStringParameters') or {})
+            elif isinstance(event.get('body'), str):
+                body = json.loads(event['body'])
+            else:
+                body = event
+        with span('image_read'):
+            image_input = read_request_image(event, body)
             
         input_text = body.get('text', '')
-        input_image = body.get('image', None)
         language = body.get('language', 'vietnamese')
+        layout = body.get('layout') or CREATE_LAYOUT
+        layout_direction = body.get('layoutDirection') or CREATE_LAYOUT_DIRECTION
         
         # cho phép text HOẶC image
-        if not input_text.strip() and not input_image:
+        if not input_text.strip() and image_input is None:
             return create_error_response(400, 'Text input or image is required')
+        if layout not in LAYOUT_MODES:
+            return create_error_response(400, f'layout must be one of {list(LAYOUT_MODES)}')
+        if layout_direction not in LAYOUT_DIRECTIONS:
+            return create_error_response(400, f'layoutDirection must be one of {list(LAYOUT_DIRECTIONS)}')
             
     except Exception as e:
         return create_error_response(400, f'Invalid input format: {str(e)}')
-    
+
+    # Đường tắt: mô tả dạng "A → B → Nếu X → C, Nếu Y → D" được dựng trực tiếp trong vài ms
+    if image_input is None and use_rule_parser(body, language):
+        with span('rule_parse'):
+            diagram_json, reason = parse_process_text(input_text)
+        if diagram_json is not None:
+            increment('rule_parser_hit')
+            try:
+                entry, _ = finish_diagram(diagram_json, input_text, layout, layout_direction, None, 'rules')
+                return create_diagram_response(entry, input_text, language, None, None, body)
+            except Exception as e:
+                return create_error_response(500, f'Processing error: {str(e)}')
+        increment('rule_parser_miss')
+        logger.debug('rule parser declined input', reason=reason)
+
+    # Step 0: Tra cache theo (text chuẩn hóa, ngôn ngữ, hash ảnh, bố cục, model, prompt)
+    use_cache = body.get('useCache', True) is not False
+    cache_key = build_generation_cache_key(input_text, language, image_input[0] if image_input else None,
+                                           layout, layout_direction)
+    cached, cache_tier = lookup_generation_cache(use_cache, cache_key)
+    if cached is not None:
+        return create_diagram_response(cached, input_text, language, cached, cache_tier, body)
+
     try:
-        # Optimized shorter prompt with focused instructions
-        base_prompt = get_optimized_prompt(input_text, language)
-        
-        # Tạo message content cho Claude
-        message_content = []
-        
-        if input_image:
-            message_content.append({
-                "type": "image",
-                "source": {
-                    "type": "base64",
-                    "media_type": detect_image_media_type(input_image),
-                    "data": input_image
-                }
-            })
-        
-        message_content.append({
-            "type": "text", 
-            "text": base_prompt
-        })
-        
-        # Call Bedrock Claude with improved parameters
-        response = bedrock_runtime.invoke_model(
-            modelId='anthropic.claude-3-sonnet-20240229-v1:0',
-            body=json.dumps({
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 2000,  # Reduced from 3000
-                "temperature": 0.1,  # Reduced from 0.3 for more consistency
-                "top_p": 0.9,        # Added for better consistency
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": message_content
-                    }
-                ]
-            })
-        )
-        
-        # Parse response
-        response_body = json.loads(response['body'].read())
-        generated_text = response_body['content'][0]['text']
-        
-        # Extract and validate JSON
-        diagram_json = extract_json_from_response(generated_text)
-        
-        # Validate and fix diagram structure
-        if not validate_diagram_structure(diagram_json):
-            diagram_json = create_fallback_diagram(input_text or "Phân tích từ hình ảnh")
+        # Request giống hệt đang được sinh trong process => chờ và dùng chung kết quả, không gọi model lần nữa
+        generate = lambda: generate_diagram(input_text, language, image_input, layout, layout_direction,
+                                            use_cache, cache_key)
+        if CREATE_COALESCE:
+            try:
+                entry, coalesced = generation_flight.do(cache_key, generate, timeout=remaining_time())
+            except TimeoutError:
+                # Request dẫn đầu chưa xong trong thời gian còn lại của request này: trả sơ đồ dự phòng
+                record_skip('coalesced_wait')
+                entry, _ = finish_diagram(None, input_text, layout, layout_direction, None, 'model')
+                coalesced = True
+            else:
+                if coalesced and not entry.get('complete', True):
+                    # Sơ đồ dùng chung là bản dự phòng vì hết giờ => metadata.deadline cũng phải báo partial
+                    for stage in entry.get('deadline_skipped') or []:
+                        record_skip(stage)
         else:
-            # Post-process to ensure consistency
-            diagram_json = post_process_diagram(diagram_json)
-        
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': json.dumps({
-                'success': True,
-                'diagram': diagram_json,
-                'metadata': {
-                    'nodes_count': len(diagram_json.get('nodes', [])),
-                    'edges_count': len(diagram_json.get('edges', [])),
-                    'conditional_edges_count': count_conditional_edges(diagram_json),
-                    'input_text': input_text[:100] + "..." if len(input_text) > 100 else input_text,
-                    'has_image': bool(input_image),
-                    'language': language
-                }
-            }, ensure_ascii=False)
-        }
-        
+            entry, coalesced = generate(), False
+        return create_diagram_response(entry, input_text, language, None, None, body, coalesced)
+
+    except _InvalidImage as e:
+        return create_error_response(400, f'Invalid input format: {str(e)}')
     except Exception as e:
         return create_error_response(500, f'Processing error: {str(e)}')
 
 
+class _InvalidImage(Exception):
+    pass
+
+
+def generate_diagram(input_text: str, language: str, image_input: Optional[Tuple[bytes, str]], layout: str,
+                     layout_direction: str, use_cache: bool, cache_key: str) -> Dict:
+    """Model path of a create request: prepare image, generate, validate, lay out, cache; returns the entry"""
+    if use_cache:
+        # Một request giống hệt có thể vừa xong giữa lần tra cache của request này và lúc vào single-flight
+        late, _ = generation_cache.get(cache_key)
+        if late is not None:
+            increment('generation_cache_late_hit')
+            return late
+
+    try:
+        with span('image_prepare'):
+            image = prepare_image(*image_input) if image_input else None
+        image_input = None
+    except Exception as e:
+        raise _InvalidImage(str(e)) from e
+
+    # Optimized shorter prompt with focused instructions
+    with span('prompt_build'):
+        base_prompt = get_optimized_prompt(input_text, language)
+        messages = build_generation_messages(base_prompt, image)
+    route = route_generation(input_text, image is not None)
+    increment('prompt_chars', len(base_prompt))
+    increment('image_input', 1 if image is not None else 0)
+    if image is not None:
+        set_value('image_input_bytes', image.input_bytes)
+        set_value('image_sent_bytes', len(image.data))
+        increment('image_resized', 1 if image.resized else 0)
+        set_property('image_media_type', image.media_type)
+        # Bytes ảnh đã nằm trong messages, không cần giữ thêm
+        image_info = image.summary()
+        image = None
+    else:
+        image_info = None
+
+    # Call Bedrock Claude with improved parameters; output sai cấu trúc / bị cắt => thử lại ở tier cao hơn
+    def invoke(route: ModelRoute) -> Tuple[Optional[Dict], Optional[str]]:
+        # Trong ngân sách thời gian còn lại của request (gửi request dự phòng khi bật hedging)
+        with span('model_invoke'):
+            response_body = invoke_generation(route, messages)
+        generated_text = response_body['content'][0]['text']
+        increment('response_chars', len(generated_text))
+        logger.debug('generation response', text=Payload(generated_text))
+
+        # Extract and validate JSON
+        with span('json_extract'):
+            return extract_json_from_response(generated_text), response_body.get('stop_reason')
+
+    # Hết giờ => diagram_json None => sơ đồ dự phòng dựng từ mô tả thay vì để Lambda timeout
+    diagram_json, route = model_router.run_with_escalation(route, invoke, generation_failure)
+    messages = None
+    entry, valid = finish_diagram(diagram_json, input_text, layout, layout_direction, image_info, 'model')
+    entry['route'] = route.as_dict()
+    # Các request gộp vào (single-flight) dựa vào đây để báo partial khi nhận sơ đồ dự phòng
+    deadline = current_deadline()
+    entry['complete'] = valid
+    entry['deadline_skipped'] = list(deadline.skipped) if deadline is not None else []
+    # Sơ đồ dự phòng (model trả về sai cấu trúc) không được cache, lần sau gọi lại model
+    if use_cache and valid:
+        generation_cache.set(cache_key, entry)
+    return entry
+
+
+def route_generation(input_text: str, has_image: bool) -> ModelRoute:
+    """Model tier and output budget for one generation"""
+    route = model_router.route('generation', {
+        'input_chars': len(input_text or ''),
+        'image': has_image,
+        'arrows': len(ARROW_RE.findall(input_text or ''))
+    })
+    set_property('model_tier', route.tier)
+    set_value('max_tokens', route.max_tokens)
+    return route
+
+
+def invoke_generation(route: ModelRoute, messages: List[Dict]) -> Dict:
+    """invoke_model + parsed response body, bounded by the request deadline (hedged when enabled)"""
+    request_body = build_generation_request(messages, route.max_tokens)
+
+    def invoke() -> Dict:
+        response = bedrock_runtime.invoke_model(modelId=route.model_id, body=request_body)
+        return json.loads(response['body'].read())
+    return hedged_call(invoke, route.model_id)
+
+
+def generation_failure(diagram_json: Optional[Dict], stop_reason: Optional[str]) -> Optional[str]:
+    """Why a generated answer should be retried on a higher tier, or None when it is usable"""
+    if stop_reason == 'max_tokens':
+        return 'max_tokens'
+    if not validate_diagram_structure(diagram_json):
+        return 'invalid_diagram'
+    return None
+
+
+def use_rule_parser(body: Dict, language: str) -> bool:
+    """Rule parser only for Vietnamese output: it keeps labels as typed and never translates them"""
+    enabled = body.get('ruleParser', CREATE_RULE_PARSER)
+    return enabled is not False and (language or '').strip().lower() in ('vietnamese', 'vi', 'tiếng việt')
+
+
+def finish_diagram(diagram_json: Optional[Dict], input_text: str, layout: str, layout_direction: str,
+                   image_info: Optional[Dict], generator: str) -> Tuple[Dict, bool]:
+    """Validate, lay out and post-process a diagram; returns (response entry, whether it was valid)"""
+    # Dựng đồ thị có chỉ mục MỘT lần, các helper bên dưới dùng chung
+    with span('validate'):
+        graph = DiagramGraph.from_dict(diagram_json)
+        valid = validate_diagram_structure(graph)
+
+    # Validate and fix diagram structure
+    layout_info = None
+    if not valid:
+        increment('fallback_diagram')
+        diagram_json = create_fallback_diagram(input_text or "Phân tích từ hình ảnh")
+        graph = DiagramGraph.from_dict(diagram_json)
+    else:
+        # Dàn bố cục phân tầng trước khi post-process (post-process chỉ điền position còn thiếu)
+        with span('layout'):
+            layout_info = apply_diagram_layout(graph, layout, layout_direction)
+        # Post-process to ensure consistency
+        with span('post_process'):
+            diagram_json = post_process_diagram(graph)
+
+    set_property('generator', generator)
+    return {
+        'diagram': diagram_json,
+        'nodes_count': graph.node_count,
+        'edges_count': graph.edge_count,
+        'conditional_edges_count': count_conditional_edges(graph),
+        'image': image_info,
+        'layout': layout_info,
+        # 'rules' = parser quy tắc, 'model' = sinh bằng model
+        'generator': generator
+    }, valid
+
+
+def normalize_generation_text(text: str) -> str:
+    """Unicode NFC, case, whitespace and arrow spelling folded so re-typed inputs share a cache entry"""
+    text = unicodedata.normalize('NFC', text or '')
+    text = ARROW_RE.sub(' → ', text)
+    return _WHITESPACE_RE.sub(' ', text).strip().casefold()
+
+
+def build_generation_cache_key(input_text: str, language: str, image_data: Optional[bytes],
+                               layout: str, layout_direction: str) -> str:
+    """Content hash of a create request; layout options are part of it since they change positions"""
+    return make_cache_key(
+        'generation',
+        normalize_generation_text(input_text),
+        (language or '').strip().lower(),
+        image_fingerprint(image_data) if image_data is not None else None,
+        layout,
+        layout_direction,
+        model_router.signature,
+        GENERATION_PROMPT_VERSION
+    )
+
+
+def lookup_generation_cache(use_cache: bool, cache_key: str) -> Tuple[Any, Any]:
+    """(cached entry, tier) or (None, None); skipped when the request disables the cache"""
+    if not use_cache:
+        return None, None
+    with span('generation_cache'):
+        cached, cache_tier = generation_cache.get(cache_key)
+    increment('generation_cache_hit' if cached is not None else 'generation_cache_miss')
+    return cached, cache_tier
+
+
+def create_diagram_response(entry: Dict, input_text: str, language: str, cached: Any, cache_tier: Any,
+                            body: Dict, coalesced: bool = False) -> Dict:
+    image_info = entry.get('image')
+    layout_info = entry.get('layout')
+    route = entry.get('route')
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type'
+        },
+        'body': json.dumps({
+            'success': True,
+            'diagram': entry['diagram'],
+            'metadata': {
+                'nodes_count': entry['nodes_count'],
+                'edges_count': entry['edges_count'],
+                'conditional_edges_count': entry['conditional_edges_count'],
+                'input_text': input_text[:100] + "..." if len(input_text) > 100 else input_text,
+                'has_image': image_info is not None,
+                **({'image': image_info} if image_info else {}),
+                'language': language,
+                'generator': entry.get('generator', 'model'),
+                **({'layout': layout_info} if layout_info else {}),
+                # Tier model / max_tokens đã dùng (không có khi sơ đồ dựng bằng parser quy tắc)
+                **({'route': route} if route else {}),
+                # Ngân sách thời gian của request; `partial` = model không kịp trả về, đây là sơ đồ dự phòng
+                'deadline': deadline_summary(),
+                'cache': {
+                    'hit': cached is not None,
+                    'tier': cache_tier,
+                    **generation_cache.stats()
+                },
+                # True = kết quả của một request giống hệt đang chạy cùng lúc (không gọi lại model)
+                'coalesced': coalesced,
+                # Thời gian từng chặng + bộ đếm khi request gửi `"includeTimings": true`
+                **({'timings': timings()} if body.get('includeTimings') else {})
+            }
+        }, ensure_ascii=False)
+    }
+
+
 def get_optimized_prompt(input_text: str, language: str) -> str:
     """Generate optimized, shorter prompt based on input analysis"""
     
@@ -166,7 +413,7 @@ Format edge có điều kiện:
   "source": "1", 
   "target": "2",
   "data": {
-    "logic": "AND",  // OR cho "hoặc", AND cho "và"
+    "logic": "VÀ",  // HOẶC cho "hoặc", VÀ cho "và"
     "rules": [
       {"id": "r1", "field": "[TRƯỜNG_TỪ_INPUT]", "operator": "[PHÉP_SO_SÁNH]", "value": "[GIÁ_TRỊ]"}
     ]
@@ -211,249 +458,147 @@ Tạo JSON thuần với cấu trúc tối giản:"""
     return base_structure + input_part
 
 
-def extract_condition_info(input_text: str) -> List[Dict]:
-    """Extract actual condition information from input text"""
-    conditions = []
-    
-    # Common condition patterns in Vietnamese
-    condition_patterns = [
-        r'nếu\s+([^→]+)→',
-        r'khi\s+([^→]+)→',
-        r'path\s+([a-zA-Z])\s+([^→]+)→',
-        r'nhánh\s+([^→]+)→',
-    ]
-    
-    for pattern in condition_patterns:
-        matches = re.findall(pattern, input_text.lower())
-        for match in matches:
-            if isinstance(match, tuple):
-                condition_text = ' '.join(match).strip()
-            else:
-                condition_text = match.strip()
-            
-            # Parse condition into field, operator, value
-            if 'đúng' in condition_text:
-                field = condition_text.replace('đúng', '').strip()
-                conditions.append({
-                    'field': field,
-                    'operator': 'Là true',
-                    'value': ''
-                })
-            elif 'sai' in condition_text or 'false' in condition_text:
-                field = condition_text.replace('sai', '').replace('false', '').strip()
-                conditions.append({
-                    'field': field,
-                    'operator': 'Là false',
-                    'value': ''
-                })
-            elif '>' in condition_text:
-                parts = condition_text.split('>')
-                if len(parts) == 2:
-                    conditions.append({
-                        'field': parts[0].strip(),
-                        'operator': 'Lớn hơn',
-                        'value': parts[1].strip()
-                    })
-            elif '<' in condition_text:
-                parts = condition_text.split('<')
-                if len(parts) == 2:
-                    conditions.append({
-                        'field': parts[0].strip(),
-                        'operator': 'Nhỏ hơn',
-                        'value': parts[1].strip()
-                    })
-            elif '=' in condition_text or 'là' in condition_text:
-                if '=' in condition_text:
-                    parts = condition_text.split('=')
-                else:
-                    parts = condition_text.split('là')
-                if len(parts) == 2:
-                    conditions.append({
-                        'field': parts[0].strip(),
-                        'operator': 'Bằng',
-                        'value': parts[1].strip()
-                    })
-            else:
-                # Default condition
-                conditions.append({
-                    'field': condition_text,
-                    'operator': 'Là true',
-                    'value': ''
-                })
-    
-    return conditions
+def apply_diagram_layout(diagram: Union[Dict, DiagramGraph], layout: str = 'auto',
+                         direction: str = 'TB') -> Optional[Dict]:
+    """Write layered positions onto the nodes; returns layout metadata, or None when positions are kept"""
+    graph = as_graph(diagram)
+    if layout == 'keep' or graph.node_count == 0:
+        return None
+    if layout == 'auto' and all(isinstance(node.raw.get('position'), dict) for node in graph.nodes):
+        return None
+    try:
+        coordinates, stats = layered_layout(graph, direction=direction)
+    except Exception as e:
+        # Thiếu NumPy hoặc đồ thị lỗi: post_process_diagram đặt vị trí theo cách cũ
+        logger.warning('layered layout failed, keeping positions', error=str(e))
+        increment('layout_error')
+        return None
+    for node, (x, y) in zip(graph.nodes, coordinates):
+        node.raw['position'] = {'x': x, 'y': y}
+    set_property('layout', layout)
+    increment('layout_crossings', stats['crossings'])
+    return {'mode': layout, 'direction': direction, **stats}
 
 
-def post_process_diagram(diagram: Dict) -> Dict:
+def post_process_diagram(diagram: Union[Dict, DiagramGraph]) -> Dict:
     """Post-process diagram to ensure consistency"""
+    graph = as_graph(diagram)
     try:
         # Ensure proper positioning
-        nodes = diagram.get('nodes', [])
-        for i, node in enumerate(nodes):
-            if 'position' not in node:
-                node['position'] = {'x': 100 + (i * 250), 'y': 100}
+        last = graph.node_count - 1
+        for node in graph.nodes:
+            raw = node.raw
+            if 'position' not in raw:
+                raw['position'] = {'x': 100 + (node.index * 250), 'y': 100}
             
             # Ensure proper node type
-            if 'type' not in node:
-                if i == 0:
-                    node['type'] = 'input'
-                elif i == len(nodes) - 1:
-                    node['type'] = 'output'
+            if 'type' not in raw:
+                if node.index == 0:
+                    raw['type'] = 'input'
+                elif node.index == last:
+                    raw['type'] = 'output'
                 else:
-                    node['type'] = 'default'
+                    raw['type'] = 'default'
+                node.type = raw['type']
         
         # Ensure edge IDs are unique
-        edges = diagram.get('edges', [])
-        for i, edge in enumerate(edges):
-            if 'id' not in edge:
-                edge['id'] = f"e{edge['source']}-{edge['target']}"
+        for edge in graph.edges:
+            if 'id' not in edge.raw:
+                edge.raw['id'] = f"e{edge.raw['source']}-{edge.raw['target']}"
+                edge.id = edge.raw['id']
         
-        return diagram
+        return graph.raw
         
     except Exception as e:
-        print(f"Post-processing error: {e}")
-        return diagram
+        logger.warning('post-processing error', error=str(e))
+        return graph.raw
 
 
 def extract_json_from_response(text: str) -> Dict:
-    """Enhanced JSON extraction with multiple fallback methods"""
-    try:
-        # Method 1: Direct JSON parsing (most reliable)
-        lines = text.strip().split('\n')
-        for line in lines:
-            line = line.strip()
-            if line.startswith('{') and line.endswith('}'):
-                try:
-                    parsed = json.loads(line)
-                    if 'nodes' in parsed and 'edges' in parsed:
-                        return parsed
-                except:
-                    continue
-        
-        # Method 2: Find largest JSON object
-        import re
-        json_candidates = []
-        
-        # Find all potential JSON objects
-        brace_level = 0
-        start_pos = -1
-        
-        for i, char in enumerate(text):
-            if char == '{':
-                if brace_level == 0:
-                    start_pos = i
-                brace_level += 1
-            elif char == '}':
-                brace_level -= 1
-                if brace_level == 0 and start_pos != -1:
-                    json_str = text[start_pos:i+1]
-                    json_candidates.append(json_str)
-        
-        # Try parsing candidates, prefer ones with nodes and edges
-        for candidate in sorted(json_candidates, key=len, reverse=True):
-            try:
-                parsed = json.loads(candidate)
-                if isinstance(parsed, dict) and 'nodes' in parsed and 'edges' in parsed:
-                    return parsed
-            except:
-                continue
-        
-        # Method 3: Regex extraction
-        json_pattern = r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}'
-        matches = re.findall(json_pattern, text, re.DOTALL)
-        
-        for match in matches:
-            try:
-                parsed = json.loads(match)
-                if isinstance(parsed, dict) and 'nodes' in parsed:
-                    return parsed
-            except:
-                continue
-                
-    except Exception as e:
-        print(f"JSON extraction error: {e}")
-    
-    return None
+    """Single-pass, string-aware extraction of the diagram object (must contain nodes and edges)"""
+    result = extract_json_object(text, required_keys=('nodes', 'edges'))
+    set_property('json_extraction_method', result.method)
+    if not result:
+        logger.warning('JSON extraction error', error=result.error, position=result.error_pos, candidates=result.candidates)
+        return None
+    return normalize_edge_logic(result.value)
+
 
+# Model đôi khi vẫn trả logic tiếng Anh; frontend và validator chỉ nhận VÀ / HOẶC
+_EDGE_LOGIC_ALIASES = {'and': 'VÀ', 'và': 'VÀ', '&&': 'VÀ', 'or': 'HOẶC', 'hoặc': 'HOẶC', '||': 'HOẶC'}
 
-def validate_diagram_structure(diagram: Dict) -> bool:
+
+def normalize_edge_logic(diagram_json: Dict) -> Dict:
+    """Map AND/OR (any case) in edge `data.logic` to VÀ/HOẶC in place, before validation"""
+    edges = diagram_json.get('edges') if isinstance(diagram_json, dict) else None
+    for edge in edges if isinstance(edges, list) else []:
+        data = edge.get('data') if isinstance(edge, dict) else None
+        if isinstance(data, dict) and isinstance(data.get('logic'), str):
+            data['logic'] = _EDGE_LOGIC_ALIASES.get(data['logic'].strip().casefold(), data['logic'])
+    return diagram_json
+
+
+def validate_diagram_structure(diagram: Union[Dict, DiagramGraph]) -> bool:
     """Streamlined validation focusing on essential structure"""
-    if not diagram or not isinstance(diagram, dict):
+    graph = as_graph(diagram)
+    raw = graph.raw
+    if not raw:
         return False
-        
-    try:
-        # Check required fields
-        if 'nodes' not in diagram or 'edges' not in diagram:
-            return False
-            
-        nodes = diagram['nodes']
-        edges = diagram['edges']
-        
-        if not isinstance(nodes, list) or not isinstance(edges, list):
-            return False
-            
-        # Must have at least 1 node
-        if len(nodes) == 0:
-            return False
-        
-        # Quick node validation
-        for node in nodes:
-            if not isinstance(node, dict):
-                return False
-            if 'id' not in node or 'data' not in node:
-                return False
-            if not isinstance(node['data'], dict) or 'label' not in node['data']:
-                return False
-        
-        # Quick edge validation
-        node_ids = {node['id'] for node in nodes}
-        for edge in edges:
-            if not isinstance(edge, dict):
-                return False
-            if 'source' not in edge or 'target' not in edge:
-                return False
-            if edge['source'] not in node_ids or edge['target'] not in node_ids:
-                return False
-            
-            # Quick validation for conditional edges
-            if 'data' in edge and 'logic' in edge['data']:
-                if edge['data']['logic'] not in ['VÀ', 'HOẶC']:
-                    return False
-        
-        return True
-        
-    except Exception as e:
-        print(f"Validation error: {e}")
+
+    # Check required fields (DiagramGraph đã kiểm tra id/label của node và source/target của edge)
+    if 'nodes' not in raw or 'edges' not in raw:
+        return False
+    if not graph.is_valid:
+        logger.warning('validation error', error=graph.error)
+        return False
+
+    # Must have at least 1 node
+    if graph.node_count == 0:
         return False
 
+    # Quick validation for conditional edges
+    for edge in graph.edges:
+        if edge.logic is not None and edge.logic not in ['VÀ', 'HOẶC']:
+            return False
+
+    return True
+
 
-def count_conditional_edges(diagram: Dict) -> int:
+def count_conditional_edges(diagram: Union[Dict, DiagramGraph]) -> int:
     """Count edges with conditional logic"""
     try:
-        edges = diagram.get('edges', [])
-        return len([edge for edge in edges if 'data' in edge and 'logic' in edge['data']])
+        return as_graph(diagram).conditional_edge_count
     except:
         return 0
 
 
-def detect_image_media_type(base64_data: str) -> str:
-    """Detect image media type from base64 data"""
-    try:
-        import base64
-        image_data = base64.b64decode(base64_data[:100])
-        
-        if image_data.startswith(b'\xff\xd8\xff'):
-            return "image/jpeg"
-        elif image_data.startswith(b'\x89PNG'):
-            return "image/png"
-        elif image_data.startswith(b'GIF8'):
-            return "image/gif"
-        elif image_data.startswith(b'RIFF') and b'WEBP' in image_data:
-            return "image/webp"
-        else:
-            return "image/jpeg"
-    except:
-        return "image/jpeg"
+def build_generation_messages(prompt: str, image: Optional[PreparedImage] = None) -> List[Dict]:
+    """Claude messages for a generation; the image is base64-encoded straight into them"""
+    # Tạo message content cho Claude
+    message_content = []
+    if image is not None:
+        message_content.append(image.content_block())
+    message_content.append({
+        "type": "text",
+        "text": prompt
+    })
+    return [
+        {
+            "role": "user",
+            "content": message_content
+        }
+    ]
+
+
+def build_generation_request(messages: List[Dict], max_tokens: int = 2000) -> str:
+    """JSON body for invoke_model; max_tokens comes from the model route"""
+    return json.dumps({
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "temperature": 0.1,  # Reduced from 0.3 for more consistency
+        "top_p": 0.9,        # Added for better consistency
+        "messages": messages
+    })
 
 
 def create_fallback_diagram(text: str) -> Dict:
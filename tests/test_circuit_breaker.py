@@ -0,0 +1,119 @@
+import pytest
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def _breaker(clock, **overrides):
+    options = dict(failure_rate_threshold=0.5, slow_call_rate_threshold=0.5, slow_call_ms=3000, min_calls=4,
+                   window_seconds=60, open_seconds=30, half_open_max_calls=1, clock=clock)
+    return CircuitBreaker('test', **{**options, **overrides})
+
+
+def _fail():
+    raise RuntimeError('down')
+
+
+def _trip(breaker):
+    for _ in range(breaker.min_calls):
+        with pytest.raises(RuntimeError):
+            breaker.call(_fail)
+    assert breaker.state == OPEN
+
+
+def test_stays_closed_below_min_calls_and_threshold():
+    breaker = _breaker(FakeClock())
+    for _ in range(3):
+        breaker.record(10, failed=True)
+    assert breaker.state == CLOSED
+    breaker = _breaker(FakeClock())
+    for failed in (True, False, False, False, False):
+        breaker.record(10, failed)
+    assert breaker.state == CLOSED
+
+
+def test_opens_on_failure_rate_and_short_circuits():
+    clock = FakeClock()
+    breaker = _breaker(clock)
+    _trip(breaker)
+    calls = []
+    with pytest.raises(CircuitOpenError) as error:
+        breaker.call(lambda: calls.append(1))
+    assert calls == []
+    assert error.value.retry_in == 30
+    clock.advance(10)
+    assert breaker.snapshot()['retry_in_ms'] == 20000
+    assert breaker.snapshot()['short_circuited'] == 1
+
+
+def test_opens_on_slow_call_rate():
+    breaker = _breaker(FakeClock())
+    for _ in range(4):
+        breaker.record(5000, failed=False)
+    assert breaker.state == OPEN
+    assert breaker.last_trip_reason == 'slow call rate 1.00'
+
+
+def test_old_outcomes_leave_the_window():
+    clock = FakeClock()
+    breaker = _breaker(clock)
+    for _ in range(3):
+        breaker.record(10, failed=True)
+    clock.advance(61)
+    breaker.record(10, failed=True)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()['calls'] == 1
+
+
+def test_half_open_admits_a_single_probe_then_closes():
+    clock = FakeClock()
+    breaker = _breaker(clock)
+    _trip(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # Chỉ một lời gọi thăm dò trong lúc half-open
+    assert not breaker.allow()
+    breaker.record(10, failed=False)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()['calls'] == 0
+    assert breaker.call(lambda: 'ok') == 'ok'
+
+
+@pytest.mark.parametrize('duration_ms, failed', [(10, True), (5000, False)])
+def test_failed_or_slow_probe_reopens(duration_ms, failed):
+    clock = FakeClock()
+    breaker = _breaker(clock)
+    _trip(breaker)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record(duration_ms, failed)
+    assert breaker.state == OPEN
+    assert breaker.trips == 2
+    assert breaker.retry_in() == 30
+
+
+def test_call_measures_duration_with_the_clock():
+    clock = FakeClock()
+    breaker = _breaker(clock, min_calls=1)
+    breaker.call(lambda: clock.advance(4))
+    assert breaker.state == OPEN
+    assert breaker.last_trip_reason.startswith('slow call rate')
+
+
+def test_disabled_breaker_never_opens():
+    breaker = _breaker(FakeClock(), enabled=False)
+    for _ in range(10):
+        breaker.record(10, failed=True)
+    assert breaker.allow()
+    assert breaker.snapshot()['state'] == 'disabled'
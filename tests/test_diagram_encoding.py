@@ -0,0 +1,48 @@
+from diagram_encoding import encode_diagram_compact, encoding_details, render_diagram_for_prompt
+from result_cache import canonical_diagram, make_cache_key
+
+DIAGRAM = {
+    'nodes': [
+        {'id': 'start', 'type': 'input', 'data': {'label': 'Bắt đầu'}, 'position': {'x': 0, 'y': 0}},
+        {'id': 'check', 'data': {'label': 'Kiểm tra\nhồ sơ'}},
+        {'id': 'end', 'type': 'output', 'data': {'label': 'Kết thúc'}}
+    ],
+    'edges': [
+        {'id': 'e1', 'source': 'start', 'target': 'check'},
+        {'id': 'e2', 'source': 'check', 'target': 'end', 'label': 'Hợp lệ',
+         'data': {'logic': 'VÀ', 'rules': [{'field': 'điểm', 'operator': 'Lớn hơn', 'value': 700}]}}
+    ]
+}
+
+
+def test_compact_encoding_lists_nodes_and_edges():
+    text, aliases = encode_diagram_compact(DIAGRAM)
+    assert aliases == {'N1': 'check', 'N2': 'end', 'N3': 'start'}
+    assert text.splitlines()[2:] == [
+        'N1 Kiểm tra hồ sơ',
+        'N2 [output] Kết thúc',
+        'N3 [input] Bắt đầu',
+        'N3 -> N1',
+        'N1 -> N2 (Hợp lệ) {VÀ: điểm Lớn hơn 700}'
+    ]
+
+
+def test_aliases_follow_the_cache_key_not_the_request_order():
+    reordered = {**DIAGRAM, 'nodes': DIAGRAM['nodes'][::-1]}
+    assert make_cache_key(canonical_diagram(reordered)) == make_cache_key(canonical_diagram(DIAGRAM))
+    assert render_diagram_for_prompt(reordered, 'compact') == render_diagram_for_prompt(DIAGRAM, 'compact')
+
+
+def test_compact_info_always_has_aliases_and_baseline_only_on_request():
+    _, info = render_diagram_for_prompt(DIAGRAM, 'compact')
+    assert info['node_aliases']['N3'] == 'start'
+    assert 'baseline_estimated_tokens' not in info
+    details = encoding_details(DIAGRAM, info)
+    assert details['estimated_token_savings'] == details['baseline_estimated_tokens'] - info['estimated_tokens'] > 0
+
+
+def test_json_format_is_unchanged():
+    text, info = render_diagram_for_prompt(DIAGRAM, 'json')
+    assert text.startswith('{\n  "nodes"')
+    assert info == {'format': 'json', 'estimated_tokens': info['estimated_tokens']}
+    assert encoding_details(DIAGRAM, info) is info
@@ -0,0 +1,84 @@
+import math
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from diagram_layout import layered_layout
+
+
+def _diagram(node_ids, edges):
+    return {
+        'nodes': [{'id': node_id, 'data': {'label': f'Bước {node_id}'}} for node_id in node_ids],
+        'edges': [{'id': f'e{i}', 'source': s, 'target': t} for i, (s, t) in enumerate(edges)]
+    }
+
+
+def _assert_no_overlap(coordinates):
+    assert len(set(coordinates)) == len(coordinates)
+    assert all(math.isfinite(x) and math.isfinite(y) for x, y in coordinates)
+
+
+def test_empty_graph():
+    coordinates, stats = layered_layout({'nodes': [], 'edges': []})
+    assert coordinates == []
+    assert stats['layers'] == 0
+
+
+def test_chain_is_one_node_per_layer():
+    coordinates, stats = layered_layout(_diagram('abcd', ['ab', 'bc', 'cd']))
+    assert stats['layers'] == 4
+    assert stats['crossings'] == 0
+    assert len({x for x, _ in coordinates}) == 1
+    assert [y for _, y in coordinates] == sorted(y for _, y in coordinates)
+
+
+def test_left_to_right_lays_layers_along_x():
+    coordinates, _ = layered_layout(_diagram('abc', ['ab', 'bc']), direction='LR')
+    assert len({y for _, y in coordinates}) == 1
+    assert [x for x, _ in coordinates] == sorted({x for x, _ in coordinates})
+
+
+def test_unknown_direction_is_rejected():
+    with pytest.raises(ValueError):
+        layered_layout(_diagram('ab', ['ab']), direction='RL')
+
+
+@pytest.mark.parametrize('edges', [
+    ['ab', 'bc', 'ca'],
+    ['ab', 'bc', 'cd', 'db', 'de'],
+    ['ab', 'ba'],
+])
+def test_cycles_are_broken(edges):
+    node_ids = sorted({node for edge in edges for node in edge})
+    coordinates, stats = layered_layout(_diagram(node_ids, edges))
+    assert stats['reversed_edges'] >= 1
+    assert len(coordinates) == len(node_ids)
+    _assert_no_overlap(coordinates)
+
+
+def test_self_loops_and_dangling_edges_are_ignored():
+    diagram = _diagram('ab', ['ab', 'aa'])
+    diagram['edges'].append({'id': 'x', 'source': 'b', 'target': 'missing'})
+    coordinates, stats = layered_layout(diagram)
+    assert stats['layers'] == 2
+    assert stats['reversed_edges'] == 0
+    _assert_no_overlap(coordinates)
+
+
+def test_duplicate_ids_still_place_every_node():
+    coordinates, _ = layered_layout(_diagram(['a', 'b', 'b', 'c'], ['ab', 'bc']))
+    assert len(coordinates) == 4
+    _assert_no_overlap(coordinates)
+
+
+def test_branches_keep_edge_order():
+    coordinates, _ = layered_layout(_diagram('abc', ['ab', 'ac']))
+    assert coordinates[1][0] < coordinates[2][0]
+    assert coordinates[1][1] == coordinates[2][1]
+
+
+def test_long_edges_get_virtual_nodes():
+    _, stats = layered_layout(_diagram('abcd', ['ab', 'bc', 'cd', 'ad']))
+    assert stats['virtual_nodes'] == 2
+    assert stats['crossings'] == 0
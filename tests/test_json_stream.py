@@ -0,0 +1,119 @@
+import json
+import random
+
+import pytest
+
+from json_stream import JsonObjectScanner, TopLevelSectionParser, extract_json_object
+
+DIAGRAM = {'nodes': [{'id': '1', 'data': {'label': 'Bắt đầu "A" {x}'}}], 'edges': []}
+SECTIONS = {
+    'overview': {'text': 'Tổng quan: "quote", {brace} và [bracket]\\n'},
+    'components': [1, 2, {'nested': [3, 4]}],
+    'score': 7.5,
+    'flag': True,
+    'missing': None,
+    'summary': 'kết thúc'
+}
+
+
+# --- extract_json_object ---
+
+def test_extracts_object_after_preamble_and_code_fence():
+    text = "Đây là sơ đồ (it's {ready}):\n```json\n" + json.dumps(DIAGRAM, ensure_ascii=False) + "\n```"
+    result = extract_json_object(text, ('nodes', 'edges'))
+    assert result.value == DIAGRAM
+    assert text[result.start:result.end] == json.dumps(DIAGRAM, ensure_ascii=False)
+
+
+def test_picks_object_with_required_keys_among_several():
+    text = '{"note": 1} rồi ' + json.dumps(DIAGRAM) + ' và {"other": {"x": 2}}'
+    result = extract_json_object(text, ('nodes', 'edges'))
+    assert result.value == DIAGRAM
+    assert result.candidates == 3
+
+
+def test_unwraps_nested_diagram():
+    result = extract_json_object(json.dumps({'diagram': DIAGRAM}) + ' trailing }', ('nodes', 'edges'))
+    assert result.value == DIAGRAM
+    assert result.method == 'nested'
+
+
+@pytest.mark.parametrize('cut', [1, 10, 25, -1])
+def test_truncated_object_is_not_extracted(cut):
+    text = json.dumps(DIAGRAM)[:cut]
+    result = extract_json_object(text, ('nodes', 'edges'))
+    assert not result
+    assert result.error
+
+
+def test_reports_missing_keys_and_empty_input():
+    assert extract_json_object('', ('nodes',)).error == 'Empty response'
+    assert extract_json_object('không có JSON', ('nodes',)).error == 'No JSON object found'
+    result = extract_json_object('{"a": 1}', ('nodes',))
+    assert not result
+    assert 'nodes' in result.error
+
+
+def test_adversarial_unbalanced_braces_fall_back_to_scanner():
+    # Nhiều '{' không đóng trước object thật: vượt _MAX_DECODE_FAILURES, phần còn lại đi qua scanner
+    text = '{ ' * 50 + 'x' + json.dumps(DIAGRAM)
+    result = extract_json_object(text, ('nodes', 'edges'))
+    assert result.value == DIAGRAM
+
+
+def test_deeply_nested_input_does_not_raise():
+    text = '[' * 100000 + ']' * 100000
+    assert not extract_json_object('{"a": ' + text + '}', ('nodes',))
+
+
+def test_scanner_matches_extractor_across_chunk_boundaries():
+    text = 'lời dẫn "it\'s" ' + json.dumps({'a': 'x\\"}{', 'b': {'c': [1, {'d': '}'}]}}) + ' hết'
+    for size in (1, 2, 3, 7):
+        scanner = JsonObjectScanner()
+        for start in range(0, len(text), size):
+            scanner.feed(text[start:start + size])
+        assert scanner.result(('a', 'b')).value == extract_json_object(text, ('a', 'b')).value
+
+
+# --- TopLevelSectionParser ---
+
+def _feed_in_chunks(text, sizes):
+    parser = TopLevelSectionParser()
+    emitted = []
+    start = 0
+    for size in sizes:
+        emitted.extend(parser.feed(text[start:start + size]))
+        start += size
+    emitted.extend(parser.feed(text[start:]))
+    return parser, emitted
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_chunk_splits_emit_every_section_once(seed):
+    rng = random.Random(seed)
+    text = 'Kết quả phân tích:\n' + json.dumps(SECTIONS, ensure_ascii=False, indent=rng.choice([None, 2]))
+    sizes = [rng.randint(1, 12) for _ in range(len(text))]
+    parser, emitted = _feed_in_chunks(text, sizes)
+    assert emitted == list(SECTIONS.items())
+    assert parser.finished
+
+
+def test_sections_are_emitted_as_soon_as_they_close():
+    parser = TopLevelSectionParser()
+    assert parser.feed('{"overview": {"a": 1}') == [('overview', {'a': 1})]
+    assert parser.feed(', "score": 3') == []
+    assert parser.feed(', "summary": "x"') == [('score', 3)]
+    assert parser.feed('}') == [('summary', 'x')]
+
+
+def test_truncated_stream_keeps_only_closed_sections():
+    text = json.dumps(SECTIONS)
+    cut = text.index('"score"') + 5
+    parser, emitted = _feed_in_chunks(text[:cut], [3] * cut)
+    assert [key for key, _ in emitted] == ['overview', 'components']
+    assert not parser.finished
+
+
+def test_text_after_the_object_is_ignored():
+    _, emitted = _feed_in_chunks('{"a": 1} {"b": 2}', [1] * 20)
+    assert emitted == [('a', 1)]
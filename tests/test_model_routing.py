@@ -0,0 +1,69 @@
+import copy
+
+from deadlines import Deadline, DeadlineExceeded, deadline_scope
+from model_routing import DEFAULT_ROUTING, ModelRouter, analysis_failure
+
+SECTIONS = ('overview', 'summary')
+GOOD = {'overview': {}, 'summary': {}}
+
+
+def _router():
+    return ModelRouter(copy.deepcopy(DEFAULT_ROUTING))
+
+
+def _route(router):
+    return router.route('analysis', {'nodes': 3, 'conditional_edges': 0, 'input_chars': 100})
+
+
+def _failure(output, stop_reason):
+    return analysis_failure(output, stop_reason, SECTIONS)
+
+
+def test_small_diagram_routes_to_fast_tier():
+    route = _route(_router())
+    assert route.tier == 'fast'
+    assert route.max_tokens == 2300
+
+
+def test_usable_output_is_returned_without_escalation():
+    router = _router()
+    calls = []
+    output, route = router.run_with_escalation(
+        _route(router), lambda r: calls.append(r.tier) or (GOOD, 'end_turn'), _failure)
+    assert (output, route.tier, calls) == (GOOD, 'fast', ['fast'])
+
+
+def test_failed_output_escalates_once():
+    router = _router()
+    calls = []
+    output, route = router.run_with_escalation(
+        _route(router), lambda r: calls.append(r.tier) or ({'detailed_analysis': 'x'}, 'end_turn'), _failure)
+    assert calls == ['fast', 'standard']
+    assert route.as_dict()['attempts'][1]['escalation_reason'] == 'invalid_json'
+    assert 'detailed_analysis' in output
+
+
+def test_deadline_during_a_call_returns_none():
+    router = _router()
+
+    def invoke(route):
+        raise DeadlineExceeded('model')
+    output, route = router.run_with_escalation(_route(router), invoke, _failure)
+    assert output is None and route.tier == 'fast'
+
+
+def test_no_escalation_without_time_for_another_call():
+    router = _router()
+    calls = []
+    deadline = Deadline(0, reserve_ms=0)
+    with deadline_scope(deadline):
+        _, route = router.run_with_escalation(
+            _route(router), lambda r: calls.append(r.tier) or ({}, 'max_tokens'), _failure)
+    assert calls == ['fast']
+    assert deadline.skipped == ['model_escalation']
+
+
+def test_analysis_failure_reasons():
+    assert _failure(GOOD, 'max_tokens') == 'max_tokens'
+    assert _failure({'overview': {}}, 'end_turn') == 'missing_sections'
+    assert _failure(GOOD, 'end_turn') is None
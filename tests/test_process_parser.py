@@ -0,0 +1,108 @@
+import pytest
+
+from process_parser import parse_condition, parse_process_text
+
+
+def _labels(diagram):
+    return {node['id']: node['data']['label'] for node in diagram['nodes']}
+
+
+def _edges(diagram):
+    labels = _labels(diagram)
+    return [(labels[edge['source']], labels[edge['target']], edge.get('data')) for edge in diagram['edges']]
+
+
+def test_linear_chain():
+    diagram, reason = parse_process_text('Nộp đơn → Duyệt → Lưu hồ sơ')
+    assert reason is None
+    assert [(s, t) for s, t, _ in _edges(diagram)] == [('Nộp đơn', 'Duyệt'), ('Duyệt', 'Lưu hồ sơ')]
+    assert [node['type'] for node in diagram['nodes']] == ['input', 'default', 'output']
+
+
+def test_branches_leave_from_the_step_before_the_condition():
+    diagram, reason = parse_process_text(
+        'Nộp hồ sơ -> Nếu điểm > 700 và thu nhập > 10tr -> Duyệt, Nếu điểm < 700 -> Từ chối')
+    assert reason is None
+    (s1, t1, c1), (s2, t2, c2) = _edges(diagram)
+    assert (s1, t1, s2, t2) == ('Nộp hồ sơ', 'Duyệt', 'Nộp hồ sơ', 'Từ chối')
+    assert c1['logic'] == 'VÀ'
+    assert [(r['field'], r['operator'], r['value']) for r in c1['rules']] == [
+        ('điểm', 'Lớn hơn', '700'), ('thu nhập', 'Lớn hơn', '10tr')]
+    assert c2['rules'][0]['operator'] == 'Nhỏ hơn'
+
+
+def test_split_step_and_path_labels():
+    diagram, reason = parse_process_text('A → Tách nhánh → Nếu Path A → B, Nếu Path B → C')
+    assert reason is None
+    assert 'Tách nhánh' not in _labels(diagram).values()
+    assert [(s, t, c['rules'][0]['value']) for s, t, c in _edges(diagram)] == [('A', 'B', 'A'), ('A', 'C', 'B')]
+
+
+def test_new_line_continues_from_existing_node():
+    diagram, _ = parse_process_text('A → B\nB → C')
+    assert len(diagram['nodes']) == 3
+    assert [(s, t) for s, t, _ in _edges(diagram)] == [('A', 'B'), ('B', 'C')]
+
+
+@pytest.mark.parametrize('text', [
+    'Kiểm tra → Nếu hợp lệ → Lưu, Ngược lại → Báo lỗi',
+    'Kiểm tra → Nếu hợp lệ → Lưu\nCòn lại → Báo lỗi',
+    'Check → If valid → Save, Otherwise → Reject',
+    'Check → If not valid → Reject',
+    'Kiểm tra → Nếu không hợp lệ → Từ chối',
+    'Kiểm tra → Trường hợp khác → Từ chối',
+])
+def test_else_and_negated_branches_go_to_the_model(text):
+    diagram, reason = parse_process_text(text)
+    assert diagram is None
+    assert reason
+
+
+@pytest.mark.parametrize('text', [
+    'Khách hàng mua hàng, sau đó → Thanh toán',
+    'Khách hàng đặt hàng. Sau đó nhân viên xác nhận → Giao hàng',
+    'Đơn được gửi đi → Ai duyệt đơn?',
+    'Bước một; bước hai → Kết thúc',
+])
+def test_prose_goes_to_the_model(text):
+    diagram, reason = parse_process_text(text)
+    assert diagram is None
+    assert 'prose' in reason
+
+
+@pytest.mark.parametrize('text, reason', [
+    ('Không có mũi tên nào', 'no arrows'),
+    ('A → → B', 'empty step between arrows'),
+    ('Nếu X → B', 'branch without a preceding step'),
+    ('A → Nếu X', 'condition without a target step'),
+])
+def test_malformed_chains_are_declined(text, reason):
+    assert parse_process_text(text) == (None, reason)
+
+
+def test_numbers_with_thousands_separator_still_parse():
+    diagram, reason = parse_process_text('Đặt hàng → Nếu tổng > 10,000 → Miễn phí giao hàng')
+    assert reason is None
+    assert _edges(diagram)[0][2]['rules'][0]['value'] == '10,000'
+
+
+def test_negation_inside_a_rule_is_not_an_else_branch():
+    diagram, reason = parse_process_text('Nhập email → Nếu email không chứa @ → Báo lỗi')
+    assert reason is None
+    assert _edges(diagram)[0][2]['rules'][0]['operator'] == 'Không chứa'
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('a > 1 hoặc b < 2', ('HOẶC', ['Lớn hơn', 'Nhỏ hơn'])),
+    ('trạng thái là đã duyệt', ('VÀ', ['Bằng'])),
+    ('tài liệu tồn tại', ('VÀ', ['Tồn tại'])),
+    ('khách VIP', ('VÀ', ['Là true'])),
+])
+def test_parse_condition(text, expected):
+    condition = parse_condition(text)
+    assert (condition['logic'], [rule['operator'] for rule in condition['rules']]) == expected
+
+
+@pytest.mark.parametrize('text', ['a > 1 và b < 2 hoặc c', 'điểm >= 700', ''])
+def test_parse_condition_declines_mixed_logic_and_unsupported_operators(text):
+    assert parse_condition(text) is None
@@ -0,0 +1,150 @@
+import copy
+
+import pytest
+
+from result_cache import LRUCache, SQLiteCacheStore, TieredCache, canonical_diagram, make_cache_key
+
+DIAGRAM = {
+    'nodes': [
+        {'id': 'a', 'type': 'input', 'data': {'label': 'Bắt đầu'}, 'position': {'x': 0, 'y': 0}},
+        {'id': 'b', 'data': {'label': 'Duyệt'}, 'position': {'x': 250, 'y': 0}, 'selected': True}
+    ],
+    'edges': [
+        {'id': 'e1', 'source': 'a', 'target': 'b', 'animated': True,
+         'data': {'logic': 'VÀ', 'rules': [{'field': 'điểm', 'operator': 'Lớn hơn', 'value': '700'}]}}
+    ]
+}
+
+
+def _key(diagram):
+    return make_cache_key('analysis', canonical_diagram(diagram))
+
+
+class FakeTime:
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr('result_cache.time.time', lambda: self.now)
+
+
+# --- canonical_diagram / make_cache_key ---
+
+def test_cosmetic_changes_keep_the_key():
+    moved = copy.deepcopy(DIAGRAM)
+    moved['nodes'][0]['position'] = {'x': 999, 'y': 5}
+    moved['nodes'][1].update(style={'color': 'red'}, width=120, dragging=True)
+    moved['edges'][0].update(markerEnd={'type': 'arrow'}, style={'stroke': '#000'}, sourceHandle='h1')
+    moved['nodes'].reverse()
+    # Thứ tự khóa trong object không ảnh hưởng
+    moved['edges'][0] = dict(reversed(list(moved['edges'][0].items())))
+    assert _key(moved) == _key(DIAGRAM)
+
+
+@pytest.mark.parametrize('change', [
+    lambda d: d['nodes'][1]['data'].update(label='Từ chối'),
+    lambda d: d['nodes'][0].update(type='default'),
+    lambda d: d['edges'][0].update(target='a'),
+    lambda d: d['edges'][0]['data']['rules'][0].update(value='800'),
+    lambda d: d['edges'][0]['data'].update(logic='HOẶC'),
+    lambda d: d['nodes'].append({'id': 'c', 'data': {'label': 'Kết thúc'}}),
+])
+def test_semantic_changes_get_a_new_key(change):
+    changed = copy.deepcopy(DIAGRAM)
+    change(changed)
+    assert _key(changed) != _key(DIAGRAM)
+
+
+def test_key_depends_on_every_part():
+    assert make_cache_key('a', {'x': 1, 'y': 2}) == make_cache_key('a', {'y': 2, 'x': 1})
+    assert make_cache_key('a', 'q') != make_cache_key('a', 'q ')
+
+
+# --- LRUCache ---
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(max_entries=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == (1, None, 3)
+
+
+def test_lru_ttl_and_per_entry_override(monkeypatch):
+    clock = FakeTime(monkeypatch)
+    cache = LRUCache(max_entries=10, ttl_seconds=10)
+    cache.set('short', 1)
+    cache.set('long', 2, ttl_seconds=100)
+    clock.now += 11
+    assert cache.get('short') is None
+    assert cache.get('long') == 2
+    assert len(cache) == 1
+
+
+# --- SQLiteCacheStore ---
+
+def test_sqlite_round_trip_and_ttl(tmp_path, monkeypatch):
+    clock = FakeTime(monkeypatch)
+    store = SQLiteCacheStore(str(tmp_path / 'cache.sqlite3'), ttl_seconds=10)
+    store.set('k', {'value': [1, 'hai']})
+    store.set('forever', 1, ttl_seconds=0)
+    assert store.get('k') == {'value': [1, 'hai']}
+    clock.now += 11
+    assert store.get('k') is None
+    assert store.get('forever') == 1
+    store.delete('forever')
+    assert store.get('forever') is None
+
+
+def test_sqlite_evicts_by_entries_in_access_order(tmp_path, monkeypatch):
+    clock = FakeTime(monkeypatch)
+    store = SQLiteCacheStore(str(tmp_path / 'cache.sqlite3'), max_entries=2)
+    store.set('a', 1)
+    clock.now += 1
+    store.set('b', 2)
+    clock.now += 1
+    store.get('a')
+    clock.now += 1
+    store.set('c', 3)
+    assert (store.get('a'), store.get('b'), store.get('c')) == (1, None, 3)
+
+
+def test_sqlite_evicts_by_bytes_and_skips_oversized_values(tmp_path, monkeypatch):
+    clock = FakeTime(monkeypatch)
+    store = SQLiteCacheStore(str(tmp_path / 'cache.sqlite3'), max_bytes=250)
+    store.set('a', 'x' * 100)
+    clock.now += 1
+    store.set('b', 'y' * 100)
+    clock.now += 1
+    store.set('c', 'z' * 100)
+    assert (store.get('a'), store.get('b') is not None, store.get('c') is not None) == (None, True, True)
+    store.set('huge', 'w' * 1000)
+    assert store.get('huge') is None
+
+
+# --- TieredCache ---
+
+def test_tiered_cache_promotes_store_hits(tmp_path):
+    store = SQLiteCacheStore(str(tmp_path / 'cache.sqlite3'))
+    TieredCache(LRUCache(), store).set('k', {'v': 1})
+    # Process mới (Lambda cold start): bộ nhớ trống, store vẫn còn
+    cache = TieredCache(LRUCache(), store)
+    assert cache.get('k') == ({'v': 1}, 'store')
+    assert cache.get('k') == ({'v': 1}, 'memory')
+    assert cache.get('missing') == (None, None)
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'memory_entries': 1}
+    cache.delete('k')
+    assert cache.get('k') == (None, None)
+
+
+def test_tiered_cache_survives_store_errors():
+    class BrokenStore:
+        def get(self, key):
+            raise OSError('disk')
+
+        def set(self, key, value, ttl_seconds=None):
+            raise OSError('disk')
+
+    cache = TieredCache(LRUCache(), BrokenStore())
+    cache.set('k', 1)
+    assert cache.get('k') == (1, 'memory')
+    assert cache.get('other') == (None, None)
@@ -0,0 +1,88 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from single_flight import SingleFlight
+
+
+def _leader_and_waiters(flight, fn, waiters=4, timeout=None):
+    """Start a leader blocked inside fn, then `waiters` joining callers; returns (leader future, waiter futures)"""
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking():
+        started.set()
+        release.wait(5)
+        return fn()
+
+    pool = ThreadPoolExecutor(max_workers=waiters + 1)
+    leader = pool.submit(flight.do, 'k', blocking)
+    assert started.wait(5)
+    joined = [pool.submit(flight.do, 'k', fn, timeout) for _ in range(waiters)]
+    # Đợi mọi caller đã gộp vào lần chạy của leader
+    deadline = time.monotonic() + 5
+    while flight.coalesced < waiters and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert flight.coalesced == waiters
+    return leader, joined, release, pool
+
+
+def test_concurrent_callers_share_one_execution():
+    flight = SingleFlight('test')
+    calls = []
+    leader, joined, release, pool = _leader_and_waiters(flight, lambda: calls.append(1) or 'result')
+    release.set()
+    assert leader.result() == ('result', False)
+    assert [future.result() for future in joined] == [('result', True)] * 4
+    assert calls == [1]
+    assert flight.stats() == {'executions': 1, 'coalesced': 4, 'in_flight': 0}
+    pool.shutdown()
+
+
+def test_exception_reaches_every_waiter():
+    flight = SingleFlight('test')
+
+    def fail():
+        raise ValueError('boom')
+    leader, joined, release, pool = _leader_and_waiters(flight, fail)
+    release.set()
+    for future in [leader, *joined]:
+        with pytest.raises(ValueError, match='boom'):
+            future.result()
+    pool.shutdown()
+
+
+def test_waiter_times_out_while_leader_finishes():
+    flight = SingleFlight('test')
+    leader, joined, release, pool = _leader_and_waiters(flight, lambda: 'late', waiters=1, timeout=0.05)
+    with pytest.raises(TimeoutError):
+        joined[0].result()
+    release.set()
+    assert leader.result() == ('late', False)
+    pool.shutdown()
+
+
+def test_timeout_error_raised_by_fn_is_not_a_wait_timeout():
+    flight = SingleFlight('test')
+
+    def fail():
+        raise TimeoutError('leader stage timed out')
+    leader, joined, release, pool = _leader_and_waiters(flight, fail, waiters=1, timeout=5)
+    release.set()
+    with pytest.raises(TimeoutError, match='leader stage'):
+        joined[0].result()
+    pool.shutdown()
+
+
+def test_key_is_released_after_completion():
+    flight = SingleFlight('test')
+    assert flight.do('k', lambda: 1) == (1, False)
+    assert flight.in_flight() == 0
+    # Lần gọi sau không gộp vào lần trước đã xong
+    assert flight.do('k', lambda: 2) == (2, False)
+    with pytest.raises(KeyError):
+        flight.do('k', lambda: {}['missing'])
+    assert flight.in_flight() == 0
+    assert flight.do('k', lambda: 3) == (3, False)